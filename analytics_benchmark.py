@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Room activity analytics benchmark
+Times the per-message counter update and the /api/stats rollups over many rooms
+
+    python analytics_benchmark.py --rooms 1000 10000
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+
+from analytics import RoomActivity  # noqa: E402
+
+MESSAGES = 200000
+QUERIES = 50
+
+
+def time_stats(activity, resolution, window):
+    samples = []
+    for _ in range(QUERIES):
+        start = time.perf_counter()
+        activity.stats(resolution, window)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Room activity analytics benchmark")
+    parser.add_argument("--rooms", type=int, nargs="+", default=[1000, 10000])
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    for rooms in args.rooms:
+        room_ids = [f"room_{i}" for i in range(rooms)]
+        users = [f"user_{i}" for i in range(rooms * 5)]
+        with tempfile.TemporaryDirectory() as path:
+            activity = RoomActivity(str(Path(path) / "stats.npz"))
+            for room_id in room_ids:
+                activity.listeners(room_id, rng.randint(0, 50))
+            traffic = [(rng.choice(room_ids), rng.choice(users)) for _ in range(MESSAGES)]
+            start = time.perf_counter()
+            for room_id, user_id in traffic:
+                activity.message(room_id, user_id)
+            per_message = (time.perf_counter() - start) / MESSAGES * 1e6
+
+            print(f"{rooms} rooms: {per_message:.2f} µs per message update, "
+                  f"{sum(a.nbytes for t in activity.tiers.values() for a in t.arrays.values()) / 2 ** 20:.0f} MiB")
+            for resolution, window in (("minute", 60), ("minute", 360), ("hour", 24), ("hour", 720), ("day", 30)):
+                print(f"  stats {resolution:<6} x {window:<5} median {time_stats(activity, resolution, window):>8.2f} ms")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+METRICS = ("messages", "senders", "listeners")
+# How rollups combine buckets: messages add up, distinct senders and listeners can only take the peak
+ROLLUP = {"messages": np.sum, "senders": np.max, "listeners": np.max}
+
+
+# One resolution of per-room counters: a [length, rooms] ring per metric, where the row
+# for bucket b is b % length, so a window of buckets is a contiguous block of rows.
+# `bucket` is the newest bucket; moving it on clears the rows being reused, for every
+# room at once.
+class Tier:
+    def __init__(self, step: int, length: int, capacity: int):
+        self.step = step
+        self.length = length
+        self.bucket = 0
+        self.arrays: Dict[str, np.ndarray] = {name: np.zeros((length, capacity), np.uint32) for name in METRICS}
+        # Senders already counted in the current bucket, per room
+        self.seen: Dict[int, Set[str]] = {}
+
+    def grow(self, capacity: int):
+        for name, array in self.arrays.items():
+            grown = np.zeros((self.length, capacity), np.uint32)
+            grown[:, :array.shape[1]] = array
+            self.arrays[name] = grown
+
+    def advance(self, bucket: int, listeners: np.ndarray):
+        if bucket <= self.bucket:
+            return
+        stale = np.arange(max(self.bucket + 1, bucket - self.length + 1), bucket + 1) % self.length
+        self.arrays["messages"][stale] = 0
+        self.arrays["senders"][stale] = 0
+        # Rooms keep their listeners across buckets even when nobody joins or leaves
+        self.arrays["listeners"][stale] = listeners
+        self.bucket = bucket
+        self.seen.clear()
+
+    def window(self, name: str, first: int, count: int, rooms) -> np.ndarray:
+        # [count, rooms] for buckets first..first+count-1; buckets outside the ring read as 0
+        array = self.arrays[name]
+        out = np.zeros((count, array[:1, rooms].shape[1]), np.uint32)
+        low = max(first, self.bucket - self.length + 1)
+        high = min(first + count - 1, self.bucket)
+        if low > high:
+            return out
+        start, stop = low % self.length, high % self.length
+        if start <= stop:
+            out[low - first:high - first + 1] = array[start:stop + 1, rooms]
+        else:
+            # Wraps around the end of the ring
+            split = low - first + self.length - start
+            out[low - first:split] = array[start:, rooms]
+            out[split:high - first + 1] = array[:stop + 1, rooms]
+        return out
+
+
+# Per-room activity counters (messages, distinct senders and peak listeners) at minute
+# and hour resolution, updated in place on the message and presence paths so stats never
+# scan storage. Minute, hour and day series are rolled up from the rings with vectorized
+# operations; days come from the hour ring. Snapshotted to `path` every
+# snapshot_interval and on close, and loaded on start. Only rooms `known` accepts get a
+# column, so room ids made up by clients cannot grow the rings.
+class RoomActivity:
+    def __init__(self, path: str, minutes: int = 360, hours: int = 720, snapshot_interval: float = 60.0,
+                 clock: Callable[[], float] = time.time, known: Callable[[str], bool] = lambda room_id: True):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.clock = clock
+        self.known = known
+        self.rooms: Dict[str, int] = {}
+        self.room_ids: List[str] = []
+        self.current_listeners = np.zeros(64, np.uint32)
+        self.minutes = Tier(60, minutes, 64)
+        self.hours = Tier(3600, hours, 64)
+        self._task: Optional[asyncio.Task] = None
+        self.advance()
+
+    @property
+    def tiers(self) -> Dict[str, Tier]:
+        return {"minute": self.minutes, "hour": self.hours}
+
+    async def start(self):
+        snapshot = await asyncio.to_thread(self._load_snapshot)
+        if snapshot is not None:
+            self._restore(snapshot)
+            logger.info("Loaded activity counters for %d rooms", len(self.room_ids))
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.save()
+
+    def _index(self, room_id: str) -> Optional[int]:
+        # Rooms are columns of every ring, in order of first activity
+        index = self.rooms.get(room_id)
+        if index is None:
+            if not self.known(room_id):
+                return None
+            index = self.rooms[room_id] = len(self.room_ids)
+            self.room_ids.append(room_id)
+            if index == len(self.current_listeners):
+                capacity = index * 2
+                self.current_listeners = np.resize(self.current_listeners, capacity)
+                self.current_listeners[index:] = 0
+                for tier in self.tiers.values():
+                    tier.grow(capacity)
+        return index
+
+    def advance(self, now: Optional[float] = None):
+        now = self.clock() if now is None else now
+        listeners = self.current_listeners
+        for tier in self.tiers.values():
+            tier.advance(int(now // tier.step), listeners)
+
+    def message(self, room_id: str, user_id: str):
+        self.advance()
+        index = self._index(room_id)
+        if index is None:
+            return
+        for tier in self.tiers.values():
+            row = tier.bucket % tier.length
+            tier.arrays["messages"][row, index] += 1
+            seen = tier.seen.setdefault(index, set())
+            if user_id not in seen:
+                seen.add(user_id)
+                tier.arrays["senders"][row, index] += 1
+
+    def listeners(self, room_id: str, count: int):
+        self.advance()
+        index = self._index(room_id)
+        if index is None:
+            return
+        self.current_listeners[index] = count
+        for tier in self.tiers.values():
+            peaks = tier.arrays["listeners"]
+            row = tier.bucket % tier.length
+            if count > peaks[row, index]:
+                peaks[row, index] = count
+
+    def _window(self, resolution: str, window: int, rooms) -> Dict[str, np.ndarray]:
+        # Each metric as [window, rooms], oldest bucket first, plus the first bucket's start time
+        self.advance()
+        if resolution == "day":
+            tier = self.hours
+            first_day = tier.bucket // 24 - window + 1
+            series = {
+                name: ROLLUP[name](tier.window(name, first_day * 24, window * 24, rooms).reshape(window, 24, -1), axis=1)
+                for name in METRICS
+            }
+            series["start"] = first_day * 86400
+            return series
+        tier = self.tiers[resolution]
+        first = tier.bucket - window + 1
+        series = {name: tier.window(name, first, window, rooms) for name in METRICS}
+        series["start"] = first * tier.step
+        return series
+
+    def max_window(self, resolution: str) -> int:
+        if resolution == "day":
+            return self.hours.length // 24
+        return self.tiers[resolution].length
+
+    def stats(self, resolution: str, window: int, top: int = 10, room_id: Optional[str] = None) -> dict:
+        # Totals per bucket across rooms (or for room_id), and the busiest rooms over the window
+        rooms = slice(0, len(self.room_ids))
+        if room_id is not None:
+            index = self.rooms.get(room_id)
+            rooms = [index] if index is not None else []
+        series = self._window(resolution, window, rooms)
+        step = 86400 if resolution == "day" else self.tiers[resolution].step
+        result = {
+            "resolution": resolution,
+            "step_s": step,
+            "start": datetime.utcfromtimestamp(series["start"]).isoformat(),
+            # Rooms add up: a user active or listening in two rooms counts in both
+            "messages": series["messages"].sum(axis=1, dtype=np.int64).tolist(),
+            "active_senders": series["senders"].sum(axis=1, dtype=np.int64).tolist(),
+            "listeners": series["listeners"].sum(axis=1, dtype=np.int64).tolist()
+        }
+        if room_id is None:
+            result["top_rooms"] = self._top_rooms(series, top)
+        return result
+
+    def _top_rooms(self, series: Dict[str, np.ndarray], top: int) -> List[dict]:
+        messages = series["messages"].sum(axis=0, dtype=np.int64)
+        active = np.flatnonzero(messages)
+        if top < len(active):
+            active = active[np.argpartition(messages[active], -top)[-top:]]
+        active = active[np.argsort(messages[active])[::-1]]
+        senders = series["senders"][:, active].max(axis=0)
+        listeners = series["listeners"][:, active].max(axis=0)
+        return [
+            {
+                "room_id": self.room_ids[index],
+                "messages": int(messages[index]),
+                "peak_senders": int(senders[i]),
+                "peak_listeners": int(listeners[i])
+            }
+            for i, index in enumerate(active)
+        ]
+
+    async def save(self):
+        # Copied here, encoded and written off the event loop
+        if not self.room_ids:
+            return
+        self.advance()
+        snapshot = {
+            "version": np.array(SNAPSHOT_VERSION),
+            "room_ids": np.array(self.room_ids),
+        }
+        for resolution, tier in self.tiers.items():
+            snapshot[f"{resolution}_bucket"] = np.array(tier.bucket)
+            for name, array in tier.arrays.items():
+                snapshot[f"{resolution}_{name}"] = array[:, :len(self.room_ids)].copy()
+        try:
+            await asyncio.to_thread(self._write_snapshot, snapshot)
+        except OSError as e:
+            logger.error("Could not save activity counters: %s", e)
+
+    def _write_snapshot(self, snapshot: Dict[str, np.ndarray]):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "wb") as f:
+            np.savez_compressed(f, **snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    def _load_snapshot(self) -> Optional[Dict[str, np.ndarray]]:
+        try:
+            with np.load(self.path) as data:
+                snapshot = {key: data[key] for key in data.files}
+            if int(snapshot["version"]) != SNAPSHOT_VERSION:
+                return None
+        except FileNotFoundError:
+            return None
+        except (OSError, KeyError, ValueError) as e:
+            # Counting starts over
+            logger.warning("Ignoring unreadable activity snapshot %s: %s", self.path, e)
+            return None
+        return snapshot
+
+    def _restore(self, snapshot: Dict[str, np.ndarray]):
+        # Only the history comes back: rooms are matched up by id and the rings move on to
+        # now, zeroing every metric for the buckets the process was down for. Listeners
+        # start from zero, since whoever was connected before went with the old process.
+        for resolution, tier in self.tiers.items():
+            if snapshot[f"{resolution}_{METRICS[0]}"].shape[0] != tier.length:
+                logger.warning("Activity snapshot has a different ring length; ignoring it")
+                return
+        columns, indexes = [], []
+        for column, room_id in enumerate(snapshot["room_ids"]):
+            index = self._index(str(room_id))
+            if index is not None:
+                columns.append(column)
+                indexes.append(index)
+        now = self.clock()
+        for resolution, tier in self.tiers.items():
+            saved = Tier(tier.step, tier.length, len(indexes))
+            saved.bucket = int(snapshot[f"{resolution}_bucket"])
+            for name in METRICS:
+                saved.arrays[name] = snapshot[f"{resolution}_{name}"][:, columns]
+            saved.advance(int(now // tier.step), np.zeros(len(indexes), np.uint32))
+            for name in METRICS:
+                combine = np.add if name != "listeners" else np.maximum
+                tier.arrays[name][:, indexes] = combine(tier.arrays[name][:, indexes], saved.arrays[name])
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.save()
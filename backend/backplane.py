@@ -0,0 +1,302 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+from typing import Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# (room_id, frame, coalesce_key) handed to the local ConnectionManager
+Deliver = Callable[[str, str, Optional[str]], None]
+# Called with a room_id whenever its room-wide user count may have changed
+PresenceListener = Callable[[str], None]
+
+
+# Pub/sub between workers: room frames are published once and delivered to every
+# other worker with local subscribers; presence counts are summed across workers.
+# Everything except start/close is synchronous so it can sit on the broadcast path.
+class Backplane:
+    def __init__(self):
+        self.deliver: Optional[Deliver] = None
+        self.on_presence: Optional[PresenceListener] = None
+        self.subscriptions: Set[str] = set()
+        self.local_presence: Dict[str, int] = {}
+        self.totals: Dict[str, int] = {}
+
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+
+    async def close(self):
+        pass
+
+    def subscribe(self, room_id: str):
+        self.subscriptions.add(room_id)
+
+    def unsubscribe(self, room_id: str):
+        self.subscriptions.discard(room_id)
+
+    def publish(self, room_id: str, frame: str, coalesce_key: Optional[str] = None):
+        raise NotImplementedError
+
+    def set_presence(self, room_id: str, count: int):
+        if count:
+            self.local_presence[room_id] = count
+        else:
+            self.local_presence.pop(room_id, None)
+
+    def room_user_count(self, room_id: str) -> int:
+        return self.totals.get(room_id, self.local_presence.get(room_id, 0))
+
+    def _on_message(self, room_id: str, frame: str, coalesce_key: Optional[str]):
+        if self.deliver is not None and room_id in self.subscriptions:
+            self.deliver(room_id, frame, coalesce_key)
+
+    def _presence_changed(self, room_id: str):
+        if self.on_presence is not None:
+            self.on_presence(room_id)
+
+
+# Shared by every InMemoryBackplane in a process; lets tests run several "workers" in one loop
+class InMemoryHub:
+    def __init__(self):
+        self.nodes: Set["InMemoryBackplane"] = set()
+
+    def publish(self, origin: "InMemoryBackplane", room_id: str, frame: str, coalesce_key: Optional[str]):
+        for node in self.nodes:
+            if node is not origin:
+                node._on_message(room_id, frame, coalesce_key)
+
+    def presence_changed(self, room_id: str):
+        total = sum(node.local_presence.get(room_id, 0) for node in self.nodes)
+        for node in self.nodes:
+            if total:
+                node.totals[room_id] = total
+            else:
+                node.totals.pop(room_id, None)
+            node._presence_changed(room_id)
+
+
+class InMemoryBackplane(Backplane):
+    def __init__(self, hub: Optional[InMemoryHub] = None):
+        super().__init__()
+        self.hub = hub or InMemoryHub()
+
+    async def start(self, deliver: Deliver):
+        await super().start(deliver)
+        self.hub.nodes.add(self)
+
+    async def close(self):
+        self.hub.nodes.discard(self)
+        for room_id in list(self.local_presence):
+            self.hub.presence_changed(room_id)
+
+    def publish(self, room_id: str, frame: str, coalesce_key: Optional[str] = None):
+        self.hub.publish(self, room_id, frame, coalesce_key)
+
+    def set_presence(self, room_id: str, count: int):
+        super().set_presence(room_id, count)
+        self.hub.presence_changed(room_id)
+
+
+# Broker for UnixSocketBackplane; runs inside whichever worker holds the lock file
+class UnixSocketBroker:
+    def __init__(self, path: str):
+        self.path = path
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.clients: Dict[asyncio.StreamWriter, Set[str]] = {}
+        self.presence: Dict[asyncio.StreamWriter, Dict[str, int]] = {}
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._handle, path=self.path)
+
+    async def close(self):
+        for writer in list(self.clients):
+            writer.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients[writer] = set()
+        self.presence[writer] = {}
+        # New workers need the current totals for rooms they have no users in yet
+        for room_id in self._rooms_with_presence():
+            self._send(writer, {"op": "presence", "room": room_id, "count": self._total(room_id)})
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self._dispatch(writer, json.loads(line))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            del self.clients[writer]
+            rooms = self.presence.pop(writer)
+            for room_id in rooms:
+                self._broadcast_presence(room_id)
+            writer.close()
+
+    def _dispatch(self, writer: asyncio.StreamWriter, event: dict):
+        op = event["op"]
+        if op == "sub":
+            self.clients[writer].add(event["room"])
+        elif op == "unsub":
+            self.clients[writer].discard(event["room"])
+        elif op == "pub":
+            line = self._encode(event)
+            for client, rooms in self.clients.items():
+                if client is not writer and event["room"] in rooms:
+                    client.write(line)
+        elif op == "presence":
+            if event["count"]:
+                self.presence[writer][event["room"]] = event["count"]
+            else:
+                self.presence[writer].pop(event["room"], None)
+            self._broadcast_presence(event["room"])
+
+    def _rooms_with_presence(self) -> Set[str]:
+        return {room_id for rooms in self.presence.values() for room_id in rooms}
+
+    def _total(self, room_id: str) -> int:
+        return sum(rooms.get(room_id, 0) for rooms in self.presence.values())
+
+    def _broadcast_presence(self, room_id: str):
+        line = self._encode({"op": "presence", "room": room_id, "count": self._total(room_id)})
+        for client in self.clients:
+            client.write(line)
+
+    def _send(self, writer: asyncio.StreamWriter, event: dict):
+        writer.write(self._encode(event))
+
+    @staticmethod
+    def _encode(event: dict) -> bytes:
+        return json.dumps(event, separators=(',', ':')).encode() + b"\n"
+
+
+# Local multi-process backplane: workers on one box talk newline-delimited JSON over a
+# Unix domain socket. The worker holding an flock on <path>.lock runs the broker; if it
+# exits, the others reconnect and one of them takes over.
+class UnixSocketBackplane(Backplane):
+    def __init__(self, path: str, reconnect_delay: float = 0.2):
+        super().__init__()
+        self.path = path
+        self.reconnect_delay = reconnect_delay
+        self.broker: Optional[UnixSocketBroker] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self._lock_fd: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+
+    async def start(self, deliver: Deliver):
+        await super().start(deliver)
+        self._task = asyncio.create_task(self._run())
+        await self._connected.wait()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.writer is not None:
+            self.writer.close()
+        if self.broker is not None:
+            await self.broker.close()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+
+    def subscribe(self, room_id: str):
+        if room_id not in self.subscriptions:
+            super().subscribe(room_id)
+            self._send({"op": "sub", "room": room_id})
+
+    def unsubscribe(self, room_id: str):
+        if room_id in self.subscriptions:
+            super().unsubscribe(room_id)
+            self._send({"op": "unsub", "room": room_id})
+
+    def publish(self, room_id: str, frame: str, coalesce_key: Optional[str] = None):
+        self._send({"op": "pub", "room": room_id, "frame": frame, "key": coalesce_key})
+
+    def set_presence(self, room_id: str, count: int):
+        # Adjust the cached total right away; the broker's answer corrects it shortly after
+        delta = count - self.local_presence.get(room_id, 0)
+        super().set_presence(room_id, count)
+        total = self.totals.get(room_id, 0) + delta
+        if total > 0:
+            self.totals[room_id] = total
+        else:
+            self.totals.pop(room_id, None)
+        self._presence_changed(room_id)
+        self._send({"op": "presence", "room": room_id, "count": count})
+
+    def _send(self, event: dict):
+        # Dropped while disconnected; subscriptions and presence are replayed on reconnect
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(UnixSocketBroker._encode(event))
+
+    def _try_become_broker(self) -> bool:
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(self.path + ".lock", os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                if self.broker is None and self._try_become_broker():
+                    self.broker = UnixSocketBroker(self.path)
+                    await self.broker.start()
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+            except (ConnectionError, FileNotFoundError):
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+
+            for room_id in self.subscriptions:
+                self._send({"op": "sub", "room": room_id})
+            for room_id, count in self.local_presence.items():
+                self._send({"op": "presence", "room": room_id, "count": count})
+            self._connected.set()
+
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    event = json.loads(line)
+                    if event["op"] == "pub":
+                        self._on_message(event["room"], event["frame"], event.get("key"))
+                    elif event["op"] == "presence":
+                        if event["count"]:
+                            self.totals[event["room"]] = event["count"]
+                        else:
+                            self.totals.pop(event["room"], None)
+                        self._presence_changed(event["room"])
+            except ConnectionError:
+                pass
+            logger.warning("Lost connection to backplane broker at %s, reconnecting", self.path)
+            self.writer = None
+            stale = list(self.totals)
+            self.totals.clear()
+            for room_id in stale:
+                self._presence_changed(room_id)
+            await asyncio.sleep(self.reconnect_delay)
+
+
+def create_backplane(kind: str, path: str) -> Backplane:
+    if kind == 'memory':
+        return InMemoryBackplane()
+    if kind == 'unix':
+        return UnixSocketBackplane(path)
+    raise ValueError(f"Unknown backplane: {kind}")
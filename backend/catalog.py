@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+# Pending lobby events per subscriber before it is told to refetch instead
+LOBBY_QUEUE_SIZE = 16
+# Rendered (offset, limit) pages kept until the catalog changes
+MAX_CACHED_PAGES = 64
+
+
+# Every room, held in memory from startup, with room-wide user counts kept current by
+# backplane presence callbacks. `version` changes whenever anything a listing shows
+# changes; rendered pages are cached until it moves. A page's ETag is a hash of its body,
+# so every worker serving the same listing gives the same ETag.
+# Count changes are pushed to lobby subscribers at most once per push_interval.
+class RoomCatalog:
+    def __init__(self, user_count: Callable[[str], int], push_interval: float = 1.0):
+        self.user_count = user_count
+        self.push_interval = push_interval
+        self.rooms: Dict[str, dict] = {}  # room_id -> JSON-ready room, in creation order
+        self.order: List[str] = []
+        self.counts: Dict[str, int] = {}
+        self.version = 0
+        self.subscribers: Set[asyncio.Queue] = set()
+        self._pages: "OrderedDict[Tuple[int, int], Tuple[bytes, str]]" = OrderedDict()
+        self._pending_counts: Dict[str, int] = {}
+        self._pending_rooms: List[dict] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def load(self, rooms: List[dict]):
+        for room in sorted(rooms, key=lambda r: r["created_at"]):
+            self.add(room)
+
+    def add(self, room: dict) -> bool:
+        if room["id"] in self.rooms:
+            return False
+        payload = {**room, "created_at": room["created_at"].isoformat()}
+        payload.pop("user_count", None)
+        self.rooms[room["id"]] = payload
+        self.order.append(room["id"])
+        count = self.user_count(room["id"])
+        if count:
+            self.counts[room["id"]] = count
+        self._changed()
+        self._pending_rooms.append(self.render_room(room["id"]))
+        self._schedule_push()
+        return True
+
+    def count_changed(self, room_id: str):
+        if room_id not in self.rooms:
+            return
+        count = self.user_count(room_id)
+        if count == self.counts.get(room_id, 0):
+            return
+        if count:
+            self.counts[room_id] = count
+        else:
+            self.counts.pop(room_id, None)
+        self._changed()
+        self._pending_counts[room_id] = count
+        self._schedule_push()
+
+    def _changed(self):
+        self.version += 1
+        self._pages.clear()
+
+    def render_room(self, room_id: str) -> dict:
+        return {**self.rooms[room_id], "user_count": self.counts.get(room_id, 0)}
+
+    def page(self, offset: int, limit: int) -> Tuple[bytes, str]:
+        # The JSON body and its ETag
+        key = (offset, limit)
+        page = self._pages.get(key)
+        if page is None:
+            rooms = [self.render_room(room_id) for room_id in self.order[offset:offset + limit]]
+            body = json.dumps(rooms, ensure_ascii=False).encode()
+            page = self._pages[key] = (body, f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"')
+            if len(self._pages) > MAX_CACHED_PAGES:
+                self._pages.popitem(last=False)
+        else:
+            self._pages.move_to_end(key)
+        return page
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=LOBBY_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def _schedule_push(self):
+        if not self.subscribers:
+            self._pending_counts.clear()
+            self._pending_rooms.clear()
+            return
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.push_interval, self._push)
+
+    def _push(self):
+        self._timer = None
+        text = json.dumps({
+            "type": "lobby",
+            "version": self.version,
+            "rooms": self._pending_rooms,
+            "counts": self._pending_counts
+        }, ensure_ascii=False)
+        self._pending_counts = {}
+        self._pending_rooms = []
+        for queue in self.subscribers:
+            if queue.full():
+                # Too far behind for deltas to be useful; have it refetch the list
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(json.dumps({"type": "resync", "version": self.version}))
+            else:
+                queue.put_nowait(text)
@@ -0,0 +1,164 @@
+from typing import Dict, Generic, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+# Two-way str <-> small int mapping; released ids are reused so the tables stay dense
+class Interner:
+    __slots__ = ("ids", "names", "free")
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.names: List[Optional[str]] = []
+        self.free: List[int] = []
+
+    def intern(self, name: str) -> int:
+        index = self.ids.get(name)
+        if index is None:
+            if self.free:
+                index = self.free.pop()
+                self.names[index] = name
+            else:
+                index = len(self.names)
+                self.names.append(name)
+            self.ids[name] = index
+        return index
+
+    def lookup(self, name: str) -> Optional[int]:
+        return self.ids.get(name)
+
+    def name(self, index: int) -> str:
+        return self.names[index]
+
+    def release(self, index: int):
+        del self.ids[self.names[index]]
+        self.names[index] = None
+        self.free.append(index)
+
+
+# Connections indexed by interned user and room ids. Each room's members are a dense
+# list and every connection remembers its position there, so removal is a swap with the
+# last member. Records need `user`, `room`, `slot` and `rooms` attributes: a single-room
+# connection keeps its room and position in `room`/`slot` (with `rooms` None), while a
+# multiplexed one keeps room -> position for every room it is in in the `rooms` dict.
+class ConnectionRegistry(Generic[T]):
+    def __init__(self):
+        self.users = Interner()
+        self.rooms = Interner()
+        self.by_user: List[Optional[T]] = []
+        self.members: List[Optional[List[T]]] = []
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[T]:
+        for connection in self.by_user:
+            if connection is not None:
+                yield connection
+
+    def get(self, user_id: str) -> Optional[T]:
+        user = self.users.lookup(user_id)
+        return self.by_user[user] if user is not None else None
+
+    def user_id(self, connection: T) -> str:
+        return self.users.name(connection.user)
+
+    def room_ids(self, connection: T) -> List[str]:
+        if connection.rooms is not None:
+            return [self.rooms.name(room) for room in connection.rooms]
+        return [self.rooms.name(connection.room)] if connection.room >= 0 else []
+
+    def joined(self, connection: T, room_id: str) -> bool:
+        room = self.rooms.lookup(room_id)
+        if room is None:
+            return False
+        return room in connection.rooms if connection.rooms is not None else connection.room == room
+
+    def add(self, connection: T, user_id: str, room_id: Optional[str] = None) -> bool:
+        # The caller removes any previous connection for user_id first.
+        # Returns True when this is the room's first member.
+        user = self.users.intern(user_id)
+        if user == len(self.by_user):
+            self.by_user.append(None)
+        self.by_user[user] = connection
+        connection.user = user
+        self.count += 1
+        return self.join(connection, room_id) if room_id is not None else False
+
+    def join(self, connection: T, room_id: str) -> bool:
+        # Returns True when this is the room's first member
+        room = self.rooms.intern(room_id)
+        if room == len(self.members):
+            self.members.append(None)
+        members = self.members[room]
+        created = members is None
+        if created:
+            members = self.members[room] = []
+        self._set_slot(connection, room, len(members))
+        members.append(connection)
+        return created
+
+    def leave(self, connection: T, room_id: str) -> bool:
+        # Returns True when the room is left empty
+        room = self.rooms.lookup(room_id)
+        members = self.members[room]
+        slot = connection.rooms.pop(room) if connection.rooms is not None else connection.slot
+        last = members.pop()
+        if last is not connection:
+            members[slot] = last
+            self._set_slot(last, room, slot)
+        if connection.rooms is None:
+            connection.room = connection.slot = -1
+        if members:
+            return False
+        self.members[room] = None
+        self.rooms.release(room)
+        return True
+
+    def remove(self, connection: T):
+        # The caller has the connection leave every room first
+        self.by_user[connection.user] = None
+        self.users.release(connection.user)
+        self.count -= 1
+
+    def _set_slot(self, connection: T, room: int, slot: int):
+        if connection.rooms is not None:
+            connection.rooms[room] = slot
+        else:
+            connection.room = room
+            connection.slot = slot
+
+    def room(self, room_id: str) -> List[T]:
+        room = self.rooms.lookup(room_id)
+        return (self.members[room] or []) if room is not None else []
+
+    def room_sizes(self) -> Iterator[Tuple[str, int]]:
+        for room, members in enumerate(self.members):
+            if members:
+                yield self.rooms.name(room), len(members)
+
+
+# Timing wheel for idle checks: items sit in the slot of their deadline and only due
+# slots are looked at, so a tick costs nothing for connections that are not due
+class IdleWheel(Generic[T]):
+    def __init__(self, tick: float = 1.0):
+        self.tick = tick
+        self.slots: Dict[int, List[T]] = {}
+        self.position: Optional[int] = None
+
+    def schedule(self, item: T, deadline: float):
+        slot = int(deadline // self.tick) + 1
+        if self.position is not None and slot <= self.position:
+            slot = self.position + 1
+        self.slots.setdefault(slot, []).append(item)
+
+    def due(self, now: float) -> List[T]:
+        current = int(now // self.tick)
+        if self.position is None:
+            self.position = min(self.slots, default=current) - 1
+        items: List[T] = []
+        for slot in range(self.position + 1, current + 1):
+            items.extend(self.slots.pop(slot, ()))
+        self.position = max(self.position, current)
+        return items
@@ -0,0 +1,197 @@
+import asyncio
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+# History is ordered, paged and cursored by seq, which is unique within a room. Messages
+# stored before seqs existed are numbered by the storage backend when it starts.
+HistoryKey = int
+
+# Rough per-message overhead of the dict, datetime and id string on top of the text
+MESSAGE_OVERHEAD = 400
+
+
+def message_key(message: dict) -> HistoryKey:
+    return message.get("seq", 0)
+
+
+def message_size(message: dict) -> int:
+    return MESSAGE_OVERHEAD + len(message["message"]) + len(message["username"])
+
+
+class RoomHistory:
+    def __init__(self, size: int):
+        self.messages: Deque[dict] = deque(maxlen=size)
+        self.bytes = 0
+        # True once the buffer holds the room's entire history, so misses mean "no more messages"
+        self.complete = False
+        self.warm = False
+        self.loading: Optional[asyncio.Future] = None
+
+    def append(self, message: dict) -> int:
+        removed = 0
+        if len(self.messages) == self.messages.maxlen:
+            removed = message_size(self.messages.popleft())
+            self.complete = False
+        if self.messages and message_key(message) < message_key(self.messages[-1]):
+            # Seqs from a counter shared between workers can come back slightly out of order
+            self.messages.insert(bisect_right(self.keys(), message_key(message)), message)
+        else:
+            self.messages.append(message)
+        added = message_size(message)
+        self.bytes += added - removed
+        return added - removed
+
+    def keys(self) -> List[HistoryKey]:
+        return [message_key(m) for m in self.messages]
+
+
+# Bounded cache of the most recent messages per room, evicted LRU under a global byte cap
+class RecentHistory:
+    def __init__(self, size: int = 200, max_bytes: int = 64 * 1024 * 1024, max_rooms: int = 10000):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_rooms = max_rooms
+        self.bytes = 0
+        self.rooms: "OrderedDict[str, RoomHistory]" = OrderedDict()
+
+    def _room(self, room_id: str) -> RoomHistory:
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = RoomHistory(self.size)
+        else:
+            self.rooms.move_to_end(room_id)
+        return room
+
+    def recent(self, room_id: str) -> List[dict]:
+        room = self.rooms.get(room_id)
+        return list(room.messages) if room is not None else []
+
+    def forget(self, room_id: str):
+        room = self.rooms.pop(room_id, None)
+        if room is not None:
+            self.bytes -= room.bytes
+
+    def append(self, room_id: str, message: dict):
+        room = self._room(room_id)
+        self.bytes += room.append({k: v for k, v in message.items() if k != "_id"})
+        self._evict()
+
+    async def warm(self, room_id: str, loader: Callable[[int], Awaitable[List[dict]]]) -> RoomHistory:
+        room = self._room(room_id)
+        if room.warm:
+            return room
+        if room.loading is not None:
+            await room.loading
+            return room
+
+        room.loading = asyncio.get_running_loop().create_future()
+        try:
+            stored = await loader(self.size)
+        except Exception:
+            room.loading.set_result(None)
+            room.loading = None
+            raise
+
+        # Merge with anything appended while loading (or still waiting on the write-behind buffer)
+        merged = {m["id"]: m for m in stored}
+        merged.update((m["id"], m) for m in room.messages)
+        current = self.rooms.get(room_id)
+        if current is not room:
+            # Evicted while loading; a fresh entry may have picked up live messages since
+            if current is not None:
+                merged.update((m["id"], m) for m in current.messages)
+                self.bytes -= current.bytes
+            self.rooms[room_id] = room
+        else:
+            self.bytes -= room.bytes
+        room.messages.clear()
+        room.bytes = 0
+        for message in sorted(merged.values(), key=message_key)[-self.size:]:
+            room.append(message)
+        self.bytes += room.bytes
+        room.complete = len(stored) < self.size and len(merged) <= self.size
+        room.warm = True
+        room.loading.set_result(None)
+        room.loading = None
+        self._evict()
+        return room
+
+    def _evict(self):
+        while len(self.rooms) > 1 and (self.bytes > self.max_bytes or len(self.rooms) > self.max_rooms):
+            _, room = self.rooms.popitem(last=False)
+            self.bytes -= room.bytes
+
+    def query(self, room: RoomHistory, limit: int,
+              before: Optional[HistoryKey] = None, after: Optional[HistoryKey] = None) -> Optional[List[dict]]:
+        # Returns None when the answer is not fully inside the buffer and storage must be asked
+        keys = room.keys()
+        messages = list(room.messages)
+        if after is not None:
+            if not room.complete and (not keys or after < keys[0]):
+                return None
+            start = bisect_right(keys, after)
+            return messages[start:start + limit]
+
+        end = bisect_left(keys, before) if before is not None else len(keys)
+        if end < limit and not room.complete:
+            return None
+        return messages[max(0, end - limit):end]
+
+
+# Monotonic per-room sequence numbers, seeded lazily from the highest stored seq. With an
+# allocator, seqs come from it instead (a counter shared by every worker serving the room,
+# read back through `current`) and `sequences` only tracks the highest one seen here:
+# allocated here or observed in frames from other workers.
+class RoomSequencer:
+    def __init__(self, loader: Callable[[str], Awaitable[int]],
+                 allocator: Optional[Callable[[str], Awaitable[int]]] = None,
+                 current: Optional[Callable[[str], Awaitable[int]]] = None):
+        self.loader = loader
+        self.allocator = allocator
+        self.current = current
+        self.sequences: Dict[str, int] = {}
+        self._loading: Dict[str, asyncio.Future] = {}
+
+    async def ensure(self, room_id: str):
+        if room_id in self.sequences:
+            return
+        pending = self._loading.get(room_id)
+        if pending is not None:
+            await pending
+            return await self.ensure(room_id)
+
+        future = self._loading[room_id] = asyncio.get_running_loop().create_future()
+        try:
+            last = await self.loader(room_id)
+            # Messages may have been numbered while the loader ran
+            self.sequences[room_id] = max(last, self.sequences.get(room_id, 0))
+        finally:
+            del self._loading[room_id]
+            future.set_result(None)
+
+    def last(self, room_id: str) -> int:
+        return self.sequences.get(room_id, 0)
+
+    async def head(self, room_id: str) -> int:
+        # The newest seq in the room. With a shared counter that is the counter's, since other
+        # workers number messages this one may not have seen yet.
+        if self.allocator is not None and self.current is not None:
+            self.observe(room_id, await self.current(room_id))
+        return self.last(room_id)
+
+    def observe(self, room_id: str, seq: int):
+        if seq > self.sequences.get(room_id, 0):
+            self.sequences[room_id] = seq
+
+    def next(self, room_id: str) -> int:
+        seq = self.sequences.get(room_id, 0) + 1
+        self.sequences[room_id] = seq
+        return seq
+
+    async def allocate(self, room_id: str) -> int:
+        if self.allocator is None:
+            return self.next(room_id)
+        seq = await self.allocator(room_id)
+        self.observe(room_id, seq)
+        return seq
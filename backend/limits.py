@@ -0,0 +1,80 @@
+import time
+from typing import Dict, Optional
+
+LIMIT_NAMES = ("max_frame_bytes", "max_message_chars", "conn_rate", "conn_burst", "room_rate", "room_burst")
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> bool:
+        # A rate of 0 means unlimited
+        if not self.rate:
+            return True
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+    def retry_after(self) -> float:
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate else 0.0
+
+
+class IngressLimits:
+    __slots__ = LIMIT_NAMES
+
+    def __init__(self, max_frame_bytes: int = 16384, max_message_chars: int = 2000,
+                 conn_rate: float = 5, conn_burst: float = 10, room_rate: float = 100, room_burst: float = 200):
+        self.max_frame_bytes = max_frame_bytes
+        self.max_message_chars = max_message_chars
+        self.conn_rate = conn_rate
+        self.conn_burst = conn_burst
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+
+    def override(self, **values) -> "IngressLimits":
+        unknown = set(values) - set(LIMIT_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown ingress limits: {', '.join(sorted(unknown))}")
+        return IngressLimits(**{**{name: getattr(self, name) for name in LIMIT_NAMES}, **values})
+
+    def as_dict(self) -> Dict[str, float]:
+        return {name: getattr(self, name) for name in LIMIT_NAMES}
+
+
+# Default limits, per-room overrides and one shared token bucket per room on this worker.
+# Connection buckets belong to the receive loop that uses them.
+class IngressLimiter:
+    def __init__(self, defaults: IngressLimits, overrides: Optional[Dict[str, dict]] = None):
+        self.defaults = defaults
+        self.rooms: Dict[str, IngressLimits] = {
+            room_id: defaults.override(**values) for room_id, values in (overrides or {}).items()
+        }
+        self.room_buckets: Dict[str, TokenBucket] = {}
+
+    def limits_for(self, room_id: Optional[str]) -> IngressLimits:
+        return self.rooms.get(room_id, self.defaults)
+
+    def connection_bucket(self, room_id: Optional[str]) -> TokenBucket:
+        # room_id None (a multiplexed connection) takes the default limits
+        limits = self.limits_for(room_id)
+        return TokenBucket(limits.conn_rate, limits.conn_burst)
+
+    def room_bucket(self, room_id: str) -> TokenBucket:
+        bucket = self.room_buckets.get(room_id)
+        if bucket is None:
+            limits = self.limits_for(room_id)
+            bucket = self.room_buckets[room_id] = TokenBucket(limits.room_rate, limits.room_burst)
+        return bucket
+
+    def forget(self, room_id: str):
+        self.room_buckets.pop(room_id, None)
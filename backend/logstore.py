@@ -0,0 +1,601 @@
+import asyncio
+import base64
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import msgpack
+
+from history import HistoryKey, message_key
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Record: payload length, crc32 of the payload, msgpack payload
+RECORD_HEADER = struct.Struct("<II")
+# Sparse index entry: seq, timestamp (µs since epoch) and offset of a record
+INDEX_ENTRY = struct.Struct("<QqQ")
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def encode_message(doc: dict) -> bytes:
+    payload = {key: value for key, value in doc.items() if key != "_id"}
+    payload["timestamp"] = (doc["timestamp"] - EPOCH) // MICROSECOND
+    payload = msgpack.packb(payload)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_message(payload: bytes) -> dict:
+    doc = msgpack.unpackb(payload)
+    doc["timestamp"] = EPOCH + doc["timestamp"] * MICROSECOND
+    return doc
+
+
+def room_directory(root: str, room_id: str) -> str:
+    # Reversible and filesystem-safe whatever the room id contains
+    return os.path.join(root, base64.urlsafe_b64encode(room_id.encode()).decode().rstrip("="))
+
+
+# One file of a room's log. Segments are preallocated to their capacity and written
+# with pwrite, so the active one stays mapped for reads while it fills; `size` is the
+# end of the last whole record.
+class Segment:
+    def __init__(self, path: str, base_seq: int):
+        self.path = path
+        self.base_seq = base_seq
+        self.size = 0
+        self.capacity = 0
+        self.fd: Optional[int] = None
+        self.map: Optional[mmap.mmap] = None
+        self.index: List[Tuple[int, datetime, int]] = []
+        self.index_file = None
+        self.last: Optional[dict] = None
+
+    @property
+    def index_path(self) -> str:
+        return self.path[:-len(".log")] + ".idx"
+
+    @property
+    def writable(self) -> bool:
+        return self.fd is not None
+
+    def view(self) -> mmap.mmap:
+        if self.map is None:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                self.map = mmap.mmap(fd, self.size, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+        return self.map
+
+    def records(self, start: int, end: int) -> Iterator[Tuple[int, dict]]:
+        view = self.view()
+        offset = start
+        while offset < end:
+            length, _ = RECORD_HEADER.unpack_from(view, offset)
+            body = offset + RECORD_HEADER.size
+            yield offset, decode_message(view[body:body + length])
+            offset = body + length
+
+    def recover(self, index_interval: int):
+        # Keep index entries that still point at an intact record, then rescan the tail
+        # from the last one; a torn final record is cut off
+        file_size = os.path.getsize(self.path)
+        entries = self._read_index()
+        if file_size == 0:
+            self._rewrite_index([])
+            return
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            view = mmap.mmap(fd, file_size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        try:
+            while entries and self._record_at(view, entries[-1][2], file_size) is None:
+                entries.pop()
+            offset = entries.pop()[2] if entries else 0
+            self.index = entries
+            while True:
+                found = self._record_at(view, offset, file_size)
+                if found is None:
+                    break
+                doc, end = found
+                self._observe(doc, offset, index_interval)
+                offset = end
+            self.size = offset
+        finally:
+            view.close()
+        self._rewrite_index(self.index)
+
+    def _record_at(self, view: mmap.mmap, offset: int, limit: int) -> Optional[Tuple[dict, int]]:
+        if offset + RECORD_HEADER.size > limit:
+            return None
+        length, crc = RECORD_HEADER.unpack_from(view, offset)
+        body = offset + RECORD_HEADER.size
+        if length == 0 or body + length > limit:
+            return None
+        payload = view[body:body + length]
+        if zlib.crc32(payload) != crc:
+            return None
+        try:
+            return decode_message(payload), body + length
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def _observe(self, doc: dict, offset: int, index_interval: int):
+        self.last = doc
+        if not self.index or offset - self.index[-1][2] >= index_interval:
+            self.index.append((doc["seq"], doc["timestamp"], offset))
+
+    def _read_index(self) -> List[Tuple[int, datetime, int]]:
+        try:
+            with open(self.index_path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return []
+        usable = len(raw) - len(raw) % INDEX_ENTRY.size
+        return [(seq, EPOCH + micros * MICROSECOND, offset)
+                for seq, micros, offset in INDEX_ENTRY.iter_unpack(raw[:usable])]
+
+    def _rewrite_index(self, entries: List[Tuple[int, datetime, int]]):
+        with open(self.index_path, "wb") as f:
+            f.write(b"".join(self._pack_entry(entry) for entry in entries))
+
+    @staticmethod
+    def _pack_entry(entry: Tuple[int, datetime, int]) -> bytes:
+        seq, timestamp, offset = entry
+        return INDEX_ENTRY.pack(seq, (timestamp - EPOCH) // MICROSECOND, offset)
+
+    def open_active(self, capacity: int):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        # Zero anything past the last whole record before reusing the space
+        os.ftruncate(self.fd, self.size)
+        self.capacity = max(capacity, self.size)
+        os.ftruncate(self.fd, self.capacity)
+        self.map = mmap.mmap(self.fd, self.capacity, access=mmap.ACCESS_READ)
+        self.index_file = open(self.index_path, "ab")
+
+    def write(self, data: bytes, entries: List[Tuple[int, datetime, int]]):
+        written = os.pwrite(self.fd, data, self.size)
+        if written != len(data):
+            raise OSError(f"Short write to {self.path}")
+        self.size += len(data)
+        if entries:
+            self.index.extend(entries)
+            self.index_file.write(b"".join(self._pack_entry(entry) for entry in entries))
+            self.index_file.flush()
+
+    def seal(self):
+        # Trim the preallocated tail; the file is remapped read-only at its final size on the next read
+        self.map.close()
+        self.map = None
+        os.ftruncate(self.fd, self.size)
+        os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        self.index_file.close()
+        self.index_file = None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+
+# A room's messages as a list of segments, appended in seq order. The sparse index
+# (first seq, timestamp and offset of every block of ~index_interval bytes) is kept
+# flat across segments so seq and cursor lookups are one bisect plus a short scan.
+# Timestamps are only used to expire whole segments.
+class RoomLog:
+    def __init__(self, directory: str, segment_bytes: int, index_interval: int):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.segments: List[Segment] = []
+        self.block_seqs: List[int] = []
+        self.block_times: List[datetime] = []
+        self.blocks: List[Tuple[Segment, int]] = []
+        self.last_seq = 0
+        # The latest batch appended and how many of its docs are stored, so a retry of it
+        # (after a failure here or in another room of the same batch) picks up from there
+        self.batch_id: Optional[int] = None
+        self.batch_stored = 0
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".log"))
+        for name in names:
+            segment = Segment(os.path.join(self.directory, name), int(name[:-len(".log")]))
+            segment.recover(self.index_interval)
+            self.segments.append(segment)
+        # Segments left empty by a crash right after a roll carry nothing worth keeping
+        for segment in self.segments[:-1]:
+            if segment.size == 0:
+                os.remove(segment.path)
+                os.remove(segment.index_path)
+        self.segments = [s for s in self.segments[:-1] if s.size] + self.segments[-1:]
+        for segment in self.segments[:-1]:
+            if os.path.getsize(segment.path) > segment.size:
+                os.truncate(segment.path, segment.size)
+        for segment in self.segments:
+            self._add_blocks(segment, segment.index)
+            if segment.last is not None:
+                self.last_seq = segment.last["seq"]
+        if self.segments:
+            self.segments[-1].open_active(self.segment_bytes)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+    def _add_blocks(self, segment: Segment, entries: List[Tuple[int, datetime, int]]):
+        for seq, timestamp, offset in entries:
+            self.block_seqs.append(seq)
+            self.block_times.append(timestamp)
+            self.blocks.append((segment, offset))
+
+    def _roll(self, base_seq: int, min_capacity: int) -> Segment:
+        if self.segments:
+            self.segments[-1].seal()
+        segment = Segment(os.path.join(self.directory, f"{base_seq:020d}.log"), base_seq)
+        segment.open_active(max(self.segment_bytes, min_capacity))
+        self.segments.append(segment)
+        return segment
+
+    def append(self, docs: List[dict], batch_id: Optional[int] = None) -> Optional[Segment]:
+        # Returns the segment written to last, for the caller to fsync. A retry of the
+        # latest batch skips the docs already stored from it.
+        if batch_id is None or batch_id != self.batch_id:
+            self.batch_id = batch_id
+            self.batch_stored = 0
+        docs = docs[self.batch_stored:]
+        segment = self.segments[-1] if self.segments else None
+        indexed_at = segment.index[-1][2] if segment is not None and segment.index else None
+        chunk = bytearray()
+        entries: List[Tuple[int, datetime, int]] = []
+        pending = 0
+        touched = None
+
+        for doc in docs:
+            record = encode_message(doc)
+            if segment is None or segment.size + len(chunk) + len(record) > segment.capacity:
+                if chunk:
+                    self._write(segment, chunk, entries, pending)
+                    chunk, entries, pending = bytearray(), [], 0
+                segment = self._roll(doc["seq"], len(record))
+                indexed_at = None
+            offset = segment.size + len(chunk)
+            if indexed_at is None or offset - indexed_at >= self.index_interval:
+                entries.append((doc["seq"], doc["timestamp"], offset))
+                indexed_at = offset
+            chunk += record
+            pending += 1
+            touched = segment
+
+        if chunk:
+            self._write(segment, chunk, entries, pending)
+        if docs:
+            self.last_seq = max(self.last_seq, max(doc["seq"] for doc in docs))
+        return touched
+
+    def _write(self, segment: Segment, chunk: bytearray, entries: List[Tuple[int, datetime, int]], count: int):
+        segment.write(bytes(chunk), entries)
+        self._add_blocks(segment, entries)
+        self.batch_stored += count
+
+    def expire(self, older_than: datetime) -> List[Segment]:
+        # Detaches the sealed segments holding nothing newer than older_than, oldest first.
+        # A segment's messages are no newer than the first one of the next segment, which
+        # is always indexed. The newest segment stays so last_seq survives a restart.
+        expired: List[Segment] = []
+        while len(self.segments) > 1:
+            following = 0
+            while following < len(self.blocks) and self.blocks[following][0] is self.segments[0]:
+                following += 1
+            # The newest segment may be empty after a crash right after a roll, leaving
+            # nothing to date the one before it by
+            if following == len(self.blocks) or self.block_times[following] >= older_than:
+                break
+            expired.append(self.segments.pop(0))
+            del self.block_seqs[:following]
+            del self.block_times[:following]
+            del self.blocks[:following]
+        return expired
+
+    def _block_records(self, block: int) -> Iterator[dict]:
+        segment, start = self.blocks[block]
+        following = block + 1
+        if following < len(self.blocks) and self.blocks[following][0] is segment:
+            end = self.blocks[following][1]
+        else:
+            end = segment.size
+        for _, doc in segment.records(start, end):
+            yield doc
+
+    def by_seq(self, first_seq: int, end_seq: int, limit: int) -> List[dict]:
+        block = max(0, bisect_right(self.block_seqs, first_seq) - 1)
+        found: List[dict] = []
+        while block < len(self.blocks) and len(found) < limit and self.block_seqs[block] < end_seq:
+            found.extend(m for m in self._block_records(block) if first_seq <= m["seq"] < end_seq)
+            block += 1
+        return found[:limit]
+
+    def after(self, position: HistoryKey, limit: int) -> List[dict]:
+        block = max(0, bisect_right(self.block_seqs, position) - 1)
+        found: List[dict] = []
+        while block < len(self.blocks) and len(found) < limit:
+            found.extend(m for m in self._block_records(block) if message_key(m) > position)
+            block += 1
+        return found[:limit]
+
+    def before(self, position: Optional[HistoryKey], limit: int) -> List[dict]:
+        # Walks blocks backwards from the cursor (or the end) until the page is full
+        block = len(self.blocks) if position is None else bisect_left(self.block_seqs, position)
+        chunks: List[List[dict]] = []
+        count = 0
+        while block > 0 and count < limit:
+            block -= 1
+            chunk = [m for m in self._block_records(block) if position is None or message_key(m) < position]
+            chunks.append(chunk)
+            count += len(chunk)
+        found = [m for chunk in reversed(chunks) for m in chunk]
+        return found[-limit:]
+
+
+# Small grouped table of forward-only counters (group -> name -> value) kept as JSON lines
+# of [group, name, value]. The highest value wins on load, and a file that is mostly
+# superseded lines is rewritten compactly when it is opened.
+class CounterTable:
+    def __init__(self, path: str):
+        self.path = path
+        self.values: Dict[str, Dict[str, int]] = {}
+        self._file = None
+
+    def open(self):
+        lines = 0
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        group, name, value = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash mid-write
+                        continue
+                    lines += 1
+                    names = self.values.setdefault(group, {})
+                    if value > names.get(name, 0):
+                        names[name] = value
+        live = sum(map(len, self.values.values()))
+        if lines > 2 * live + 1000:
+            with open(self.path + ".tmp", "w") as f:
+                for group, names in self.values.items():
+                    f.writelines(json.dumps([group, name, value]) + "\n" for name, value in names.items())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.path + ".tmp", self.path)
+        self._file = open(self.path, "a")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def update(self, items: List[Tuple[str, str, int]]):
+        lines = []
+        for group, name, value in items:
+            names = self.values.setdefault(group, {})
+            if value > names.get(name, 0):
+                names[name] = value
+                lines.append(json.dumps([group, name, value]) + "\n")
+        if lines:
+            self._file.writelines(lines)
+            self._file.flush()
+            await asyncio.to_thread(os.fsync, self._file.fileno())
+
+
+# Embedded storage for single-process deployments: one append-only log per room under
+# `path`, plus a JSON-lines room catalog. Appends from one MessageWriter batch are
+# fsynced together (group commit); with fsync_interval > 0 they are synced in the
+# background instead and a crash can lose that much. The directory is locked, so only
+# one process may use it at a time.
+class LogStorage(Storage):
+    def __init__(self, path: str, segment_bytes: int = 8 * 1024 * 1024, index_interval: int = 4096,
+                 fsync_interval: float = 0.0, max_open_rooms: int = 1024):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.fsync_interval = fsync_interval
+        self.max_open_rooms = max_open_rooms
+        self.rooms: Dict[str, dict] = {}
+        self.logs: "OrderedDict[str, RoomLog]" = OrderedDict()
+        self.dirty: Set[Segment] = set()
+        self._catalog = None
+        self._lock_file = None
+        self.markers = CounterTable(os.path.join(path, "read_markers.jsonl"))
+        # Room heads all live in one group
+        self.heads = CounterTable(os.path.join(path, "room_heads.jsonl"))
+        self._sync_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        os.makedirs(os.path.join(self.path, "messages"), exist_ok=True)
+        self._lock_file = open(os.path.join(self.path, "LOCK"), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError(f"Storage directory {self.path} is in use by another process")
+
+        catalog_path = os.path.join(self.path, "rooms.jsonl")
+        if os.path.exists(catalog_path):
+            with open(catalog_path) as f:
+                for line in f:
+                    try:
+                        room = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash mid-write
+                        continue
+                    room["created_at"] = datetime.fromisoformat(room["created_at"])
+                    self.rooms[room["id"]] = room
+        self._catalog = open(catalog_path, "a")
+        self.markers.open()
+        self.heads.open()
+
+        if self.fsync_interval > 0:
+            self._sync_task = asyncio.create_task(self._sync_periodically())
+
+    async def close(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+        for log in self.logs.values():
+            log.close()
+        self.logs.clear()
+        self.dirty.clear()
+        if self._catalog is not None:
+            self._catalog.close()
+            self._catalog = None
+        self.markers.close()
+        self.heads.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _log(self, room_id: str, create: bool = False) -> Optional[RoomLog]:
+        log = self.logs.get(room_id)
+        if log is not None:
+            self.logs.move_to_end(room_id)
+            return log
+        directory = room_directory(os.path.join(self.path, "messages"), room_id)
+        if not create and not os.path.isdir(directory):
+            return None
+        log = self.logs[room_id] = RoomLog(directory, self.segment_bytes, self.index_interval)
+        log.open()
+        # Least recently used logs give back their file descriptors and mappings
+        while len(self.logs) > self.max_open_rooms:
+            _, evicted = self.logs.popitem(last=False)
+            self.dirty.difference_update(evicted.segments)
+            evicted.close()
+        return log
+
+    async def insert_room(self, room: dict):
+        self._catalog.write(json.dumps({**room, "created_at": room["created_at"].isoformat()}) + "\n")
+        self._catalog.flush()
+        await asyncio.to_thread(os.fsync, self._catalog.fileno())
+        self.rooms[room["id"]] = dict(room)
+
+    async def find_room_by_name(self, name: str) -> Optional[dict]:
+        for room in self.rooms.values():
+            if room["name"] == name:
+                return dict(room)
+        return None
+
+    async def list_rooms(self, limit: Optional[int] = None) -> List[dict]:
+        return [dict(room) for room in list(self.rooms.values())[:limit]]
+
+    async def append_messages(self, docs: List[dict], batch_id: Optional[int] = None):
+        by_room: Dict[str, List[dict]] = {}
+        for doc in docs:
+            by_room.setdefault(doc["room_id"], []).append(doc)
+        for room_id, room_docs in by_room.items():
+            touched = self._log(room_id, create=True).append(room_docs, batch_id)
+            if touched is not None:
+                self.dirty.add(touched)
+        if self.fsync_interval <= 0:
+            await self._sync()
+
+    async def _sync(self):
+        # One fsync per touched file for the whole batch, off the event loop. The
+        # descriptors are duplicated so a log closed meanwhile cannot pull them away.
+        fds = [os.dup(segment.fd) for segment in self.dirty if segment.writable]
+        self.dirty.clear()
+        if fds:
+            await asyncio.to_thread(self._fsync_all, fds)
+
+    @staticmethod
+    def _fsync_all(fds: List[int]):
+        try:
+            for fd in fds:
+                os.fdatasync(fd)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    async def _sync_periodically(self):
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            try:
+                await self._sync()
+            except OSError as e:
+                logger.error("Log storage fsync failed: %s", e)
+
+    async def last_seq(self, room_id: str) -> int:
+        log = self._log(room_id)
+        return log.last_seq if log is not None else 0
+
+    async def read_messages(self, room_id: str, limit: int,
+                            before: Optional[HistoryKey] = None, after: Optional[HistoryKey] = None) -> List[dict]:
+        log = self._log(room_id)
+        if log is None:
+            return []
+        if after is not None:
+            return log.after(after, limit)
+        return log.before(before, limit)
+
+    async def messages_by_seq(self, room_id: str, first_seq: int, end_seq: int, limit: int) -> List[dict]:
+        log = self._log(room_id)
+        return log.by_seq(first_seq, end_seq, limit) if log is not None else []
+
+    async def save_read_markers(self, markers: List[Tuple[str, str, int]]):
+        await self.markers.update(markers)
+
+    async def read_markers(self, user_id: str) -> Dict[str, int]:
+        return dict(self.markers.values.get(user_id, {}))
+
+    async def save_room_heads(self, heads: Dict[str, int]):
+        await self.heads.update([("", room_id, seq) for room_id, seq in heads.items()])
+
+    async def room_heads(self) -> Dict[str, int]:
+        return dict(self.heads.values.get("", {}))
+
+    async def expire_messages(self, room_id: str, older_than: datetime) -> Tuple[int, int]:
+        # Whole segments only, so retention here is as coarse as LOG_SEGMENT_BYTES. The count
+        # is the seq span removed, which is exact unless messages were dropped before storage.
+        log = self._log(room_id)
+        if log is None:
+            return 0, 0
+        expired = log.expire(older_than)
+        if not expired:
+            return 0, 0
+        for segment in expired:
+            segment.close()
+            self.dirty.discard(segment)
+        await asyncio.to_thread(self._remove_segments, expired)
+        end_seq = log.segments[0].base_seq
+        return end_seq - expired[0].base_seq, end_seq
+
+    @staticmethod
+    def _remove_segments(segments: List[Segment]):
+        for segment in segments:
+            os.remove(segment.path)
+            os.remove(segment.index_path)
@@ -0,0 +1,196 @@
+import asyncio
+import os
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Instruments are plain dict/list updates (no locks: everything runs on one event loop).
+# Overhead budget: under 1µs per inc/observe and under 3% of broadcast_to_room CPU at
+# 100 recipients; metrics_benchmark.py checks both.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Registry:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.metrics: List["Metric"] = []
+
+    def register(self, metric: "Metric") -> "Metric":
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry(enabled=os.environ.get('METRICS_ENABLED', 'true').lower() != 'false')
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), registry: Registry = registry):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        registry.register(self)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, labels: Labels = ()):
+        if self.registry.enabled:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, collect: Optional[Callable[[], Dict[Labels, float]]] = None, **kwargs):
+        # With collect, values are computed at scrape time and nothing runs on the hot path
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Labels, float] = {}
+        self.collect = collect
+
+    def set(self, value: float, labels: Labels = ()):
+        if self.registry.enabled:
+            self.values[labels] = value
+
+    def samples(self) -> Iterable[str]:
+        values = self.collect() if self.collect is not None else self.values
+        for labels, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS,
+                 collect: Optional[Callable[[], Dict[Labels, Iterable[float]]]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count], sum
+        self.counts: Dict[Labels, List[int]] = {}
+        self.sums: Dict[Labels, float] = {}
+        self.collect = collect
+
+    def observe(self, value: float, labels: Labels = ()):
+        if not self.registry.enabled:
+            return
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def time(self, labels: Labels = ()) -> "Timer":
+        return Timer(self, labels)
+
+    def _snapshot(self) -> Tuple[Dict[Labels, List[int]], Dict[Labels, float]]:
+        if self.collect is None:
+            return self.counts, self.sums
+        counts: Dict[Labels, List[int]] = {}
+        sums: Dict[Labels, float] = {}
+        for labels, values in self.collect().items():
+            bucket_counts = counts[labels] = [0] * (len(self.buckets) + 1)
+            total = 0.0
+            for value in values:
+                bucket_counts[bisect_left(self.buckets, value)] += 1
+                total += value
+            sums[labels] = total
+        return counts, sums
+
+    def samples(self) -> Iterable[str]:
+        counts, sums = self._snapshot()
+        for labels, bucket_counts in counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(sums[labels])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: Histogram, labels: Labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+# Sleeps for a fixed interval and records how late the loop woke it up
+class LoopLagSampler:
+    def __init__(self, histogram: Histogram, gauge: Gauge, interval: float = 0.5):
+        self.histogram = histogram
+        self.gauge = gauge
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None and self.histogram.registry.enabled:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.histogram.observe(lag)
+            self.gauge.set(lag)
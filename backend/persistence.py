@@ -0,0 +1,148 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple
+
+from metrics import SIZE_BUCKETS, Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+batch_size_histogram = Histogram("chat_persist_batch_size", "Documents per storage append batch", buckets=SIZE_BUCKETS)
+insert_seconds = Histogram("chat_persist_insert_seconds", "Storage append latency, including retries")
+retries_total = Counter("chat_persist_retries_total", "Failed storage appends that were retried")
+dropped_total = Counter("chat_persist_dropped_total", "Chat messages dropped after exhausting retries")
+
+
+# Write-behind buffer for chat messages, appended to storage in batches by size or by time.
+# on_persisted is called with each batch once storage has it.
+class MessageWriter:
+    def __init__(self, storage, batch_size: int = 500, flush_interval: float = 0.05,
+                 max_buffer: int = 10000, max_retries: int = 5, retry_backoff: float = 0.1,
+                 on_persisted: Optional[Callable[[List[dict]], None]] = None):
+        self.storage = storage
+        self.on_persisted = on_persisted
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.buffer: Deque[Tuple[dict, Optional[asyncio.Future]]] = deque()
+        # Producers held back while the buffer is full, in arrival order: (doc, future, admitted)
+        self._waiting: Deque[Tuple[dict, Optional[asyncio.Future], asyncio.Future]] = deque()
+        self._batch_ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        # Identifies a batch to storage across its retries
+        self._batch_ids = itertools.count(1)
+        # One batch in flight at a time, so batches reach storage in buffer order
+        self._flushing = asyncio.Lock()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def add(self, doc: dict, wait: bool = False):
+        # Producers wait here once the buffer is full, which bounds memory while storage is slow
+        # or down. Waiters are admitted strictly in order, and nobody overtakes them, so docs
+        # reach the buffer (and storage) in the order add() was called.
+        loop = asyncio.get_running_loop()
+        future = loop.create_future() if wait else None
+        if self._waiting or len(self.buffer) >= self.max_buffer:
+            admitted = loop.create_future()
+            entry = (doc, future, admitted)
+            self._waiting.append(entry)
+            try:
+                await admitted
+            except asyncio.CancelledError:
+                # Not admitted yet: the doc never reaches the buffer
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                raise
+        else:
+            self.buffer.append((doc, future))
+        if len(self.buffer) >= self.batch_size:
+            self._batch_ready.set()
+        if future is not None:
+            await future
+
+    def _admit(self):
+        # Moves waiting producers' docs into the buffer as space frees up, oldest first
+        while self._waiting and len(self.buffer) < self.max_buffer:
+            doc, future, admitted = self._waiting.popleft()
+            self.buffer.append((doc, future))
+            admitted.set_result(None)
+
+    async def flush(self):
+        # Appends everything buffered so far; the writer keeps running
+        while self.buffer or self._waiting:
+            await self._flush()
+
+    async def close(self):
+        # Flush everything still buffered, then stop the background task
+        self._closing = True
+        self._batch_ready.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        while self.buffer or self._waiting:
+            await self._flush()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            while self.buffer and not self._closing:
+                await self._flush()
+                if len(self.buffer) < self.batch_size:
+                    break
+
+    async def _flush(self):
+        async with self._flushing:
+            self._admit()
+            if self.buffer:
+                await self._append(self._take_batch())
+
+    def _take_batch(self) -> List[Tuple[dict, Optional[asyncio.Future]]]:
+        return [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+
+    async def _append(self, batch: List[Tuple[dict, Optional[asyncio.Future]]]):
+        self._admit()
+        docs = [doc for doc, _ in batch]
+        batch_size_histogram.observe(len(docs))
+        started = time.perf_counter()
+        batch_id = next(self._batch_ids)
+
+        error: Optional[Exception] = None
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.storage.append_messages(docs, batch_id)
+                error = None
+                break
+            except Exception as e:
+                error = e
+            if attempt < self.max_retries:
+                retries_total.inc()
+                await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+        insert_seconds.observe(time.perf_counter() - started)
+
+        if error is not None:
+            dropped_total.inc(len(docs))
+            logger.error("Dropping %d chat messages after %d retries: %s", len(docs), self.max_retries, error)
+        elif self.on_persisted is not None:
+            try:
+                self.on_persisted(docs)
+            except Exception:
+                logger.exception("on_persisted callback failed")
+
+        for _, future in batch:
+            if future is None or future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
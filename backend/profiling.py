@@ -0,0 +1,161 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from asyncio import events
+from collections import Counter as Tally, deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional
+
+from metrics import Counter
+
+MAX_STACK_DEPTH = 64
+# A coroutine chain is followed this far looking for the room it works on
+MAX_AWAIT_DEPTH = 32
+
+slow_callbacks_total = Counter("chat_slow_callbacks_total", "Event loop callbacks that ran past the tracing threshold")
+
+
+def frame_label(code) -> str:
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame) -> str:
+    # Root first, as flamegraph.pl and speedscope expect
+    labels: List[str] = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.reverse()
+    return ";".join(labels)
+
+
+def sample_stacks(thread_id: Optional[int], seconds: float, interval: float) -> Tally:
+    # Blocking; run in its own thread. thread_id None samples every thread but this one,
+    # each stack under its thread's name.
+    stacks: Tally = Tally()
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frames = sys._current_frames()
+        if thread_id is not None:
+            frame = frames.get(thread_id)
+            if frame is not None:
+                stacks[collapse(frame)] += 1
+        else:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident != me:
+                    stacks[f"{names.get(ident, ident)};{collapse(frame)}"] += 1
+        del frames
+        time.sleep(interval)
+    return stacks
+
+
+# On-demand wall-clock stack sampling. Nothing runs until profile() is called, and only
+# one profile runs at a time; the sampler thread holds the GIL just long enough to walk
+# the stacks every `interval`.
+class StackProfiler:
+    def __init__(self):
+        self.running = False
+
+    async def profile(self, seconds: float, interval: float = 0.01, all_threads: bool = False) -> str:
+        # Collapsed stacks ("frame;frame;frame count" per line), hottest first
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        self.running = True
+        try:
+            loop_thread = None if all_threads else threading.get_ident()
+            stacks = await asyncio.to_thread(sample_stacks, loop_thread, seconds, interval)
+        finally:
+            self.running = False
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def describe_callback(handle: events.Handle) -> Dict[str, Optional[str]]:
+    # The task a loop callback stepped, where its coroutine chain is suspended now, and
+    # the first room_id local found along that chain
+    callback = handle._callback
+    task = getattr(callback, "__self__", None)
+    if not isinstance(task, asyncio.Task):
+        return {"callback": getattr(callback, "__qualname__", repr(callback)), "task": None, "room_id": None, "stack": None}
+
+    labels: List[str] = []
+    room_id = None
+    awaitable = task.get_coro()
+    while awaitable is not None and len(labels) < MAX_AWAIT_DEPTH:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "gi_frame", None)
+        if frame is None:
+            break
+        labels.append(frame_label(frame.f_code))
+        if room_id is None:
+            value = frame.f_locals.get("room_id")
+            if isinstance(value, str):
+                room_id = value
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "gi_yieldfrom", None)
+    coro = task.get_coro()
+    return {
+        "callback": getattr(coro, "__qualname__", repr(coro)),
+        "task": task.get_name(),
+        "room_id": room_id,
+        "stack": ";".join(labels) or None
+    }
+
+
+# Records loop callbacks that run past `threshold` seconds. While enabled, the loop's
+# Handle._run is wrapped with a timer; disable() puts the original back, so tracing
+# costs nothing when off. Only the default asyncio loop runs callbacks through
+# Handle._run, so other loop implementations are refused.
+class SlowCallbackTracer:
+    def __init__(self, max_records: int = 200):
+        self.threshold = 0.0
+        self.records: Deque[dict] = deque(maxlen=max_records)
+        self.enabled_until: Optional[datetime] = None
+        self._original = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._original is not None
+
+    def enable(self, threshold: float, seconds: float):
+        loop = asyncio.get_running_loop()
+        if not isinstance(loop, asyncio.BaseEventLoop):
+            raise RuntimeError(f"Slow-callback tracing needs the default asyncio loop, not {type(loop).__name__}")
+        self.threshold = threshold
+        if self._original is None:
+            self._original = original = events.Handle._run
+            tracer = self
+
+            def _run(handle):
+                started = time.perf_counter()
+                original(handle)
+                elapsed = time.perf_counter() - started
+                if elapsed >= tracer.threshold:
+                    tracer._record(handle, elapsed)
+
+            events.Handle._run = _run
+        # Switches itself off, so a forgotten trace does not stay on
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = loop.call_later(seconds, self.disable)
+        self.enabled_until = datetime.utcfromtimestamp(time.time() + seconds)
+
+    def disable(self):
+        if self._original is not None:
+            events.Handle._run = self._original
+            self._original = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.enabled_until = None
+
+    def _record(self, handle: events.Handle, elapsed: float):
+        slow_callbacks_total.inc()
+        try:
+            details = describe_callback(handle)
+        except Exception as e:
+            details = {"callback": repr(handle), "error": str(e)}
+        self.records.append({"at": datetime.utcnow().isoformat(), "seconds": round(elapsed, 6), **details})
@@ -0,0 +1,201 @@
+import json
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import msgpack
+
+# Offered in Sec-WebSocket-Protocol; clients that offer nothing get JSON text frames
+JSON_PROTOCOL = "chat.json.v1"
+MSGPACK_PROTOCOL = "chat.msgpack.v1"
+SUBPROTOCOLS = (MSGPACK_PROTOCOL, JSON_PROTOCOL)
+
+# First byte of every binary frame
+RAW = b"\x00"
+DEFLATED = b"\x01"
+
+# Short keys for the binary encoding; anything not listed keeps its name
+SHORT_KEYS = {
+    "type": "t",
+    "id": "i",
+    "seq": "s",
+    "message": "m",
+    "timestamp": "ts",
+    "user_count": "c",
+    "events": "e",
+    "joined": "j",
+    "left": "l",
+    "users": "us",
+    "room_id": "r",
+}
+LONG_KEYS = {short: key for key, short in SHORT_KEYS.items()}
+
+
+def negotiate(offered: List[str]) -> Optional[str]:
+    for protocol in offered:
+        if protocol in SUBPROTOCOLS:
+            return protocol
+    return None
+
+
+def epoch_ms(timestamp: str) -> int:
+    # Server timestamps are naive UTC isoformat strings
+    return int(datetime.fromisoformat(timestamp).replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+# Ref -> (user_id, username) for the refs a frame uses
+RefTable = Dict[int, Tuple[str, str]]
+
+
+# Process-wide user_id -> small int, so binary frames carry a ref instead of two strings.
+# Users with a connection open are held (acquire/release) and keep their ref; everyone else
+# (history authors, users who just left) stays in a small LRU. Refs are never reused, and
+# frames carry the definitions of the refs they use, so dropping an entry is always safe:
+# the user just gets a new ref next time.
+class UserRefs:
+    def __init__(self, max_idle: int = 10000):
+        self.max_idle = max_idle
+        self.held: Dict[str, Tuple[int, str]] = {}
+        self.holders: Dict[str, int] = {}
+        self.idle: "OrderedDict[str, Tuple[int, str]]" = OrderedDict()
+        self._next_ref = 1
+
+    def __len__(self) -> int:
+        return len(self.held) + len(self.idle)
+
+    def intern(self, user_id: str, username: str) -> int:
+        table = self.held if user_id in self.held else self.idle
+        entry = table.get(user_id)
+        if entry is None or entry[1] != username:
+            entry = table[user_id] = self._new(username)
+        if table is self.idle:
+            self.idle.move_to_end(user_id)
+            self._trim()
+        return entry[0]
+
+    def acquire(self, user_id: str, username: str):
+        count = self.holders.get(user_id, 0)
+        self.holders[user_id] = count + 1
+        if not count:
+            entry = self.idle.pop(user_id, None)
+            self.held[user_id] = entry if entry is not None and entry[1] == username else self._new(username)
+        else:
+            self.intern(user_id, username)
+
+    def release(self, user_id: str):
+        count = self.holders.pop(user_id, 0) - 1
+        if count > 0:
+            self.holders[user_id] = count
+            return
+        entry = self.held.pop(user_id, None)
+        if entry is not None:
+            self.idle[user_id] = entry
+            self._trim()
+
+    def _new(self, username: str) -> Tuple[int, str]:
+        ref = self._next_ref
+        self._next_ref += 1
+        return ref, username
+
+    def _trim(self):
+        while len(self.idle) > self.max_idle:
+            self.idle.popitem(last=False)
+
+
+def ref_definitions(refs: RefTable) -> bytes:
+    # Sent to a connection before the first frame that uses refs it has not seen
+    table = [[ref, *refs[ref]] for ref in sorted(refs)]
+    return RAW + msgpack.packb({"t": "users", "d": table})
+
+
+user_refs = UserRefs()
+
+
+def compact_event(event: dict, refs: RefTable) -> dict:
+    out = {}
+    for key, value in event.items():
+        if key == "username" and "user_id" in event:
+            continue
+        if key == "user_id":
+            username = event.get("username", "")
+            ref = user_refs.intern(value, username)
+            refs[ref] = (value, username)
+            out["u"] = ref
+        elif key == "timestamp" and isinstance(value, str):
+            out["ts"] = epoch_ms(value)
+        elif key == "events":
+            out["e"] = [compact_event(e, refs) for e in value]
+        elif key in ("joined", "left", "users"):
+            members = []
+            for user_id, username in value:
+                ref = user_refs.intern(user_id, username)
+                refs[ref] = (user_id, username)
+                members.append(ref)
+            out[SHORT_KEYS[key]] = members
+        else:
+            out[SHORT_KEYS.get(key, key)] = value
+    return out
+
+
+# One outbound event, encoded lazily and at most once per wire format however many
+# connections it goes to
+class Frame:
+    __slots__ = ("message", "_text", "_packed", "_deflated", "refs")
+
+    def __init__(self, message: Optional[dict] = None, text: Optional[str] = None):
+        self.message = message
+        self._text = text
+        self._packed: Optional[bytes] = None
+        self._deflated: Dict[int, bytes] = {}
+        self.refs: RefTable = {}
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = json.dumps(self.message, separators=(',', ':'), ensure_ascii=False)
+        return self._text
+
+    @property
+    def packed(self) -> bytes:
+        if self._packed is None:
+            message = self.message if self.message is not None else json.loads(self._text)
+            self._packed = msgpack.packb(compact_event(message, self.refs))
+        return self._packed
+
+    def binary(self, deflate_level: int = 0, min_size: int = 256) -> bytes:
+        packed = self.packed
+        if not deflate_level or len(packed) < min_size:
+            return RAW + packed
+        deflated = self._deflated.get(deflate_level)
+        if deflated is None:
+            compressor = zlib.compressobj(deflate_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            deflated = self._deflated[deflate_level] = DEFLATED + compressor.compress(packed) + compressor.flush()
+        return deflated
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+def decode_client_frame(data: bytes, max_size: int = 0) -> dict:
+    # Inbound binary frames are plain msgpack maps; short keys are accepted too.
+    # Anything undecodable raises ValueError, and a deflated frame that would inflate past
+    # max_size (0 for no limit) raises FrameTooLarge without inflating the rest.
+    payload = data[1:] if data[:1] in (RAW, DEFLATED) else data
+    try:
+        if data[:1] == DEFLATED:
+            inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            payload = inflater.decompress(payload, max_size)
+            if inflater.unconsumed_tail:
+                raise FrameTooLarge(f"Frame inflates past {max_size} bytes")
+            if not inflater.eof:
+                raise ValueError("Truncated deflate stream")
+        message = msgpack.unpackb(payload)
+    except FrameTooLarge:
+        raise
+    except (zlib.error, msgpack.UnpackException, ValueError) as e:
+        raise ValueError(f"Undecodable frame: {e}") from e
+    if not isinstance(message, dict):
+        raise ValueError("Frame is not a map")
+    return {LONG_KEYS.get(key, key): value for key, value in message.items()}
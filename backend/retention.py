@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, Optional
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+POLICY_NAMES = ("ttl_s", "hot_count", "hot_age_s")
+
+archived_total = Counter("chat_retention_archived_total", "Chat messages moved from hot storage into archive buckets")
+expired_total = Counter("chat_retention_expired_total", "Chat messages deleted by TTL")
+run_seconds = Histogram("chat_retention_run_seconds", "Duration of one retention pass over every room")
+
+
+# How long a room keeps its history (ttl_s) and how much of it stays hot: at most hot_count
+# messages no older than hot_age_s, the rest moving into archive buckets. 0 turns a limit off.
+class RetentionPolicy:
+    __slots__ = POLICY_NAMES
+
+    def __init__(self, ttl_s: float = 0, hot_count: int = 0, hot_age_s: float = 0):
+        self.ttl_s = ttl_s
+        self.hot_count = hot_count
+        self.hot_age_s = hot_age_s
+
+    def override(self, **values) -> "RetentionPolicy":
+        unknown = set(values) - set(POLICY_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown retention settings: {', '.join(sorted(unknown))}")
+        return RetentionPolicy(**{**{name: getattr(self, name) for name in POLICY_NAMES}, **values})
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.ttl_s or self.hot_count or self.hot_age_s)
+
+
+# Background pass over every room every `interval`: archive in batches of `batch`
+# messages, yielding between them, then expire. on_expired(room_id, end_seq) is told
+# that nothing below end_seq is left.
+class RetentionJob:
+    def __init__(self, storage, rooms: Callable[[], Iterable[str]], defaults: RetentionPolicy,
+                 overrides: Optional[Dict[str, dict]] = None, bucket_seconds: float = 3600,
+                 interval: float = 300, batch: int = 1000,
+                 on_expired: Optional[Callable[[str, int], None]] = None):
+        self.storage = storage
+        self.rooms = rooms
+        self.defaults = defaults
+        self.policies: Dict[str, RetentionPolicy] = {
+            room_id: defaults.override(**values) for room_id, values in (overrides or {}).items()
+        }
+        self.bucket_seconds = bucket_seconds
+        self.interval = interval
+        self.batch = batch
+        self.on_expired = on_expired
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.defaults.enabled or any(policy.enabled for policy in self.policies.values())
+
+    def policy_for(self, room_id: str) -> RetentionPolicy:
+        return self.policies.get(room_id, self.defaults)
+
+    def start(self):
+        if self._task is None and self.enabled and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            started = time.perf_counter()
+            await self.run_once()
+            run_seconds.observe(time.perf_counter() - started)
+
+    async def run_once(self):
+        for room_id in list(self.rooms()):
+            policy = self.policy_for(room_id)
+            if not policy.enabled:
+                continue
+            try:
+                await self.apply(room_id, policy, datetime.utcnow())
+            except Exception as e:
+                # The next pass picks up where this one stopped
+                logger.error("Retention failed for room %s: %s", room_id, e)
+
+    async def apply(self, room_id: str, policy: RetentionPolicy, now: datetime):
+        if policy.hot_count or policy.hot_age_s:
+            end_seq = await self.storage.last_seq(room_id) - policy.hot_count + 1 if policy.hot_count else 0
+            older_than = now - timedelta(seconds=policy.hot_age_s) if policy.hot_age_s else None
+            while True:
+                moved = await self.storage.archive_messages(room_id, end_seq, older_than, self.bucket_seconds, self.batch)
+                archived_total.inc(moved)
+                if moved < self.batch:
+                    break
+                await asyncio.sleep(0)
+
+        if policy.ttl_s:
+            expired, end_seq = await self.storage.expire_messages(room_id, now - timedelta(seconds=policy.ttl_s))
+            if expired:
+                expired_total.inc(expired)
+                logger.info("Expired %d messages from room %s", expired, room_id)
+            if end_seq and self.on_expired is not None:
+                self.on_expired(room_id, end_seq)
@@ -0,0 +1,325 @@
+import asyncio
+import logging
+import os
+import re
+import time
+import zlib
+from array import array
+from bisect import bisect_left, insort
+from heapq import merge
+from itertools import accumulate, chain
+from operator import sub
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import msgpack
+
+from logstore import room_directory
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+TOKEN = re.compile(r"\w+")
+MAX_TERM_CHARS = 32
+# A short prefix only expands to this many terms (in term order)
+MAX_PREFIX_TERMS = 512
+SNAPSHOT_VERSION = 1
+# Seqs below the newest indexed that rooms other processes persist to are read again
+REREAD_SEQS = 64
+
+search_seconds = Histogram("chat_search_seconds", "Search query latency, including index catch-up")
+
+
+def tokenize(text: str) -> List[str]:
+    return [term for term in TOKEN.findall(text.casefold()) if len(term) <= MAX_TERM_CHARS]
+
+
+def pack_postings(postings: array) -> bytes:
+    # Ascending seqs stored as gaps, which zlib squeezes well
+    return array("I", map(sub, postings, chain((0,), postings))).tobytes()
+
+
+def unpack_postings(data: bytes) -> array:
+    gaps = array("I")
+    gaps.frombytes(data)
+    return array("I", accumulate(gaps))
+
+
+def descending(postings: array, before: Optional[int]) -> Iterator[int]:
+    i = bisect_left(postings, before) if before is not None else len(postings)
+    while i:
+        i -= 1
+        yield postings[i]
+
+
+def contains(lists: List[array], seq: int) -> bool:
+    for postings in lists:
+        i = bisect_left(postings, seq)
+        if i < len(postings) and postings[i] == seq:
+            return True
+    return False
+
+
+# One room's inverted index: term -> ascending array of message seqs, plus the sorted
+# term list for prefix lookups. Messages normally arrive in seq order and are appended;
+# anything older is inserted in place.
+class RoomIndex:
+    __slots__ = ("postings", "terms", "last_seq", "ready", "catching_up", "pending", "dirty")
+
+    def __init__(self):
+        self.postings: Dict[str, array] = {}
+        self.terms: List[str] = []
+        self.last_seq = 0
+        # While the room catches up with storage, live messages wait in `pending`
+        self.ready = False
+        self.catching_up = False
+        self.pending: List[dict] = []
+        self.dirty = False
+
+    def add(self, seq: int, text: str):
+        in_order = seq > self.last_seq
+        for term in set(tokenize(text)):
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array("I")
+                insort(self.terms, term)
+            if in_order:
+                postings.append(seq)
+            else:
+                i = bisect_left(postings, seq)
+                if i < len(postings) and postings[i] == seq:
+                    continue
+                postings.insert(i, seq)
+        self.last_seq = max(self.last_seq, seq)
+        self.dirty = True
+
+    def expire(self, end_seq: int):
+        # Drops every posting below end_seq, and terms left with none
+        emptied = False
+        for term, postings in list(self.postings.items()):
+            i = bisect_left(postings, end_seq)
+            if i == len(postings):
+                del self.postings[term]
+                emptied = True
+            elif i:
+                del postings[:i]
+        if emptied:
+            self.terms = sorted(self.postings)
+        self.dirty = True
+
+    def _lists(self, term: str, prefix: bool) -> List[array]:
+        if not prefix:
+            postings = self.postings.get(term)
+            return [postings] if postings else []
+        lists = []
+        i = bisect_left(self.terms, term)
+        while i < len(self.terms) and len(lists) < MAX_PREFIX_TERMS and self.terms[i].startswith(term):
+            lists.append(self.postings[self.terms[i]])
+            i += 1
+        return lists
+
+    def search(self, terms: List[str], before: Optional[int], limit: int) -> List[int]:
+        # Seqs of messages holding every term (the last one as a prefix), newest first.
+        # Candidates come from the rarest term and are checked against the others.
+        lists = [self._lists(term, i == len(terms) - 1) for i, term in enumerate(terms)]
+        if not lists or not all(lists):
+            return []
+        lists.sort(key=lambda postings: sum(map(len, postings)))
+        driver, others = lists[0], lists[1:]
+        if len(driver) == 1:
+            candidates = descending(driver[0], before)
+        else:
+            candidates = merge(*(descending(postings, before) for postings in driver), reverse=True)
+
+        found: List[int] = []
+        previous = None
+        for seq in candidates:
+            if seq == previous:
+                continue
+            previous = seq
+            if all(contains(postings, seq) for postings in others):
+                found.append(seq)
+                if len(found) == limit:
+                    break
+        return found
+
+    def snapshot(self) -> Tuple[int, Dict[str, array]]:
+        # Copies, so the snapshot can be encoded off the event loop while the index keeps changing
+        return self.last_seq, {term: array("I", postings) for term, postings in self.postings.items()}
+
+    @classmethod
+    def restore(cls, last_seq: int, postings: Dict[str, array]) -> "RoomIndex":
+        index = cls()
+        index.last_seq = last_seq
+        index.postings = postings
+        index.terms = sorted(postings)
+        return index
+
+
+# Per-room full-text indexes over chat history. The write-behind flush feeds persisted
+# messages in; a room first catches up from storage (anything after its snapshot) under
+# a lock, so indexes always match what storage holds. Rooms that are not `complete` (other
+# processes persist messages to them too) catch up again before every search. Dirty rooms
+# are snapshotted to `path` every snapshot_interval and on close, and all snapshots are
+# loaded on start.
+class SearchIndex:
+    def __init__(self, storage, path: str, snapshot_interval: float = 60.0, catch_up_batch: int = 5000,
+                 complete: Callable[[str], bool] = lambda room_id: True):
+        self.storage = storage
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        self.catch_up_batch = catch_up_batch
+        self.complete = complete
+        self.rooms: Dict[str, RoomIndex] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.rooms.update(await asyncio.to_thread(self._load_snapshots))
+        if self.rooms:
+            logger.info("Loaded search indexes for %d rooms", len(self.rooms))
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.save()
+
+    def add_messages(self, docs: List[dict]):
+        for doc in docs:
+            index = self.rooms.get(doc["room_id"])
+            if index is None:
+                # Not searched yet; catching up will read it from storage
+                continue
+            if index.ready:
+                index.add(doc["seq"], doc["message"])
+            elif index.catching_up:
+                index.pending.append(doc)
+
+    def expire(self, room_id: str, end_seq: int):
+        index = self.rooms.get(room_id)
+        if index is not None:
+            index.expire(end_seq)
+
+    async def room(self, room_id: str) -> RoomIndex:
+        index = self.rooms.get(room_id)
+        complete = self.complete(room_id)
+        if index is not None and index.ready and complete:
+            return index
+        lock = self._locks.setdefault(room_id, asyncio.Lock())
+        async with lock:
+            index = self.rooms.setdefault(room_id, RoomIndex())
+            if not index.ready:
+                await self._catch_up(room_id, index)
+            elif not complete:
+                # Other processes' flushes can land out of seq order, so the newest seqs
+                # already indexed are read again; adding them twice changes nothing
+                await self._read_stored(room_id, index, max(index.last_seq - REREAD_SEQS, 0) + 1)
+        self._locks.pop(room_id, None)
+        return index
+
+    async def _read_stored(self, room_id: str, index: RoomIndex, first_seq: Optional[int] = None) -> int:
+        # Indexes everything stored from first_seq on (by default, after the newest seq indexed)
+        read = 0
+        first_seq = index.last_seq + 1 if first_seq is None else first_seq
+        while True:
+            docs = await self.storage.messages_by_seq(room_id, first_seq, 2 ** 32, self.catch_up_batch)
+            for doc in docs:
+                index.add(doc["seq"], doc["message"])
+            read += len(docs)
+            if len(docs) < self.catch_up_batch:
+                return read
+            first_seq = docs[-1]["seq"] + 1
+
+    async def _catch_up(self, room_id: str, index: RoomIndex):
+        index.catching_up = True
+        try:
+            caught_up = await self._read_stored(room_id, index)
+        except Exception:
+            # The next search tries again from wherever this got to
+            index.catching_up = False
+            index.pending = []
+            raise
+        # Live messages persisted while storage was being read; any overlap is skipped
+        for doc in index.pending:
+            index.add(doc["seq"], doc["message"])
+        index.pending = []
+        index.catching_up = False
+        index.ready = True
+        if caught_up > self.catch_up_batch:
+            logger.info("Indexed %d messages for room %s", caught_up, room_id)
+
+    async def search(self, room_id: str, query: str, before: Optional[int] = None, limit: int = 20) -> List[int]:
+        terms = tokenize(query)
+        if not terms:
+            return []
+        started = time.perf_counter()
+        index = await self.room(room_id)
+        found = index.search(terms, before, limit)
+        search_seconds.observe(time.perf_counter() - started)
+        return found
+
+    async def save(self):
+        for room_id, index in list(self.rooms.items()):
+            if not index.dirty or not index.ready:
+                continue
+            index.dirty = False
+            last_seq, postings = index.snapshot()
+            try:
+                await asyncio.to_thread(self._write_snapshot, room_id, last_seq, postings)
+            except OSError as e:
+                index.dirty = True
+                logger.error("Could not save search index for room %s: %s", room_id, e)
+
+    async def _run(self):
+        # Rooms loaded from snapshots catch up now rather than on their first search
+        for room_id in list(self.rooms):
+            try:
+                await self.room(room_id)
+            except Exception as e:
+                logger.error("Could not catch up search index for room %s: %s", room_id, e)
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.save()
+
+    def _snapshot_path(self, room_id: str) -> str:
+        return room_directory(self.path, room_id) + ".idx"
+
+    def _write_snapshot(self, room_id: str, last_seq: int, postings: Dict[str, array]):
+        payload = msgpack.packb({
+            "version": SNAPSHOT_VERSION,
+            "room_id": room_id,
+            "last_seq": last_seq,
+            "postings": {term: pack_postings(seqs) for term, seqs in postings.items()}
+        })
+        path = self._snapshot_path(room_id)
+        with open(path + ".tmp", "wb") as f:
+            f.write(zlib.compress(payload, 1))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _load_snapshots(self) -> Dict[str, RoomIndex]:
+        rooms: Dict[str, RoomIndex] = {}
+        for name in os.listdir(self.path):
+            if not name.endswith(".idx"):
+                continue
+            try:
+                with open(os.path.join(self.path, name), "rb") as f:
+                    snapshot = msgpack.unpackb(zlib.decompress(f.read()))
+                if snapshot["version"] != SNAPSHOT_VERSION:
+                    continue
+            except (OSError, KeyError, ValueError, zlib.error) as e:
+                # Rebuilt from storage on first search
+                logger.warning("Ignoring unreadable search snapshot %s: %s", name, e)
+                continue
+            rooms[snapshot["room_id"]] = RoomIndex.restore(
+                snapshot["last_seq"],
+                {term: unpack_postings(data) for term, data in snapshot["postings"].items()}
+            )
+        return rooms
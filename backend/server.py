@@ -1,23 +1,155 @@
-from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Dict, Set
+from typing import List, Dict, Set, Deque, Tuple, Optional, Callable
 import uuid
 from datetime import datetime
+from collections import deque
+import asyncio
+import base64
+import hmac
 import json
+import random
+import time
+
+from analytics import RoomActivity
+from backplane import Backplane, InMemoryBackplane, create_backplane
+from catalog import RoomCatalog
+from connections import ConnectionRegistry, IdleWheel
+from history import HistoryKey, RecentHistory, RoomSequencer, message_key
+from limits import IngressLimiter, IngressLimits, TokenBucket
+from metrics import Counter, Gauge, Histogram, LoopLagSampler, registry
+from persistence import MessageWriter
+from profiling import SlowCallbackTracer, StackProfiler
+from protocol import MSGPACK_PROTOCOL, Frame, FrameTooLarge, decode_client_frame, negotiate, ref_definitions, user_refs
+from retention import RetentionJob, RetentionPolicy
+from search import SearchIndex
+from sharding import ShardMap, claim_directory
+from storage import create_storage
+from unread import ReadTracker
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Storage: "mongo" (MONGO_URL, DB_NAME) or "log", an embedded append-only log under STORAGE_PATH
+# for single-process deployments
+STORAGE = os.environ.get('STORAGE', 'mongo')  # mongo, log
+STORAGE_PATH = os.environ.get('STORAGE_PATH', str(ROOT_DIR / 'data'))
+LOG_SEGMENT_BYTES = int(os.environ.get('LOG_SEGMENT_BYTES', str(8 * 1024 * 1024)))
+LOG_FSYNC_MS = int(os.environ.get('LOG_FSYNC_MS', '0'))  # 0 fsyncs every write batch
+# Mongo archive buckets (see retention below) go on in a new document every this many messages
+ARCHIVE_BUCKET_MAX_MESSAGES = int(os.environ.get('ARCHIVE_BUCKET_MAX_MESSAGES', '1000'))
+
+storage = create_storage(
+    STORAGE,
+    mongo_url=os.environ.get('MONGO_URL', ''),
+    db_name=os.environ.get('DB_NAME', ''),
+    path=STORAGE_PATH,
+    segment_bytes=LOG_SEGMENT_BYTES,
+    fsync_interval=LOG_FSYNC_MS / 1000,
+    archive_bucket_messages=ARCHIVE_BUCKET_MAX_MESSAGES
+)
+
+# Cross-worker fan-out: "memory" for a single worker, "unix" for several workers on one box
+BACKPLANE = os.environ.get('BACKPLANE', 'memory')
+BACKPLANE_SOCKET = os.environ.get('BACKPLANE_SOCKET', '/tmp/chatroom-backplane.sock')
+
+# Optional room sharding across K processes (see shards.py); each room lives on exactly one shard
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+SHARD_INDEX = int(os.environ.get('SHARD_INDEX', '0'))
+SHARD_URLS = [url for url in os.environ.get('SHARD_URLS', '').split(',') if url]
+
+shard_map = ShardMap(SHARD_INDEX, SHARD_COUNT, SHARD_URLS)
+
+# Any shard serves history and search for any room, so shards need storage they all share;
+# the embedded log is locked to one process
+if SHARD_COUNT > 1 and STORAGE != 'mongo':
+    raise ValueError(f"SHARD_COUNT={SHARD_COUNT} needs storage shared by every shard (STORAGE=mongo)")
+
+# Files that only one process may write (search snapshots, activity counters, drain state)
+# go under PROCESS_PATH by default: STORAGE_PATH itself for a single process, else a
+# directory in it per shard, or per worker when unsharded workers share a backplane
+if SHARD_COUNT > 1:
+    PROCESS_PATH = os.path.join(STORAGE_PATH, f'shard-{SHARD_INDEX}')
+elif BACKPLANE != 'memory':
+    PROCESS_PATH = claim_directory(STORAGE_PATH, 'worker')
+else:
+    PROCESS_PATH = STORAGE_PATH
+
+# Full-text search indexes, fed from the write-behind flush and snapshotted under SEARCH_PATH.
+# Rooms other processes post to as well catch up from storage before each search.
+SEARCH_PATH = os.environ.get('SEARCH_PATH', os.path.join(PROCESS_PATH, 'search'))
+SEARCH_SNAPSHOT_S = float(os.environ.get('SEARCH_SNAPSHOT_S', '60'))
+
+search_index = SearchIndex(storage, SEARCH_PATH, snapshot_interval=SEARCH_SNAPSHOT_S,
+                           complete=lambda room_id: posted_here(room_id))
+
+# Write-behind persistence for chat messages
+PERSIST_BATCH_SIZE = int(os.environ.get('PERSIST_BATCH_SIZE', '500'))
+PERSIST_FLUSH_MS = int(os.environ.get('PERSIST_FLUSH_MS', '50'))
+PERSIST_MAX_BUFFER = int(os.environ.get('PERSIST_MAX_BUFFER', '10000'))
+PERSIST_ACK_MODE = os.environ.get('PERSIST_ACK_MODE', 'broadcast')  # broadcast, persist
+
+message_writer = MessageWriter(
+    storage,
+    batch_size=PERSIST_BATCH_SIZE,
+    flush_interval=PERSIST_FLUSH_MS / 1000,
+    max_buffer=PERSIST_MAX_BUFFER,
+    on_persisted=search_index.add_messages
+)
+
+# Recent messages per room, kept in memory so history requests skip storage (for rooms
+# whose messages all go through this process; see posted_here)
+HISTORY_CACHE_SIZE = int(os.environ.get('HISTORY_CACHE_SIZE', '200'))
+HISTORY_CACHE_MAX_BYTES = int(os.environ.get('HISTORY_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+recent_history = RecentHistory(size=HISTORY_CACHE_SIZE, max_bytes=HISTORY_CACHE_MAX_BYTES)
+
+# Retention: messages older than RETENTION_TTL_S are deleted, and beyond RETENTION_HOT_COUNT
+# messages or RETENTION_HOT_AGE_S they move into ARCHIVE_BUCKET_S-wide archive buckets that
+# history reads page into. 0 turns a limit off; ROOM_RETENTION overrides them per room, e.g.
+# {"<room_id>": {"ttl_s": 604800, "hot_count": 1000}}. Each worker handles the rooms it owns.
+RETENTION_TTL_S = float(os.environ.get('RETENTION_TTL_S', '0'))
+RETENTION_HOT_COUNT = int(os.environ.get('RETENTION_HOT_COUNT', '0'))
+RETENTION_HOT_AGE_S = float(os.environ.get('RETENTION_HOT_AGE_S', '0'))
+ARCHIVE_BUCKET_S = float(os.environ.get('ARCHIVE_BUCKET_S', '3600'))
+RETENTION_INTERVAL_S = float(os.environ.get('RETENTION_INTERVAL_S', '300'))
+RETENTION_BATCH = int(os.environ.get('RETENTION_BATCH', '1000'))
+
+# Read markers and room heads for unread counts, written back every READ_MARKER_FLUSH_MS;
+# heads advanced by other workers are picked up every ROOM_HEADS_REFRESH_S
+READ_MARKER_FLUSH_MS = int(os.environ.get('READ_MARKER_FLUSH_MS', '1000'))
+ROOM_HEADS_REFRESH_S = float(os.environ.get('ROOM_HEADS_REFRESH_S', '30'))
+
+read_tracker = ReadTracker(storage, flush_interval=READ_MARKER_FLUSH_MS / 1000, refresh_interval=ROOM_HEADS_REFRESH_S)
+
+# Per-room activity counters behind /api/stats, kept in memory at minute (STATS_MINUTES long)
+# and hour (STATS_HOURS long) resolution and snapshotted to STATS_PATH every STATS_SNAPSHOT_S.
+# Messages are counted by the worker they were posted to, and each worker keeps its own snapshot.
+STATS_PATH = os.environ.get('STATS_PATH', os.path.join(PROCESS_PATH, 'stats.npz'))
+STATS_MINUTES = int(os.environ.get('STATS_MINUTES', '360'))
+STATS_HOURS = int(os.environ.get('STATS_HOURS', '720'))
+STATS_SNAPSHOT_S = float(os.environ.get('STATS_SNAPSHOT_S', '60'))
+
+room_activity = RoomActivity(STATS_PATH, minutes=STATS_MINUTES, hours=STATS_HOURS, snapshot_interval=STATS_SNAPSHOT_S,
+                             known=lambda room_id: room_id in room_catalog.rooms)
+
+# Per-room message sequence numbers, used by clients to resume after a reconnect
+RESUME_MAX_MESSAGES = int(os.environ.get('RESUME_MAX_MESSAGES', '500'))
+
+room_sequencer = RoomSequencer(storage.last_seq)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
 
 # Create the main app without a prefix
 app = FastAPI()
@@ -25,62 +157,616 @@ app = FastAPI()
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Several unsharded workers behind a shared backplane all post to the same rooms, so seqs
+# come from a counter in storage instead of each worker's own. Sharded rooms have a single
+# owner, which keeps numbering them locally.
+if BACKPLANE != 'memory' and SHARD_COUNT == 1:
+    if STORAGE != 'mongo':
+        raise ValueError(f"BACKPLANE={BACKPLANE} without sharding needs storage shared by every worker (STORAGE=mongo)")
+    room_sequencer.allocator = storage.next_seq
+    room_sequencer.current = storage.current_seq
+
+def posted_here(room_id: str) -> bool:
+    # Whether every message in the room is posted through this process, so the in-memory
+    # ring buffer sees them all. Not with a shared seq counter (other workers post to the
+    # room too) or for rooms another shard owns.
+    return room_sequencer.allocator is None and shard_map.owns(room_id)
+
+# Outbound send queue settings
+SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', '256'))
+OVERFLOW_POLICY = os.environ.get('WS_OVERFLOW_POLICY', 'drop_oldest')  # drop_oldest, coalesce, disconnect
+OVERFLOW_POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+
+# Tick-based batching: busy rooms get one frame with an array of events per tick
+ROOM_BATCH_MODE = os.environ.get('ROOM_BATCH_MODE', 'off')  # off, auto, always
+ROOM_BATCH_TICK_MS = int(os.environ.get('ROOM_BATCH_TICK_MS', '25'))
+ROOM_BATCH_RATE = float(os.environ.get('ROOM_BATCH_RATE', '20'))  # msgs/sec at which auto mode starts batching
+
+# Joins and leaves are collected per room and sent as one delta per window
+PRESENCE_DEBOUNCE_MS = int(os.environ.get('PRESENCE_DEBOUNCE_MS', '250'))
+
+# Binary frames at least this big are deflated for connections that asked for it (?deflate=1..9)
+WS_DEFLATE_MIN_BYTES = int(os.environ.get('WS_DEFLATE_MIN_BYTES', '256'))
+
+# Rooms one multiplexed connection (/ws/{user_id}/{username}) can subscribe to at once
+WS_MAX_SUBSCRIPTIONS = int(os.environ.get('WS_MAX_SUBSCRIPTIONS', '50'))
+
+# Connections silent for WS_IDLE_TIMEOUT_S get a {"type": "ping"}; no frame back within
+# WS_PING_TIMEOUT_S and they are closed. Off (0) by default, since only clients that answer
+# the ping (like the web app) should be run with it on; listen-only clients would be reaped.
+WS_IDLE_TIMEOUT_S = float(os.environ.get('WS_IDLE_TIMEOUT_S', '0'))
+WS_PING_TIMEOUT_S = float(os.environ.get('WS_PING_TIMEOUT_S', '20'))
+
+# Lobby subscribers get room user-count changes at most once per LOBBY_PUSH_MS
+LOBBY_PUSH_MS = int(os.environ.get('LOBBY_PUSH_MS', '1000'))
+LOBBY_KEEPALIVE_S = float(os.environ.get('LOBBY_KEEPALIVE_S', '15'))
+# Backplane channel for rooms created on other workers; the slash keeps it out of WebSocket room ids
+LOBBY_CHANNEL = "lobby/rooms"
+
+# Ingress limits; frame size is checked before a frame is parsed, and the connection rate applies
+# to chat messages and subscribes only. Rates are messages/sec (0 = unlimited) and ROOM_LIMITS
+# overrides them per room, e.g. {"<room_id>": {"conn_rate": 1, "max_message_chars": 280}}
+ingress_limiter = IngressLimiter(
+    IngressLimits(
+        max_frame_bytes=int(os.environ.get('WS_MAX_FRAME_BYTES', '16384')),
+        max_message_chars=int(os.environ.get('WS_MAX_MESSAGE_CHARS', '2000')),
+        conn_rate=float(os.environ.get('WS_CONN_RATE', '5')),
+        conn_burst=float(os.environ.get('WS_CONN_BURST', '10')),
+        room_rate=float(os.environ.get('WS_ROOM_RATE', '100')),
+        room_burst=float(os.environ.get('WS_ROOM_BURST', '200'))
+    ),
+    json.loads(os.environ.get('ROOM_LIMITS', '{}'))
+)
+
+# Admission control: new sockets are let in at WS_ADMIT_RATE/sec in bursts of WS_ADMIT_BURST
+# (0 = unlimited); the rest are told to come back after a delay spread over WS_ADMIT_JITTER_MS
+WS_ADMIT_RATE = float(os.environ.get('WS_ADMIT_RATE', '200'))
+WS_ADMIT_BURST = float(os.environ.get('WS_ADMIT_BURST', '400'))
+WS_ADMIT_JITTER_MS = int(os.environ.get('WS_ADMIT_JITTER_MS', '5000'))
+
+# Drain (POST /api/admin/drain, before stopping the process): new sockets are refused, every
+# client gets {"type": "reconnect"} with a resume token and a delay of DRAIN_RECONNECT_MS plus
+# up to DRAIN_JITTER_MS, pending writes are flushed and room presence is saved to
+# DRAIN_STATE_PATH so the next process warms the busiest rooms first
+DRAIN_RECONNECT_MS = int(os.environ.get('DRAIN_RECONNECT_MS', '1000'))
+DRAIN_JITTER_MS = int(os.environ.get('DRAIN_JITTER_MS', '15000'))
+DRAIN_TIMEOUT_S = float(os.environ.get('DRAIN_TIMEOUT_S', '10'))
+DRAIN_STATE_PATH = os.environ.get('DRAIN_STATE_PATH', os.path.join(PROCESS_PATH, 'drain-state.json'))
+DRAIN_STATE_MAX_AGE_S = float(os.environ.get('DRAIN_STATE_MAX_AGE_S', '600'))
+
+# Admin endpoints take this in an X-Admin-Token header and are disabled while it is unset
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Diagnostics behind the admin token: POST /api/admin/profile samples stacks for up to
+# PROFILE_MAX_S, and /api/admin/slow-callbacks traces loop callbacks slower than a threshold
+# for up to SLOW_CALLBACK_MAX_S. Neither costs anything until it is asked for.
+PROFILE_MAX_S = float(os.environ.get('PROFILE_MAX_S', '60'))
+SLOW_CALLBACK_MAX_S = float(os.environ.get('SLOW_CALLBACK_MAX_S', '600'))
+
+stack_profiler = StackProfiler()
+slow_callback_tracer = SlowCallbackTracer()
+
+# Metrics, served in Prometheus text format from /api/metrics
+connections_total = Counter("chat_connections_total", "WebSocket connections accepted")
+disconnects_total = Counter("chat_disconnects_total", "WebSocket connections removed")
+messages_received_total = Counter("chat_messages_received_total", "Chat messages received from clients")
+frames_enqueued_total = Counter("chat_frames_enqueued_total", "Frames queued to client connections")
+frames_dropped_total = Counter("chat_frames_dropped_total", "Frames dropped by a full send queue", ["policy"])
+slow_consumers_total = Counter("chat_slow_consumer_disconnects_total", "Connections closed for falling behind")
+idle_reaped_total = Counter("chat_idle_reaped_total", "Connections closed for not answering an idle ping")
+ingress_rejected_total = Counter("chat_ingress_rejected_total", "Client frames rejected before processing", ["reason"])
+admission_rejected_total = Counter(
+    "chat_admission_rejected_total", "WebSocket connections turned away with a reconnect hint", ["reason"]
+)
+ingress_limit = Gauge(
+    "chat_ingress_limit", "Configured ingress limits; room=\"*\" is the default", ["room", "limit"],
+    collect=lambda: {
+        (room, name): value
+        for room, limits in [("*", ingress_limiter.defaults), *ingress_limiter.rooms.items()]
+        for name, value in limits.as_dict().items()
+    }
+)
+broadcast_seconds = Histogram("chat_broadcast_seconds", "Time to fan one frame out to a room")
+history_seconds = Histogram("chat_history_request_seconds", "History endpoint latency", ["source"])
+room_connections = Gauge(
+    "chat_room_connections", "Local connections per room", ["room_id"],
+    collect=lambda: {(room_id,): count for room_id, count in manager.registry.room_sizes()}
+)
+send_queue_depth = Histogram(
+    "chat_send_queue_depth", "Pending frames per connection, sampled at scrape time",
+    buckets=(0, 1, 4, 16, 64, 256, 1024),
+    collect=lambda: {(): [c.pending for c in manager.registry]}
+)
+persist_buffer_depth = Gauge(
+    "chat_persist_buffer_depth", "Chat messages waiting for the write-behind flush",
+    collect=lambda: {(): len(message_writer.buffer)}
+)
+loop_lag = Histogram("chat_event_loop_lag_seconds", "How late the event loop ran a timer")
+loop_lag_last = Gauge("chat_event_loop_lag_last_seconds", "Most recent event loop lag sample")
+loop_lag_sampler = LoopLagSampler(loop_lag, loop_lag_last)
+
+class SlowConsumer(Exception):
+    pass
+
+def encode_frame(message: dict) -> Frame:
+    # Encoded lazily, once per wire format, however many connections it goes to
+    return Frame(message)
+
+# Sent to idle connections; any frame back (e.g. {"type": "pong"}) counts as an answer
+PING_FRAME = encode_frame({"type": "ping"})
+
+# One socket plus its bounded outbound queue. Most listeners are idle, so the queue and
+# the writer task are only created when there is something to send, and the idle reaper
+# retires them again once the connection has gone quiet.
+class ClientConnection:
+    __slots__ = ("websocket", "username", "user", "room", "slot", "rooms", "max_queue", "policy", "binary",
+                 "deflate_level", "known_refs", "queue", "writer", "ready", "held", "closed", "dropped",
+                 "last_seen", "pinged", "on_error")
+
+    def __init__(self, websocket: WebSocket, username: str = "", max_queue: int = SEND_QUEUE_SIZE,
+                 policy: str = OVERFLOW_POLICY, protocol: Optional[str] = None, deflate_level: int = 0,
+                 held: bool = False, multiplexed: bool = False):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.websocket = websocket
+        self.username = username
+        # Interned ids and position in the room, set by ConnectionRegistry; a multiplexed
+        # connection keeps room -> position for each room it subscribed to in `rooms` instead
+        self.user = self.room = self.slot = -1
+        self.rooms: Optional[Dict[int, int]] = {} if multiplexed else None
+        self.max_queue = max_queue
+        self.policy = policy
+        self.binary = protocol == MSGPACK_PROTOCOL
+        self.deflate_level = deflate_level
+        self.known_refs: Optional[Set[int]] = None
+        self.queue: Optional[Deque[Tuple[Optional[str], Frame]]] = None
+        self.writer: Optional[asyncio.Task] = None
+        self.ready: Optional[asyncio.Event] = None
+        # Held connections queue frames but do not send until start()
+        self.held = held
+        self.closed = False
+        self.dropped = 0
+        self.last_seen = time.monotonic()
+        self.pinged = False
+        self.on_error: Optional[Callable[["ClientConnection"], None]] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self.queue) if self.queue else 0
+
+    def start(self, on_error: Callable[["ClientConnection"], None]):
+        self.on_error = on_error
+        self.held = False
+        if self.queue:
+            self._start_writer()
+
+    def _start_writer(self):
+        self.ready = asyncio.Event()
+        self.ready.set()
+        self.writer = asyncio.create_task(self._drain())
+
+    def retire(self):
+        # Lets an idle writer task exit; the next enqueue starts a new one
+        if self.writer is not None and not self.queue:
+            self.ready.set()
+
+    def prepend(self, frames: List[Frame]):
+        # Frames that must go out ahead of anything already queued (e.g. a resume replay)
+        if frames:
+            if self.queue is None:
+                self.queue = deque()
+            self.queue.extendleft((None, frame) for frame in reversed(frames))
+
+    def enqueue(self, frame: Frame, coalesce_key: Optional[str] = None):
+        if self.closed:
+            return
+        queue = self.queue
+        if queue is None:
+            queue = self.queue = deque()
+        elif len(queue) >= self.max_queue:
+            if self.policy == 'disconnect':
+                raise SlowConsumer()
+            if self.policy == 'coalesce' and coalesce_key is not None:
+                # Replace the pending frame with the same key, keeping its place in line
+                for i, (key, _) in enumerate(queue):
+                    if key == coalesce_key:
+                        queue[i] = (coalesce_key, frame)
+                        return
+            queue.popleft()
+            self.dropped += 1
+            frames_dropped_total.inc(labels=(self.policy,))
+        queue.append((coalesce_key, frame))
+        if self.writer is not None:
+            self.ready.set()
+        elif not self.held:
+            self._start_writer()
+
+    async def _drain(self):
+        ready = self.ready
+        try:
+            while not self.closed:
+                await ready.wait()
+                if not self.queue:
+                    # Woken by retire()
+                    break
+                while self.queue:
+                    ready.clear()
+                    _, frame = self.queue.popleft()
+                    if self.binary:
+                        await self._send_binary(frame)
+                    else:
+                        await self.websocket.send_text(frame.text)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # The socket is gone; the receive loop will see the disconnect too
+            if self.on_error is not None:
+                self.on_error(self)
+        finally:
+            if self.writer is asyncio.current_task():
+                self.writer = self.ready = None
+                if not self.queue:
+                    self.queue = None
+
+    async def _send_binary(self, frame: Frame):
+        data = frame.binary(self.deflate_level, WS_DEFLATE_MIN_BYTES)
+        if frame.refs:
+            known = self.known_refs
+            if known is None:
+                known = self.known_refs = set()
+            unknown = {ref: user for ref, user in frame.refs.items() if ref not in known}
+            if unknown:
+                await self.websocket.send_bytes(ref_definitions(unknown))
+                known.update(unknown)
+        await self.websocket.send_bytes(data)
+
+    async def close(self, code: int = 1000):
+        self.stop()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stop(self):
+        self.closed = True
+        self.queue = None
+        if self.writer is not None and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+            self.writer = self.ready = None
+
+# Message rate and pending events for one room while it is in batched delivery
+class RoomBatch:
+    def __init__(self, batched: bool = False):
+        self.batched = batched
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.pending: List[dict] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def observe(self, rate_threshold: float):
+        self.window_count += 1
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed < 1.0:
+            return
+        rate = self.window_count / elapsed
+        # Hysteresis so a room hovering around the threshold does not flap between modes
+        if rate >= rate_threshold:
+            self.batched = True
+        elif rate < rate_threshold / 2:
+            self.batched = False
+        self.window_start = now
+        self.window_count = 0
+
+# Joins and leaves in a room since the last presence delta went out
+class PresenceDelta:
+    def __init__(self):
+        self.joined: Dict[str, str] = {}  # user_id -> username
+        self.left: Dict[str, str] = {}
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def join(self, user_id: str, username: str):
+        # A leave and rejoin inside one window cancel out
+        if self.left.pop(user_id, None) is None:
+            self.joined[user_id] = username
+
+    def leave(self, user_id: str, username: str):
+        if self.joined.pop(user_id, None) is None:
+            self.left[user_id] = username
+
 # WebSocket Connection Manager
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.user_rooms: Dict[str, str] = {}  # user_id -> room_id
-        self.room_users: Dict[str, Set[str]] = {}  # room_id -> set of user_ids
+    def __init__(self, backplane: Optional[Backplane] = None):
+        self.registry: ConnectionRegistry[ClientConnection] = ConnectionRegistry()
+        self.backplane = backplane or InMemoryBackplane()
+        self.presence_window = PRESENCE_DEBOUNCE_MS / 1000
+        self.presence_deltas: Dict[str, PresenceDelta] = {}
+        self.batch_mode = ROOM_BATCH_MODE
+        self.batch_tick = ROOM_BATCH_TICK_MS / 1000
+        self.batch_rate = ROOM_BATCH_RATE
+        self.room_batches: Dict[str, RoomBatch] = {}
+        self.idle_timeout = WS_IDLE_TIMEOUT_S
+        self.ping_timeout = WS_PING_TIMEOUT_S
+        self.idle_wheel: IdleWheel[ClientConnection] = IdleWheel()
+        self._reaper: Optional[asyncio.Task] = None
+        self.draining = False
 
-    async def connect(self, websocket: WebSocket, user_id: str, username: str, room_id: str):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-        self.user_rooms[user_id] = room_id
-        
-        if room_id not in self.room_users:
-            self.room_users[room_id] = set()
-        self.room_users[room_id].add(user_id)
-        
-        # Notify room about new user
-        await self.broadcast_to_room(room_id, {
-            "type": "user_joined",
-            "user_id": user_id,
-            "username": username,
-            "timestamp": datetime.utcnow().isoformat(),
-            "user_count": len(self.room_users[room_id])
-        })
-
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-        
-        if user_id in self.user_rooms:
-            room_id = self.user_rooms[user_id]
-            del self.user_rooms[user_id]
-            
-            if room_id in self.room_users:
-                self.room_users[room_id].discard(user_id)
-                if len(self.room_users[room_id]) == 0:
-                    del self.room_users[room_id]
-
-    async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
-            websocket = self.active_connections[user_id]
-            await websocket.send_text(json.dumps(message))
-
-    async def broadcast_to_room(self, room_id: str, message: dict):
-        if room_id in self.room_users:
-            for user_id in list(self.room_users[room_id]):
-                await self.send_personal_message(message, user_id)
+    async def connect(self, websocket: WebSocket, user_id: str, username: str, room_id: Optional[str],
+                      hold: bool = False, protocol: Optional[str] = None, deflate_level: int = 0) -> ClientConnection:
+        # With hold=True live frames queue up but are not sent until release(). With room_id
+        # None the connection is multiplexed and joins rooms through subscribe().
+        await websocket.accept(subprotocol=protocol)
+        previous = self.registry.get(user_id)
+        if previous is not None:
+            # Same user again (another tab, or a reconnect before the old socket was noticed
+            # gone). The old socket is closed with 4409 rather than left open but deaf.
+            self.disconnect(user_id)
+            asyncio.create_task(previous.close(code=4409))
+
+        connection = ClientConnection(websocket, username, protocol=protocol, deflate_level=deflate_level,
+                                      held=hold, multiplexed=room_id is None)
+        connections_total.inc()
+        self.registry.add(connection, user_id)
+        user_refs.acquire(user_id, username)
+        if room_id is not None:
+            self._join(connection, user_id, room_id)
+        if not hold:
+            connection.start(self._drop_connection)
+        if self.idle_timeout:
+            self.idle_wheel.schedule(connection, connection.last_seen + self.idle_timeout)
+        return connection
+
+    def subscribe(self, connection: ClientConnection, room_id: str, frames: Callable[[], List[Frame]]):
+        # Adds a room to a multiplexed connection. frames() is queued right after joining,
+        # before any live frame from the room can be, so it can be an ack plus a replay.
+        self._join(connection, self.registry.user_id(connection), room_id)
+        for frame in frames():
+            if not self._enqueue(connection, frame):
+                return
+
+    def unsubscribe(self, connection: ClientConnection, room_id: str) -> bool:
+        # Returns True when the room is left empty on this worker
+        return self._leave(connection, self.registry.user_id(connection), room_id)
+
+    def _join(self, connection: ClientConnection, user_id: str, room_id: str):
+        if self.registry.join(connection, room_id):
+            self.backplane.subscribe(room_id)
+        self.backplane.set_presence(room_id, len(self.registry.room(room_id)))
+        # Notify room about new user with the next presence delta
+        self._presence_delta(room_id).join(user_id, connection.username)
+
+    def _leave(self, connection: ClientConnection, user_id: str, room_id: str) -> bool:
+        emptied = self.registry.leave(connection, room_id)
+        self._presence_delta(room_id).leave(user_id, connection.username)
+        self.backplane.set_presence(room_id, len(self.registry.room(room_id)))
+        if emptied:
+            self.backplane.unsubscribe(room_id)
+            batch = self.room_batches.get(room_id)
+            if batch is not None and not batch.pending:
+                del self.room_batches[room_id]
+        return emptied
+
+    def release(self, user_id: str, frames: List[Frame]):
+        connection = self.registry.get(user_id)
+        if connection is None or not connection.held:
+            return
+        connection.prepend(frames)
+        connection.start(self._drop_connection)
+
+    def disconnect(self, user_id: str, connection: Optional[ClientConnection] = None):
+        # With a connection given, only that one is removed (not a newer one for the same user)
+        current = self.registry.get(user_id)
+        if current is None or (connection is not None and current is not connection):
+            return
+        current.stop()
+        for room_id in self.registry.room_ids(current):
+            self._leave(current, user_id, room_id)
+        self.registry.remove(current)
+        user_refs.release(user_id)
+        disconnects_total.inc()
+
+    def start_reaper(self):
+        if self._reaper is None and self.idle_timeout:
+            self._reaper = asyncio.create_task(self._reap())
+
+    async def stop_reaper(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            try:
+                await self._reaper
+            except asyncio.CancelledError:
+                pass
+            self._reaper = None
+
+    async def _reap(self):
+        # Only connections whose idle deadline has come up are looked at each tick
+        while True:
+            await asyncio.sleep(self.idle_wheel.tick)
+            now = time.monotonic()
+            for connection in self.idle_wheel.due(now):
+                if connection.closed:
+                    continue
+                connection.retire()
+                idle_until = connection.last_seen + self.idle_timeout
+                if idle_until > now:
+                    connection.pinged = False
+                    self.idle_wheel.schedule(connection, idle_until)
+                elif not connection.pinged:
+                    connection.pinged = True
+                    self._enqueue(connection, PING_FRAME)
+                    self.idle_wheel.schedule(connection, now + self.ping_timeout)
+                else:
+                    idle_reaped_total.inc()
+                    self.disconnect(self.registry.user_id(connection), connection)
+                    asyncio.create_task(connection.close(code=4408))
+
+    def _presence_delta(self, room_id: str) -> PresenceDelta:
+        delta = self.presence_deltas.get(room_id)
+        if delta is None:
+            delta = self.presence_deltas[room_id] = PresenceDelta()
+            delta.timer = asyncio.get_running_loop().call_later(self.presence_window, self._flush_presence, room_id)
+        return delta
+
+    def _flush_presence(self, room_id: str):
+        delta = self.presence_deltas.pop(room_id)
+        if not delta.joined and not delta.left:
+            return
+        # Keyed so a coalescing send queue keeps only the latest delta for a slow client
+        self._publish(room_id, encode_frame({
+            "type": "presence",
+            "room_id": room_id,
+            "joined": [[user_id, username] for user_id, username in delta.joined.items()],
+            "left": [[user_id, username] for user_id, username in delta.left.items()],
+            "user_count": self.get_room_user_count(room_id),
+            "timestamp": datetime.utcnow().isoformat()
+        }), coalesce_key="presence")
+
+    async def drain(self, hint: Callable[[ClientConnection], dict], timeout: float, code: int = 1012) -> int:
+        # Refuses new sockets from here on, queues hint(connection) behind whatever
+        # each client still has pending, gives the queues up to `timeout` to empty, then
+        # closes every socket. Returns how many were closed.
+        self.draining = True
+        connections = list(self.registry)
+        for connection in connections:
+            self._enqueue(connection, encode_frame(hint(connection)))
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and any(c.pending for c in connections if not c.closed):
+            await asyncio.sleep(0.05)
+        for i in range(0, len(connections), 1000):
+            await asyncio.gather(*(c.close(code) for c in connections[i:i + 1000]))
+        return len(connections)
+
+    def presence_by_room(self) -> Dict[str, List[List[str]]]:
+        return {
+            room_id: [[self.registry.user_id(c), c.username] for c in self.registry.room(room_id)]
+            for room_id, _ in self.registry.room_sizes()
+        }
+
+    def presence_snapshot(self, room_id: str) -> dict:
+        # Members connected to this worker, plus the room-wide count
+        return {
+            "type": "presence_snapshot",
+            "room_id": room_id,
+            "users": [[self.registry.user_id(c), c.username] for c in self.registry.room(room_id)],
+            "user_count": self.get_room_user_count(room_id)
+        }
+
+    def _drop_connection(self, connection: ClientConnection):
+        if not connection.closed:
+            self.disconnect(self.registry.user_id(connection), connection)
+
+    async def send_personal_message(self, message: dict, user_id: str, coalesce_key: Optional[str] = None):
+        connection = self.registry.get(user_id)
+        if connection is not None:
+            self._enqueue(connection, encode_frame(message), coalesce_key)
+
+    def _enqueue(self, connection: ClientConnection, frame: Frame, coalesce_key: Optional[str] = None) -> bool:
+        # False if the connection was dropped as a slow consumer
+        try:
+            connection.enqueue(frame, coalesce_key)
+            return True
+        except SlowConsumer:
+            self._drop_slow_consumer(connection)
+            return False
+
+    def _drop_slow_consumer(self, connection: ClientConnection):
+        user_id = self.registry.user_id(connection)
+        logger.warning("Disconnecting slow consumer %s", user_id)
+        slow_consumers_total.inc()
+        self.disconnect(user_id, connection)
+        asyncio.create_task(connection.close(code=1008))
+
+    async def broadcast_to_room(self, room_id: str, message: dict, coalesce_key: Optional[str] = None):
+        if self.batch_mode != 'off':
+            batch = self.room_batches.get(room_id)
+            if batch is None:
+                batch = self.room_batches[room_id] = RoomBatch(batched=self.batch_mode == 'always')
+            was_batched = batch.batched
+            if self.batch_mode == 'auto':
+                batch.observe(self.batch_rate)
+            if batch.batched:
+                batch.pending.append(message)
+                if batch.timer is None:
+                    batch.timer = asyncio.get_running_loop().call_later(self.batch_tick, self._flush_batch, room_id)
+                return
+            if was_batched:
+                # Leaving batched mode; whatever is pending goes out first to keep order
+                self._flush_batch(room_id)
+
+        self._publish(room_id, encode_frame(message), coalesce_key)
+
+    def _flush_batch(self, room_id: str):
+        batch = self.room_batches.get(room_id)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        if batch.pending:
+            events, batch.pending = batch.pending, []
+            self._publish(room_id, encode_frame({"type": "batch", "room_id": room_id, "events": events}))
+        if not self.registry.room(room_id):
+            del self.room_batches[room_id]
+
+    def _publish(self, room_id: str, frame: Frame, coalesce_key: Optional[str] = None):
+        # Serialized once and shared by every recipient; each connection's writer task does the actual send
+        with broadcast_seconds.time():
+            self.deliver_local(room_id, frame, coalesce_key)
+            self.backplane.publish(room_id, frame.text, coalesce_key)
+
+    def deliver_remote(self, room_id: str, text: str, coalesce_key: Optional[str] = None,
+                       message: Optional[dict] = None):
+        # Frames from other workers arrive as JSON text (and already parsed, if the caller
+        # had to look inside); binary is re-encoded here only if needed
+        self.deliver_local(room_id, Frame(message, text), coalesce_key)
+
+    def deliver_local(self, room_id: str, frame: Frame, coalesce_key: Optional[str] = None):
+        members = self.registry.room(room_id)
+        slow: List[ClientConnection] = []
+        for connection in members:
+            try:
+                connection.enqueue(frame, coalesce_key)
+            except SlowConsumer:
+                slow.append(connection)
+        frames_enqueued_total.inc(len(members))
+        # Dropped after the loop, since removal reorders the member list
+        for connection in slow:
+            self._drop_slow_consumer(connection)
 
     def get_room_user_count(self, room_id: str) -> int:
-        return len(self.room_users.get(room_id, set()))
+        # Summed across every worker sharing the backplane
+        return self.backplane.room_user_count(room_id)
 
-manager = ConnectionManager()
+manager = ConnectionManager(create_backplane(BACKPLANE, BACKPLANE_SOCKET))
+admission = TokenBucket(WS_ADMIT_RATE, WS_ADMIT_BURST)
+
+room_catalog = RoomCatalog(manager.get_room_user_count, push_interval=LOBBY_PUSH_MS / 1000)
+def presence_changed(room_id: str):
+    room_catalog.count_changed(room_id)
+    room_activity.listeners(room_id, manager.get_room_user_count(room_id))
+
+manager.backplane.on_presence = presence_changed
+
+def messages_expired(room_id: str, end_seq: int):
+    search_index.expire(room_id, end_seq)
+    read_tracker.expired(room_id, end_seq)
+    recent_history.forget(room_id)
+
+retention_job = RetentionJob(
+    storage,
+    lambda: [room_id for room_id in room_catalog.order if shard_map.owns(room_id)],
+    RetentionPolicy(ttl_s=RETENTION_TTL_S, hot_count=RETENTION_HOT_COUNT, hot_age_s=RETENTION_HOT_AGE_S),
+    json.loads(os.environ.get('ROOM_RETENTION', '{}')),
+    bucket_seconds=ARCHIVE_BUCKET_S,
+    interval=RETENTION_INTERVAL_S,
+    batch=RETENTION_BATCH,
+    on_expired=messages_expired
+)
 
 # Define Models
 class ChatMessage(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    seq: Optional[int] = None
     user_id: str
     username: str
     room_id: str
@@ -88,6 +774,35 @@ class ChatMessage(BaseModel):
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     message_type: str = "chat"  # chat, system
 
+# Same shape as ChatMessage.dict(), without running the model on the hot path
+def new_chat_message(user_id: str, username: str, room_id: str, seq: int, message: str,
+                     message_type: str = "chat") -> dict:
+    now = datetime.utcnow()
+    return {
+        "id": str(uuid.uuid4()),
+        "seq": seq,
+        "user_id": user_id,
+        "username": username,
+        "room_id": room_id,
+        "message": message,
+        # Millisecond precision, as Mongo stores it, so cached and stored copies are identical
+        "timestamp": now.replace(microsecond=now.microsecond // 1000 * 1000),
+        "message_type": message_type
+    }
+
+def message_event(chat_message: dict) -> dict:
+    return {
+        "type": "message",
+        "room_id": chat_message["room_id"],
+        "id": chat_message["id"],
+        "seq": chat_message.get("seq"),
+        "user_id": chat_message["user_id"],
+        "username": chat_message["username"],
+        "message": chat_message["message"],
+        "timestamp": chat_message["timestamp"].isoformat(),
+        "user_count": manager.get_room_user_count(chat_message["room_id"])
+    }
+
 class ChatMessageCreate(BaseModel):
     user_id: str
     username: str
@@ -108,76 +823,605 @@ class RoomCreate(BaseModel):
     description: str
     niche: str
 
+async def admit(websocket: WebSocket) -> bool:
+    if not manager.draining and admission.take(time.monotonic()):
+        return True
+    # Turned away with a spread-out delay, so a reconnect storm comes back over time
+    if manager.draining:
+        reason, after_ms = "draining", DRAIN_RECONNECT_MS + random.randint(0, DRAIN_JITTER_MS)
+    else:
+        reason, after_ms = "busy", int(admission.retry_after() * 1000) + random.randint(0, WS_ADMIT_JITTER_MS)
+    admission_rejected_total.inc(labels=(reason,))
+    await websocket.accept()
+    await websocket.send_text(encode_frame({"type": "reconnect", "reason": reason, "after_ms": after_ms}).text)
+    await websocket.close(code=1013)
+    return False
+
+def negotiate_encoding(websocket: WebSocket) -> Tuple[Optional[str], int]:
+    # JSON text unless the client offers the binary subprotocol; ?deflate=1..9 compresses large binary frames
+    protocol = negotiate(websocket.scope.get("subprotocols", []))
+    deflate = websocket.query_params.get("deflate", "0")
+    return protocol, min(int(deflate), 9) if deflate.isdigit() else 0
+
+# Client frames that cost next to nothing to handle and get at most a short reply; these do
+# not take from the connection's rate bucket
+UNMETERED_FRAMES = frozenset(("pong", "read", "presence_snapshot", "unsubscribe"))
+
+async def client_frames(websocket: WebSocket, connection: ClientConnection, user_id: str,
+                        max_frame_bytes: int, connection_bucket: TokenBucket):
+    # Parsed client frames that pass the size and rate checks; pongs are consumed here
+    rate_limited = False
+    while True:
+        frame = await websocket.receive()
+        if frame["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(frame.get("code", 1000))
+        connection.last_seen = time.monotonic()
+
+        # Size is checked on the raw frame, before any parsing
+        raw = frame.get("text")
+        if raw is None:
+            raw = frame.get("bytes") or b""
+        if len(raw) > max_frame_bytes or (
+                isinstance(raw, str) and len(raw) * 4 > max_frame_bytes
+                and len(raw.encode()) > max_frame_bytes):
+            ingress_rejected_total.inc(labels=("frame_too_large",))
+            await websocket.close(code=1009)
+            raise WebSocketDisconnect(1009)
+
+        try:
+            data = json.loads(raw) if isinstance(raw, str) else decode_client_frame(raw, max_frame_bytes)
+            kind = data.get("type")
+            if kind == "pong":
+                continue
+            metered = not isinstance(kind, str) or kind not in UNMETERED_FRAMES
+        except FrameTooLarge:
+            # The same limit applies to what a compressed frame inflates to
+            ingress_rejected_total.inc(labels=("frame_too_large",))
+            await websocket.close(code=1009)
+            raise WebSocketDisconnect(1009)
+        except (ValueError, TypeError, AttributeError):
+            data, kind, metered = None, None, True
+
+        if metered and not connection_bucket.take(time.monotonic()):
+            ingress_rejected_total.inc(labels=("connection_rate",))
+            retry_after_ms = int(connection_bucket.retry_after() * 1000)
+            if kind == "subscribe":
+                # A refused subscribe is always answered, so the client knows to retry that room
+                reply = {"type": "rate_limited", "retry_after_ms": retry_after_ms}
+                if isinstance(data.get("room_id"), str):
+                    reply["room_id"] = data["room_id"]
+                await manager.send_personal_message(reply, user_id)
+            elif not rate_limited:
+                # Once per burst of rejected messages, so a flood does not turn into a reply flood
+                rate_limited = True
+                await manager.send_personal_message({"type": "rate_limited", "retry_after_ms": retry_after_ms}, user_id)
+            continue
+        if metered:
+            rate_limited = False
+        if data is None:
+            await reject_malformed(user_id)
+            continue
+        yield data
+
+async def reject_malformed(user_id: str, room_id: Optional[str] = None):
+    ingress_rejected_total.inc(labels=("malformed",))
+    reply = {"type": "error", "reason": "malformed"}
+    if room_id is not None:
+        reply["room_id"] = room_id
+    await manager.send_personal_message(reply, user_id)
+
+def int_field(data: dict, key: str) -> int:
+    value = data[key]
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise TypeError(f"{key} must be an integer")
+    return value
+
+async def post_chat_message(user_id: str, username: str, room_id: str, text: str, tag_room: bool = False):
+    # Room limits, then sequence, broadcast and persist. tag_room adds room_id to rejections
+    # for multiplexed clients.
+    limits = ingress_limiter.limits_for(room_id)
+    tag = {"room_id": room_id} if tag_room else {}
+    if len(text) > limits.max_message_chars:
+        ingress_rejected_total.inc(labels=("message_too_long",))
+        await manager.send_personal_message(
+            {"type": "error", "reason": "message_too_long", "max_chars": limits.max_message_chars, **tag},
+            user_id
+        )
+        return
+    room_bucket = ingress_limiter.room_bucket(room_id)
+    if not room_bucket.take(time.monotonic()):
+        ingress_rejected_total.inc(labels=("room_rate",))
+        await manager.send_personal_message(
+            {"type": "rate_limited", "retry_after_ms": int(room_bucket.retry_after() * 1000), **tag},
+            user_id
+        )
+        return
+    messages_received_total.inc()
+    room_activity.message(room_id, user_id)
+
+    # Build the stored document once; the broadcast reuses its fields. In persist mode the
+    # room only sees it once stored, and the sender is told if storing it failed.
+    try:
+        chat_message = new_chat_message(user_id, username, room_id, await room_sequencer.allocate(room_id), text)
+        if PERSIST_ACK_MODE == 'persist':
+            await message_writer.add(chat_message, wait=True)
+    except Exception as e:
+        logger.error("Could not store a message for room %s: %s", room_id, e)
+        await manager.send_personal_message({"type": "error", "reason": "not_stored", **tag}, user_id)
+        return
+    event = message_event(chat_message)
+    read_tracker.message(room_id, chat_message["seq"], user_id)
+    recent_history.append(room_id, chat_message)
+    await manager.broadcast_to_room(room_id, event)
+    # Queued for the batched writer
+    if PERSIST_ACK_MODE != 'persist':
+        await message_writer.add(chat_message)
+
+def forget_empty_rooms(room_ids: List[str]):
+    for room_id in room_ids:
+        if not manager.registry.room(room_id):
+            ingress_limiter.forget(room_id)
+
 # WebSocket endpoint
 @app.websocket("/ws/{room_id}/{user_id}/{username}")
 async def websocket_endpoint(websocket: WebSocket, room_id: str, user_id: str, username: str):
-    await manager.connect(websocket, user_id, username, room_id)
+    if not shard_map.owns(room_id):
+        # Point the client at the shard that owns this room
+        await websocket.accept()
+        owner_url = shard_map.url_for(room_id)
+        if owner_url:
+            query = f"?{websocket.url.query}" if websocket.url.query else ""
+            await websocket.send_text(encode_frame({
+                "type": "redirect",
+                "url": f"{owner_url}{websocket.url.path}{query}",
+                "shard": shard_map.owner(room_id)
+            }).text)
+        await websocket.close(code=4001)
+        return
+
+    if not await admit(websocket):
+        return
+
+    protocol, deflate_level = negotiate_encoding(websocket)
+
+    # ?last_seq=N asks for every message after N before live traffic starts; ?resume=<token>
+    # (from a drain's reconnect hint) does the same for the seq the token carries
+    last_seq = websocket.query_params.get("last_seq")
+    resume = decode_resume_token(websocket.query_params.get("resume", ""))
+    if last_seq is None and resume is not None and resume[0] == room_id:
+        last_seq = str(resume[1])
+    await room_sequencer.ensure(room_id)
+    if last_seq is not None and last_seq.isdigit():
+        connection = await manager.connect(websocket, user_id, username, room_id, hold=True,
+                                           protocol=protocol, deflate_level=deflate_level)
+        # Anything newer than this is delivered live, so the replay stops here
+        upto = await room_sequencer.head(room_id)
+        missed = await load_missed_messages(room_id, int(last_seq), upto)
+        manager.release(user_id, [encode_frame(event) for event in missed])
+    else:
+        connection = await manager.connect(websocket, user_id, username, room_id,
+                                           protocol=protocol, deflate_level=deflate_level)
+    max_frame_bytes = ingress_limiter.limits_for(room_id).max_frame_bytes
+    connection_bucket = ingress_limiter.connection_bucket(room_id)
     try:
-        while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
-            
-            # Create message in database
-            chat_message = ChatMessage(
-                user_id=user_id,
-                username=username,
-                room_id=room_id,
-                message=message_data["message"],
-                message_type="chat"
-            )
-            
-            # Store in database
-            await db.chat_messages.insert_one(chat_message.dict())
-            
-            # Broadcast to room
-            await manager.broadcast_to_room(room_id, {
-                "type": "message",
-                "id": chat_message.id,
-                "user_id": user_id,
-                "username": username,
-                "message": message_data["message"],
-                "timestamp": chat_message.timestamp.isoformat(),
-                "user_count": manager.get_room_user_count(room_id)
-            })
-            
+        async for data in client_frames(websocket, connection, user_id, max_frame_bytes, connection_bucket):
+            try:
+                if data.get("type") == "presence_snapshot":
+                    await manager.send_personal_message(manager.presence_snapshot(room_id), user_id)
+                    continue
+                if data.get("type") == "read":
+                    read_tracker.mark_read(user_id, room_id, int_field(data, "seq"))
+                    continue
+                text = data["message"]
+                if not isinstance(text, str):
+                    raise TypeError("message must be a string")
+            except (ValueError, TypeError, KeyError, AttributeError):
+                await reject_malformed(user_id)
+                continue
+            await post_chat_message(user_id, username, room_id, text)
+
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Whatever ended the loop, so a failed handler cannot leave the user counted in the room
+        manager.disconnect(user_id, connection)
+        forget_empty_rooms([room_id])
+
+# Multiplexed endpoint: one socket for any number of rooms, joined and left with control frames
+#   {"type": "subscribe", "room_id": ..., "last_seq": N}   last_seq (or a drain's "resume" token) is optional
+#   {"type": "unsubscribe", "room_id": ...}
+#   {"type": "message" | "read" | "presence_snapshot", "room_id": ..., ...}
+# and every room event carries its room_id. Rooms owned by another shard are answered with a
+# {"type": "redirect", "room_id", "url"} pointing at that shard's multiplexed endpoint, and a
+# subscribe over the connection rate with {"type": "rate_limited", "room_id", "retry_after_ms"}.
+@app.websocket("/ws/{user_id}/{username}")
+async def multiplexed_endpoint(websocket: WebSocket, user_id: str, username: str):
+    if not await admit(websocket):
+        return
+
+    protocol, deflate_level = negotiate_encoding(websocket)
+    connection = await manager.connect(websocket, user_id, username, None,
+                                       protocol=protocol, deflate_level=deflate_level)
+    max_frame_bytes = ingress_limiter.defaults.max_frame_bytes
+    connection_bucket = ingress_limiter.connection_bucket(None)
+    try:
+        async for data in client_frames(websocket, connection, user_id, max_frame_bytes, connection_bucket):
+            room_id = data.get("room_id")
+            try:
+                if not isinstance(room_id, str):
+                    raise TypeError("room_id must be a string")
+                kind = data.get("type", "message")
+                if kind == "subscribe":
+                    await subscribe_room(websocket, connection, user_id, username, room_id, data)
+                    continue
+                if not manager.registry.joined(connection, room_id):
+                    await manager.send_personal_message(
+                        {"type": "error", "reason": "not_subscribed", "room_id": room_id}, user_id
+                    )
+                    continue
+                if kind == "unsubscribe":
+                    manager.unsubscribe(connection, room_id)
+                    forget_empty_rooms([room_id])
+                    await manager.send_personal_message({"type": "unsubscribed", "room_id": room_id}, user_id)
+                elif kind == "presence_snapshot":
+                    await manager.send_personal_message(manager.presence_snapshot(room_id), user_id)
+                elif kind == "read":
+                    read_tracker.mark_read(user_id, room_id, int_field(data, "seq"))
+                elif kind == "message":
+                    text = data["message"]
+                    if not isinstance(text, str):
+                        raise TypeError("message must be a string")
+                    await post_chat_message(user_id, username, room_id, text, tag_room=True)
+                else:
+                    raise ValueError(f"Unknown frame type: {kind}")
+            except (ValueError, TypeError, KeyError, AttributeError):
+                await reject_malformed(user_id, room_id if isinstance(room_id, str) else None)
+
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
-        await manager.broadcast_to_room(room_id, {
-            "type": "user_left",
-            "user_id": user_id,
-            "username": username,
-            "timestamp": datetime.utcnow().isoformat(),
-            "user_count": manager.get_room_user_count(room_id)
-        })
+        pass
+    finally:
+        room_ids = manager.registry.room_ids(connection)
+        manager.disconnect(user_id, connection)
+        forget_empty_rooms(room_ids)
+
+async def subscribe_room(websocket: WebSocket, connection: ClientConnection, user_id: str, username: str,
+                         room_id: str, data: dict):
+    if not shard_map.owns(room_id):
+        owner_url = shard_map.url_for(room_id)
+        reply = {"type": "redirect", "room_id": room_id, "shard": shard_map.owner(room_id)}
+        if owner_url:
+            reply["url"] = f"{owner_url}{websocket.url.path}"
+        await manager.send_personal_message(reply, user_id)
+        return
+    if manager.registry.joined(connection, room_id):
+        await manager.send_personal_message(subscribed_ack(room_id, room_sequencer.last(room_id)), user_id)
+        return
+    if len(connection.rooms) >= WS_MAX_SUBSCRIPTIONS:
+        await manager.send_personal_message(
+            {"type": "error", "reason": "too_many_rooms", "room_id": room_id, "max_rooms": WS_MAX_SUBSCRIPTIONS},
+            user_id
+        )
+        return
+
+    last_seq = int_field(data, "last_seq") if data.get("last_seq") is not None else None
+    resume = decode_resume_token(data.get("resume") or "")
+    if last_seq is None and resume is not None and resume[0] == room_id:
+        last_seq = resume[1]
+    await room_sequencer.ensure(room_id)
+    upto = await room_sequencer.head(room_id)
+    missed: List[dict] = []
+    if last_seq is not None:
+        missed = await load_missed_messages(room_id, last_seq, upto)
+        # Messages sent while storage was read; when they were all posted here they come
+        # from the ring buffer, without awaiting
+        while not connection.closed:
+            head = await room_sequencer.head(room_id)
+            if head <= upto:
+                break
+            caught_up, upto = upto, head
+            missed.extend(await load_missed_messages(room_id, caught_up, upto))
+    if connection.closed:
+        return
+    # Joined, acked and replayed in one step, so the replay ends where live delivery starts
+    manager.subscribe(connection, room_id, lambda: [
+        encode_frame(subscribed_ack(room_id, upto)), *(encode_frame(event) for event in missed)
+    ])
+
+def subscribed_ack(room_id: str, last_seq: int) -> dict:
+    return {
+        "type": "subscribed",
+        "room_id": room_id,
+        "last_seq": last_seq,
+        "user_count": manager.get_room_user_count(room_id)
+    }
+
+async def load_missed_messages(room_id: str, last_seq: int, upto: int) -> List[dict]:
+    if upto <= last_seq:
+        return []
+
+    events: List[dict] = []
+    first_seq = last_seq + 1
+    if upto - last_seq > RESUME_MAX_MESSAGES:
+        # Too far behind to replay; tell the client to refetch history instead
+        first_seq = upto - RESUME_MAX_MESSAGES + 1
+        events.append({"type": "history_gap", "room_id": room_id, "from_seq": last_seq + 1, "to_seq": first_seq - 1})
+
+    # Newest part from the ring buffer (which also covers messages not yet flushed), the rest
+    # from storage. Only the unbroken run of seqs ending at upto comes from the buffer, as it
+    # lacks anything posted through other workers.
+    buffered = sorted((m for m in recent_history.recent(room_id) if first_seq <= message_key(m) <= upto), key=message_key)
+    run = len(buffered)
+    while run and message_key(buffered[run - 1]) == upto - (len(buffered) - run):
+        run -= 1
+    buffered = buffered[run:]
+    covered_from = message_key(buffered[0]) if buffered else upto + 1
+    stored: List[dict] = []
+    if covered_from > first_seq:
+        stored = await storage.messages_by_seq(room_id, first_seq, covered_from, RESUME_MAX_MESSAGES)
+
+    events.extend(message_event(m) for m in stored + buffered)
+    return events
 
 # REST API endpoints
 @api_router.get("/")
 async def root():
     return {"message": "Lofi Chatroom API"}
 
+async def add_room(room: Room):
+    room_dict = room.dict()
+    await storage.insert_room(room_dict)
+    room_catalog.add(room_dict)
+    # Other workers pick it up through the backplane
+    manager.backplane.publish(LOBBY_CHANNEL, json.dumps({**room_dict, "created_at": room.created_at.isoformat()}))
+
 @api_router.post("/rooms", response_model=Room)
 async def create_room(room: RoomCreate):
     room_obj = Room(**room.dict())
-    await db.rooms.insert_one(room_obj.dict())
+    await add_room(room_obj)
     return room_obj
 
 @api_router.get("/rooms", response_model=List[Room])
-async def get_rooms():
-    rooms = await db.rooms.find().to_list(100)
-    room_list = []
-    for room in rooms:
-        room_obj = Room(**room)
-        room_obj.user_count = manager.get_room_user_count(room_obj.id)
-        room_list.append(room_obj)
-    return room_list
+async def get_rooms(request: Request, offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=500)):
+    # Served from the in-memory catalog; a matching If-None-Match gets a 304 without a body
+    body, etag = room_catalog.page(offset, limit)
+    total = len(room_catalog.order)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "X-Total-Count": str(total)}
+    if offset + limit < total:
+        headers["X-Next-Offset"] = str(offset + limit)
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+@api_router.get("/lobby/events")
+async def lobby_events():
+    # Server-sent events: throttled user-count changes and new rooms, or "resync" to refetch
+    queue = room_catalog.subscribe()
+
+    async def stream():
+        try:
+            yield f"data: {json.dumps({'type': 'hello', 'version': room_catalog.version})}\n\n"
+            while True:
+                try:
+                    text = await asyncio.wait_for(queue.get(), timeout=LOBBY_KEEPALIVE_S)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {text}\n\n"
+        finally:
+            room_catalog.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# Resume tokens name the room and the last seq queued to the client before it was drained
+def encode_resume_token(room_id: str, seq: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([room_id, seq]).encode()).decode()
+
+def decode_resume_token(token: str) -> Optional[Tuple[str, int]]:
+    try:
+        room_id, seq = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return str(room_id), max(0, int(seq))
+    except (ValueError, TypeError):
+        return None
+
+def require_admin(request: Request):
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+def reconnect_hint(connection: ClientConnection) -> dict:
+    # A multiplexed connection gets a resume token per subscribed room
+    tokens = {
+        room_id: encode_resume_token(room_id, room_sequencer.last(room_id))
+        for room_id in manager.registry.room_ids(connection)
+    }
+    return {
+        "type": "reconnect",
+        "reason": "draining",
+        "after_ms": DRAIN_RECONNECT_MS + random.randint(0, DRAIN_JITTER_MS),
+        "resume": tokens if connection.rooms is not None else next(iter(tokens.values()), None)
+    }
+
+def write_drain_state(state: dict):
+    os.makedirs(os.path.dirname(DRAIN_STATE_PATH), exist_ok=True)
+    with open(DRAIN_STATE_PATH + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(DRAIN_STATE_PATH + ".tmp", DRAIN_STATE_PATH)
+
+def read_drain_state() -> Optional[dict]:
+    try:
+        with open(DRAIN_STATE_PATH) as f:
+            state = json.load(f)
+        os.remove(DRAIN_STATE_PATH)
+    except (OSError, ValueError):
+        return None
+    return state if time.time() - state.get("saved_at", 0) <= DRAIN_STATE_MAX_AGE_S else None
+
+@api_router.post("/admin/drain")
+async def drain_server(request: Request):
+    require_admin(request)
+    if manager.draining:
+        raise HTTPException(status_code=409, detail="Already draining")
+    started = time.perf_counter()
+    manager.draining = True
+    presence = manager.presence_by_room()
+    # Messages waiting on storage (PERSIST_ACK_MODE=persist) go out before the hints
+    await message_writer.flush()
+    closed = await manager.drain(reconnect_hint, DRAIN_TIMEOUT_S)
+    await message_writer.flush()
+    await search_index.save()
+    await read_tracker.flush()
+    rooms = {room_id: {"seq": room_sequencer.last(room_id), "users": users} for room_id, users in presence.items()}
+    await asyncio.to_thread(write_drain_state, {"saved_at": time.time(), "rooms": rooms})
+    logger.info("Drained %d connections from %d rooms", closed, len(rooms))
+    return {"closed": closed, "rooms": len(rooms), "seconds": round(time.perf_counter() - started, 3)}
+
+@api_router.post("/admin/profile")
+async def profile_server(
+    request: Request,
+    seconds: float = Query(10, gt=0),
+    interval_ms: float = Query(10, ge=1, le=1000),
+    threads: str = Query("loop", pattern="^(loop|all)$")
+):
+    # Wall-clock stack samples of the event loop thread (or every thread) as collapsed
+    # stacks, ready for flamegraph.pl or speedscope
+    require_admin(request)
+    if seconds > PROFILE_MAX_S:
+        raise HTTPException(status_code=400, detail=f"seconds can be at most {PROFILE_MAX_S:g}")
+    try:
+        stacks = await stack_profiler.profile(seconds, interval_ms / 1000, all_threads=threads == "all")
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(stacks)
+
+@api_router.post("/admin/slow-callbacks")
+async def start_slow_callback_trace(
+    request: Request,
+    threshold_ms: float = Query(100, gt=0),
+    seconds: float = Query(60, gt=0)
+):
+    # Records every loop callback slower than threshold_ms, with the coroutine it stepped and
+    # the room it was working on, until `seconds` have passed or the trace is deleted
+    require_admin(request)
+    if seconds > SLOW_CALLBACK_MAX_S:
+        raise HTTPException(status_code=400, detail=f"seconds can be at most {SLOW_CALLBACK_MAX_S:g}")
+    try:
+        slow_callback_tracer.enable(threshold_ms / 1000, seconds)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return slow_callback_trace()
+
+@api_router.get("/admin/slow-callbacks")
+async def get_slow_callback_trace(request: Request):
+    require_admin(request)
+    return {**slow_callback_trace(), "records": list(slow_callback_tracer.records)}
+
+@api_router.delete("/admin/slow-callbacks")
+async def stop_slow_callback_trace(request: Request):
+    require_admin(request)
+    slow_callback_tracer.disable()
+    return slow_callback_trace()
+
+def slow_callback_trace() -> dict:
+    tracer = slow_callback_tracer
+    return {
+        "enabled": tracer.enabled,
+        "threshold_ms": tracer.threshold * 1000,
+        "enabled_until": tracer.enabled_until.isoformat() if tracer.enabled_until else None
+    }
+
+# History cursors are opaque seqs so paging stays on the (room_id, seq) index
+def encode_cursor(message: dict) -> str:
+    return base64.urlsafe_b64encode(str(message_key(message)).encode()).decode()
+
+def decode_cursor(cursor: str) -> HistoryKey:
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def serialize_message(message: dict) -> dict:
+    return {**message, "timestamp": message["timestamp"].isoformat()}
 
 @api_router.get("/rooms/{room_id}/messages")
-async def get_room_messages(room_id: str, limit: int = 50):
-    messages = await db.chat_messages.find(
-        {"room_id": room_id}
-    ).sort("timestamp", -1).limit(limit).to_list(limit)
-    
-    return sorted([ChatMessage(**msg) for msg in messages], key=lambda x: x.timestamp)
+async def get_room_messages(
+    room_id: str,
+    limit: int = Query(50, ge=1, le=500),
+    before: Optional[str] = None,
+    after: Optional[str] = None
+):
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+
+    started = time.perf_counter()
+    source = "cache"
+    cursor = before or after
+    position = decode_cursor(cursor) if cursor else None
+
+    # Serve from the in-memory buffer when the page falls entirely inside it
+    messages = None
+    if posted_here(room_id):
+        room = await recent_history.warm(room_id, lambda n: storage.read_messages(room_id, n))
+        messages = recent_history.query(
+            room, limit,
+            before=position if before else None,
+            after=position if after else None
+        )
+
+    if messages is None:
+        source = "storage"
+        messages = await storage.read_messages(
+            room_id, limit,
+            before=position if before else None,
+            after=position if after else None
+        )
+
+    headers = {}
+    if messages:
+        headers["X-Before-Cursor"] = encode_cursor(messages[0])
+        headers["X-After-Cursor"] = encode_cursor(messages[-1])
+    response = JSONResponse([serialize_message(msg) for msg in messages], headers=headers)
+    history_seconds.observe(time.perf_counter() - started, (source,))
+    return response
+
+@api_router.get("/rooms/{room_id}/search")
+async def search_room_messages(
+    room_id: str,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    before: Optional[int] = Query(None, ge=1)
+):
+    # Messages holding every word of q (the last one as a prefix), newest first. The
+    # X-Before-Cursor header is the `before` for the next page.
+    seqs = await search_index.search(room_id, q, before=before, limit=limit)
+    messages = await storage.messages_by_seqs(room_id, seqs) if seqs else []
+    messages.reverse()
+    headers = {}
+    if len(seqs) == limit:
+        headers["X-Before-Cursor"] = str(seqs[-1])
+    return JSONResponse([serialize_message(msg) for msg in messages], headers=headers)
+
+@api_router.get("/users/{user_id}/unread")
+async def get_unread_counts(user_id: str):
+    # Per room, {"unread", "last_read", "last_seq"}: every room in the catalog, plus any
+    # other the user has read in, from one marker query
+    return await read_tracker.unread(user_id, room_catalog.order)
+
+@api_router.get("/stats")
+async def get_stats(
+    resolution: str = Query("minute", pattern="^(minute|hour|day)$"),
+    window: int = Query(60, ge=1),
+    top: int = Query(10, ge=1, le=100),
+    room_id: Optional[str] = None
+):
+    # Messages, distinct senders and peak listeners per bucket, oldest first, and the
+    # busiest rooms over the window; served from the in-memory counters only
+    max_window = room_activity.max_window(resolution)
+    if window > max_window:
+        raise HTTPException(status_code=400, detail=f"window can be at most {max_window} at {resolution} resolution")
+    return room_activity.stats(resolution, window, top=top, room_id=room_id)
+
+@api_router.get("/metrics")
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 # Create default rooms
 @api_router.post("/init-default-rooms")
@@ -206,10 +1450,9 @@ async def init_default_rooms():
     ]
     
     for room_data in default_rooms:
-        existing = await db.rooms.find_one({"name": room_data["name"]})
+        existing = await storage.find_room_by_name(room_data["name"])
         if not existing:
-            room = Room(**room_data)
-            await db.rooms.insert_one(room.dict())
+            await add_room(Room(**room_data))
     
     return {"message": "Default rooms initialized"}
 
@@ -222,15 +1465,98 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Before-Cursor", "X-After-Cursor", "ETag", "X-Total-Count", "X-Next-Offset"],
 )
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+@app.on_event("startup")
+async def start_storage():
+    await storage.start()
+
+@app.on_event("startup")
+async def start_search_index():
+    await search_index.start()
+
+@app.on_event("startup")
+async def load_room_catalog():
+    room_catalog.load(await storage.list_rooms())
+
+@app.on_event("startup")
+async def start_message_writer():
+    message_writer.start()
+
+@app.on_event("startup")
+async def start_loop_lag_sampler():
+    loop_lag_sampler.start()
+
+@app.on_event("startup")
+async def start_idle_reaper():
+    manager.start_reaper()
+
+@app.on_event("startup")
+async def start_read_tracker():
+    await read_tracker.start()
+
+@app.on_event("startup")
+async def start_room_activity():
+    await room_activity.start()
+
+@app.on_event("startup")
+async def start_retention_job():
+    retention_job.start()
+
+async def warm_rooms(rooms: Dict[str, dict]):
+    # Busiest rooms first, one at a time, so warming does not become its own storm. Rooms
+    # another shard owns now (the shard count changed) are left to that shard.
+    owned = [room_id for room_id in rooms if shard_map.owns(room_id)]
+    for room_id in sorted(owned, key=lambda r: len(rooms[r]["users"]), reverse=True):
+        try:
+            await room_sequencer.ensure(room_id)
+            if posted_here(room_id):
+                await recent_history.warm(room_id, lambda n, room_id=room_id: storage.read_messages(room_id, n))
+        except Exception as e:
+            logger.warning("Could not warm room %s: %s", room_id, e)
+
+@app.on_event("startup")
+async def load_drain_state():
+    # Left by the previous process's drain; its clients are about to come back
+    state = await asyncio.to_thread(read_drain_state)
+    if state and state["rooms"]:
+        logger.info("Warming %d rooms from the drain state", len(state["rooms"]))
+        asyncio.create_task(warm_rooms(state["rooms"]))
+
+def deliver_from_backplane(room_id: str, text: str, coalesce_key: Optional[str] = None):
+    if room_id == LOBBY_CHANNEL:
+        room = json.loads(text)
+        room["created_at"] = datetime.fromisoformat(room["created_at"])
+        room_catalog.add(room)
+    elif room_sequencer.allocator is not None:
+        # Other workers number this room's messages too: keep the local head (behind resume
+        # tokens and acks for rooms with members here) up with what was delivered
+        event = json.loads(text)
+        room_sequencer.observe(room_id, newest_seq(event))
+        manager.deliver_remote(room_id, text, coalesce_key, event)
+    else:
+        manager.deliver_remote(room_id, text, coalesce_key)
+
+def newest_seq(event: dict) -> int:
+    if event.get("type") == "batch":
+        return max((newest_seq(e) for e in event["events"]), default=0)
+    return (event.get("seq") or 0) if event.get("type") == "message" else 0
+
+@app.on_event("startup")
+async def start_backplane():
+    await manager.backplane.start(deliver_from_backplane)
+    manager.backplane.subscribe(LOBBY_CHANNEL)
 
 @app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+async def shutdown_storage():
+    await retention_job.close()
+    await message_writer.close()
+    await search_index.close()
+    await read_tracker.close()
+    await room_activity.close()
+    await manager.backplane.close()
+    await loop_lag_sampler.stop()
+    slow_callback_tracer.disable()
+    await manager.stop_reaper()
+    await storage.close()
@@ -0,0 +1,55 @@
+import fcntl
+import os
+import zlib
+from typing import List, Optional
+
+# Held for the life of the process; see claim_directory
+_directory_locks: List[int] = []
+
+
+def shard_for_room(room_id: str, shard_count: int) -> int:
+    # crc32 rather than hash() so every process agrees regardless of PYTHONHASHSEED
+    return zlib.crc32(room_id.encode()) % shard_count
+
+
+# Which rooms this process owns when running as one of K room shards
+class ShardMap:
+    def __init__(self, index: int = 0, count: int = 1, urls: Optional[List[str]] = None):
+        if not 0 <= index < count:
+            raise ValueError(f"Shard index {index} out of range for {count} shards")
+        self.index = index
+        self.count = count
+        self.urls = urls or []
+
+    @property
+    def enabled(self) -> bool:
+        return self.count > 1
+
+    def owner(self, room_id: str) -> int:
+        return shard_for_room(room_id, self.count) if self.enabled else 0
+
+    def owns(self, room_id: str) -> bool:
+        return self.owner(room_id) == self.index
+
+    def url_for(self, room_id: str) -> Optional[str]:
+        owner = self.owner(room_id)
+        return self.urls[owner] if owner < len(self.urls) else None
+
+
+def claim_directory(path: str, prefix: str) -> str:
+    # The first of <path>/<prefix>-0, -1, ... that no other process holds, for files only
+    # one process may write when several share `path`. It stays this process's (an flock
+    # on a file inside) until it exits, so a restarted worker takes over one left free.
+    index = 0
+    while True:
+        directory = os.path.join(path, f"{prefix}-{index}")
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(os.path.join(directory, ".lock"), os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            index += 1
+            continue
+        _directory_locks.append(fd)
+        return directory
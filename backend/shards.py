@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Run the chat server as K room shards, one uvicorn process per shard.
+Rooms are hashed onto shards; sockets that land on the wrong shard are
+redirected, and user counts are aggregated over the unix backplane.
+
+    python shards.py --shards 4 --base-port 8001
+
+With ADMIN_TOKEN set, stopping drains every shard first (POST /api/admin/drain),
+so clients are told when to reconnect instead of all dropping at once.
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent
+
+
+def drain(port):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/api/admin/drain",
+        method="POST",
+        headers={"X-Admin-Token": os.environ["ADMIN_TOKEN"]}
+    )
+    timeout = float(os.environ.get("DRAIN_TIMEOUT_S", "10")) + 30
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            print(f"Drained shard on port {port}: {response.read().decode()}")
+    except OSError as e:
+        print(f"Could not drain shard on port {port}: {e}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run room-sharded chat server processes")
+    parser.add_argument("--shards", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--base-port", type=int, default=8001)
+    parser.add_argument("--public-urls", default="",
+                        help="Comma-separated ws(s):// base URL per shard; defaults to ws://<host>:<port>")
+    args = parser.parse_args()
+    if args.shards > 1 and os.environ.get("STORAGE", "mongo") != "mongo":
+        parser.error("STORAGE=log keeps its log in one process; run shards with STORAGE=mongo")
+
+    ports = [args.base_port + i for i in range(args.shards)]
+    urls = args.public_urls or ",".join(f"ws://{args.host}:{port}" for port in ports)
+
+    processes = []
+    for index, port in enumerate(ports):
+        env = dict(
+            os.environ,
+            SHARD_COUNT=str(args.shards),
+            SHARD_INDEX=str(index),
+            SHARD_URLS=urls,
+            BACKPLANE=os.environ.get("BACKPLANE", "unix")
+        )
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--host", args.host, "--port", str(port)],
+            cwd=ROOT_DIR,
+            env=env
+        ))
+
+    def stop(signum, frame):
+        if os.environ.get("ADMIN_TOKEN"):
+            with ThreadPoolExecutor(len(ports)) as pool:
+                list(pool.map(drain, ports))
+        for process in processes:
+            process.send_signal(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    sys.exit(max(process.wait() for process in processes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from history import HistoryKey, message_key
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_start(timestamp: datetime, bucket_seconds: float) -> datetime:
+    return timestamp - (timestamp - EPOCH) % timedelta(seconds=bucket_seconds)
+
+
+# Everything the server persists: rooms, chat messages and ranged history reads.
+# Message reads return chronological lists of plain dicts (no _id) with datetime timestamps.
+class Storage:
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def insert_room(self, room: dict):
+        raise NotImplementedError
+
+    async def find_room_by_name(self, name: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def list_rooms(self, limit: Optional[int] = None) -> List[dict]:
+        raise NotImplementedError
+
+    async def append_messages(self, docs: List[dict], batch_id: Optional[int] = None):
+        # Must be safe to retry: a retry passes the same docs and batch_id after a failure,
+        # and whatever of the batch was already stored must not be stored twice
+        raise NotImplementedError
+
+    async def last_seq(self, room_id: str) -> int:
+        raise NotImplementedError
+
+    async def next_seq(self, room_id: str) -> int:
+        # Atomically takes the room's next seq, for several processes numbering the same room.
+        # Backends only one process can open have no need for it.
+        raise NotImplementedError
+
+    async def current_seq(self, room_id: str) -> int:
+        # The last seq next_seq handed out, which may not be stored yet
+        raise NotImplementedError
+
+    async def read_messages(self, room_id: str, limit: int,
+                            before: Optional[HistoryKey] = None, after: Optional[HistoryKey] = None) -> List[dict]:
+        # Latest `limit` messages, or the page just before/after a cursor position
+        raise NotImplementedError
+
+    async def messages_by_seq(self, room_id: str, first_seq: int, end_seq: int, limit: int) -> List[dict]:
+        # Messages with first_seq <= seq < end_seq, in seq order
+        raise NotImplementedError
+
+    async def messages_by_seqs(self, room_id: str, seqs: List[int]) -> List[dict]:
+        # Messages with any of the given seqs, in seq order
+        found = []
+        for seq in sorted(seqs):
+            found.extend(await self.messages_by_seq(room_id, seq, seq + 1, 1))
+        return found
+
+    async def archive_messages(self, room_id: str, end_seq: int, older_than: Optional[datetime],
+                               bucket_seconds: float, limit: int) -> int:
+        # Moves up to `limit` of the oldest hot messages with seq < end_seq or timestamp < older_than
+        # into time buckets, returning how many moved. Reads keep paging into the buckets.
+        # Backends whose storage is already cold past the newest file have nothing to move.
+        return 0
+
+    async def expire_messages(self, room_id: str, older_than: datetime) -> Tuple[int, int]:
+        # Deletes messages older than older_than. Returns how many went and the seq below
+        # which nothing is left (0 when nothing was deleted).
+        raise NotImplementedError
+
+    async def save_read_markers(self, markers: List[Tuple[str, str, int]]):
+        # (user_id, room_id, seq) triples; a stored marker only ever moves forward
+        raise NotImplementedError
+
+    async def read_markers(self, user_id: str) -> Dict[str, int]:
+        # room_id -> last read seq
+        raise NotImplementedError
+
+    async def save_room_heads(self, heads: Dict[str, int]):
+        # room_id -> highest seq sent; like markers, only ever moves forward
+        raise NotImplementedError
+
+    async def room_heads(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+
+# Archived messages live in chat_archive documents per (room, time bucket, part). A bucket
+# rolls over to a new part every archive_bucket_messages messages, keeping documents far
+# below Mongo's 16 MB limit, and reads take only the messages they need out of each part.
+class MongoStorage(Storage):
+    def __init__(self, client, db_name: str, archive_bucket_messages: int = 1000):
+        self.client = client
+        self.db = client[db_name]
+        self.archive_bucket_messages = archive_bucket_messages
+
+    async def start(self):
+        try:
+            await self.db.chat_messages.create_index(
+                [("room_id", 1), ("timestamp", 1), ("id", 1)],
+                name="room_history"
+            )
+            await self.db.chat_messages.create_index([("room_id", 1), ("seq", 1)], name="room_seq")
+            await self.db.chat_archive.create_index(
+                [("room_id", 1), ("start", 1), ("part", 1)], name="room_bucket_part", unique=True
+            )
+            await self.db.chat_archive.create_index([("room_id", 1), ("last_timestamp", 1)], name="room_bucket_end")
+            await self.db.chat_archive.create_index([("room_id", 1), ("last_seq", 1)], name="room_bucket_seq")
+            await self.db.read_markers.create_index([("user_id", 1), ("room_id", 1)], name="user_room", unique=True)
+            await self.db.room_heads.create_index([("room_id", 1)], name="room", unique=True)
+            await self.db.room_sequences.create_index([("room_id", 1)], name="room", unique=True)
+        except Exception as e:
+            logger.warning("Could not create chat_messages indexes: %s", e)
+        await self._number_unsequenced()
+
+    async def _number_unsequenced(self):
+        # Messages stored before seqs existed are numbered once, in timestamp order, just
+        # below each room's first numbered message (so possibly at or below 0), since
+        # history is paged by seq alone. The newest go first: a run that is interrupted, or
+        # one running in two workers at once, picks up with exactly the same numbers.
+        rooms = await self.db.chat_messages.distinct("room_id", {"seq": {"$exists": False}})
+        for room_id in rooms:
+            first = await self.db.chat_messages.find_one(
+                {"room_id": room_id, "seq": {"$exists": True}}, {"seq": 1}, sort=[("seq", 1)]
+            )
+            archived = await self.db.chat_archive.find_one(
+                {"room_id": room_id}, {"first_seq": 1}, sort=[("first_seq", 1)]
+            )
+            docs = await self.db.chat_messages.find(
+                {"room_id": room_id, "seq": {"$exists": False}}, {"_id": 1}
+            ).sort([("timestamp", -1), ("id", -1)]).to_list(None)
+            top = len(docs) + 1
+            if first is not None or archived is not None:
+                top = min(doc[key] for doc, key in ((first, "seq"), (archived, "first_seq")) if doc is not None)
+            await self.db.chat_messages.bulk_write([
+                UpdateOne({"_id": doc["_id"], "seq": {"$exists": False}}, {"$set": {"seq": top - 1 - i}})
+                for i, doc in enumerate(docs)
+            ], ordered=True)
+            await self.db.room_sequences.update_one(
+                {"room_id": room_id}, {"$max": {"seq": await self.last_seq(room_id)}}, upsert=True
+            )
+            logger.info("Numbered %d messages stored before seqs in room %s", len(docs), room_id)
+
+    async def close(self):
+        self.client.close()
+
+    async def insert_room(self, room: dict):
+        await self.db.rooms.insert_one(dict(room))
+
+    async def find_room_by_name(self, name: str) -> Optional[dict]:
+        return await self.db.rooms.find_one({"name": name}, {"_id": 0})
+
+    async def list_rooms(self, limit: Optional[int] = None) -> List[dict]:
+        return await self.db.rooms.find({}, {"_id": 0}).to_list(limit)
+
+    async def append_messages(self, docs: List[dict], batch_id: Optional[int] = None):
+        try:
+            await self.db.chat_messages.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # insert_many assigns _id in place, so a retried batch reports the
+            # documents that already made it as duplicates
+            write_errors = e.details.get("writeErrors", [])
+            if not all(err.get("code") == DUPLICATE_KEY for err in write_errors):
+                raise
+
+    async def last_seq(self, room_id: str) -> int:
+        latest = await self.db.chat_messages.find_one(
+            {"room_id": room_id, "seq": {"$exists": True}},
+            {"seq": 1},
+            sort=[("seq", -1)]
+        )
+        if latest is None:
+            # Everything may have been archived
+            latest = await self.db.chat_archive.find_one({"room_id": room_id}, {"last_seq": 1}, sort=[("last_seq", -1)])
+            return latest["last_seq"] if latest else 0
+        return latest["seq"]
+
+    async def next_seq(self, room_id: str) -> int:
+        counter = await self.db.room_sequences.find_one_and_update(
+            {"room_id": room_id},
+            {"$inc": {"seq": 1}},
+            projection={"_id": 0, "seq": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if counter is not None:
+            return counter["seq"]
+        # First seq taken through the counter: start it from what is already stored
+        try:
+            await self.db.room_sequences.insert_one({"room_id": room_id, "seq": await self.last_seq(room_id)})
+        except DuplicateKeyError:
+            # Another worker started it first
+            pass
+        return await self.next_seq(room_id)
+
+    async def current_seq(self, room_id: str) -> int:
+        counter = await self.db.room_sequences.find_one({"room_id": room_id}, {"_id": 0, "seq": 1})
+        return counter["seq"] if counter is not None else await self.last_seq(room_id)
+
+    async def read_messages(self, room_id: str, limit: int,
+                            before: Optional[HistoryKey] = None, after: Optional[HistoryKey] = None) -> List[dict]:
+        # Hot messages first; a page that runs past the oldest of them continues into the archive
+        if after is not None:
+            # Only look in the archive when some bucket ends after the cursor
+            if await self.db.chat_archive.find_one({"room_id": room_id, "last_seq": {"$gt": after}}, {"_id": 1}):
+                archived = await self._archived_after(room_id, after, limit)
+                if len(archived) == limit:
+                    return archived
+                hot = await self._read_hot(room_id, limit, after=after)
+                return self._merge(archived, hot)[:limit]
+            return await self._read_hot(room_id, limit, after=after)
+
+        hot = await self._read_hot(room_id, limit, before=before)
+        if len(hot) == limit:
+            return hot
+        oldest = message_key(hot[0]) if hot else before
+        archived = await self._archived_before(room_id, oldest, limit - len(hot))
+        return self._merge(archived, hot)[-limit:]
+
+    @staticmethod
+    def _merge(older: List[dict], newer: List[dict]) -> List[dict]:
+        # A message archived just before a crash can still be hot too
+        ids: Set[str] = {m["id"] for m in newer}
+        return [m for m in older if m["id"] not in ids] + newer
+
+    def _bucket_messages(self, query: dict, direction: int, cond: Optional[dict] = None, count: Optional[int] = None):
+        # Archive parts matching query in seq order (direction 1) or reverse, each with only its
+        # messages passing cond, and at most `count` of those from the end read first
+        messages = "$messages" if cond is None else {"$filter": {"input": "$messages", "cond": cond}}
+        if count is not None:
+            messages = {"$slice": [messages, count if direction == 1 else -count]}
+        return self.db.chat_archive.aggregate([
+            {"$match": query},
+            {"$sort": {"last_seq": direction}},
+            {"$project": {"_id": 0, "messages": messages}}
+        ])
+
+    async def _archived_before(self, room_id: str, position: Optional[HistoryKey], limit: int) -> List[dict]:
+        query: dict = {"room_id": room_id}
+        cond = None
+        if position is not None:
+            query["first_seq"] = {"$lt": position}
+            cond = {"$lt": ["$$this.seq", position]}
+        chunks: List[List[dict]] = []
+        count = 0
+        async for bucket in self._bucket_messages(query, -1, cond, limit):
+            chunks.append(bucket["messages"])
+            count += len(bucket["messages"])
+            if count >= limit:
+                break
+        found = [m for chunk in reversed(chunks) for m in chunk]
+        return found[-limit:]
+
+    async def _archived_after(self, room_id: str, position: HistoryKey, limit: int) -> List[dict]:
+        query = {"room_id": room_id, "last_seq": {"$gt": position}}
+        found: List[dict] = []
+        async for bucket in self._bucket_messages(query, 1, {"$gt": ["$$this.seq", position]}, limit):
+            found.extend(bucket["messages"])
+            if len(found) >= limit:
+                break
+        return found[:limit]
+
+    async def _archived_seqs(self, room_id: str, first_seq: int, last_seq: int, wanted, limit: int) -> List[dict]:
+        # Archived messages with first_seq <= seq <= last_seq that pass `wanted`, in seq order
+        query = {"room_id": room_id, "last_seq": {"$gte": first_seq}, "first_seq": {"$lte": last_seq}}
+        cond = {"$and": [{"$gte": ["$$this.seq", first_seq]}, {"$lte": ["$$this.seq", last_seq]}]}
+        found: List[dict] = []
+        async for bucket in self._bucket_messages(query, 1, cond):
+            found.extend(m for m in bucket["messages"] if wanted(m["seq"]))
+            if len(found) >= limit:
+                break
+        return found[:limit]
+
+    async def _read_hot(self, room_id: str, limit: int,
+                        before: Optional[HistoryKey] = None, after: Optional[HistoryKey] = None) -> List[dict]:
+        query: dict = {"room_id": room_id}
+        direction = -1  # newest first, flipped back to chronological below
+        if before is not None:
+            query["seq"] = {"$lt": before}
+        elif after is not None:
+            query["seq"] = {"$gt": after}
+            direction = 1
+
+        messages = await self.db.chat_messages.find(query, {"_id": 0}).sort(
+            "seq", direction
+        ).limit(limit).to_list(limit)
+        if direction == -1:
+            messages.reverse()
+        return messages
+
+    async def messages_by_seq(self, room_id: str, first_seq: int, end_seq: int, limit: int) -> List[dict]:
+        hot = await self.db.chat_messages.find(
+            {"room_id": room_id, "seq": {"$gte": first_seq, "$lt": end_seq}},
+            {"_id": 0}
+        ).sort("seq", 1).to_list(limit)
+        if hot and hot[0]["seq"] == first_seq:
+            return hot
+        end = hot[0]["seq"] if hot else end_seq
+        archived = await self._archived_seqs(room_id, first_seq, end - 1, lambda seq: first_seq <= seq < end, limit)
+        return self._merge(archived, hot)[:limit]
+
+    async def messages_by_seqs(self, room_id: str, seqs: List[int]) -> List[dict]:
+        hot = await self.db.chat_messages.find(
+            {"room_id": room_id, "seq": {"$in": list(seqs)}},
+            {"_id": 0}
+        ).sort("seq", 1).to_list(len(seqs))
+        missing = set(seqs) - {m["seq"] for m in hot}
+        if not missing:
+            return hot
+        archived = await self._archived_seqs(room_id, min(missing), max(missing), missing.__contains__, len(missing))
+        return sorted(self._merge(archived, hot), key=lambda m: m["seq"])
+
+    async def archive_messages(self, room_id: str, end_seq: int, older_than: Optional[datetime],
+                               bucket_seconds: float, limit: int) -> int:
+        docs = await self.db.chat_messages.find(
+            {"room_id": room_id, "seq": {"$exists": True}}, {"_id": 0}
+        ).sort("seq", 1).to_list(limit)
+        moving: List[dict] = []
+        for doc in docs:
+            if doc["seq"] >= end_seq and (older_than is None or doc["timestamp"] >= older_than):
+                break
+            moving.append(doc)
+        if not moving:
+            return 0
+
+        buckets: Dict[datetime, List[dict]] = {}
+        for doc in moving:
+            buckets.setdefault(bucket_start(doc["timestamp"], bucket_seconds), []).append(doc)
+        for start, messages in buckets.items():
+            await self._archive_bucket(room_id, start, messages)
+        # Only deleted once every bucket has them, so a failed run is simply repeated
+        await self.db.chat_messages.delete_many({"room_id": room_id, "seq": {"$lte": moving[-1]["seq"]}})
+        return len(moving)
+
+    async def _archive_bucket(self, room_id: str, start: datetime, messages: List[dict]):
+        latest = await self.db.chat_archive.find_one(
+            {"room_id": room_id, "start": start}, {"part": 1, "count": 1, "last_seq": 1}, sort=[("part", -1)]
+        )
+        part, count = 0, 0
+        if latest is not None:
+            # Skip whatever an interrupted run already moved
+            messages = [m for m in messages if m["seq"] > latest["last_seq"]]
+            part, count = latest["part"], latest["count"]
+        while messages:
+            if count >= self.archive_bucket_messages:
+                part, count = part + 1, 0
+            chunk = messages[:self.archive_bucket_messages - count]
+            messages = messages[len(chunk):]
+            await self.db.chat_archive.update_one(
+                {"room_id": room_id, "start": start, "part": part},
+                {
+                    "$push": {"messages": {"$each": chunk}},
+                    "$inc": {"count": len(chunk)},
+                    "$set": {"last_seq": chunk[-1]["seq"], "last_timestamp": chunk[-1]["timestamp"]},
+                    "$setOnInsert": {"first_seq": chunk[0]["seq"], "first_timestamp": chunk[0]["timestamp"]}
+                },
+                upsert=True
+            )
+            count += len(chunk)
+
+    async def expire_messages(self, room_id: str, older_than: datetime) -> Tuple[int, int]:
+        end_seq = 0
+        newest = await self.db.chat_messages.find_one(
+            {"room_id": room_id, "timestamp": {"$lt": older_than}, "seq": {"$exists": True}},
+            {"seq": 1},
+            sort=[("seq", -1)]
+        )
+        if newest is not None:
+            end_seq = newest["seq"] + 1
+        result = await self.db.chat_messages.delete_many({"room_id": room_id, "timestamp": {"$lt": older_than}})
+        expired = result.deleted_count
+
+        # Buckets go whole, once their newest message is past the cutoff
+        bucket_query = {"room_id": room_id, "last_timestamp": {"$lt": older_than}}
+        async for bucket in self.db.chat_archive.find(bucket_query, {"count": 1, "last_seq": 1}):
+            expired += bucket["count"]
+            end_seq = max(end_seq, bucket["last_seq"] + 1)
+        if end_seq:
+            await self.db.chat_archive.delete_many(bucket_query)
+        return expired, end_seq
+
+    async def save_read_markers(self, markers: List[Tuple[str, str, int]]):
+        await self.db.read_markers.bulk_write([
+            UpdateOne({"user_id": user_id, "room_id": room_id}, {"$max": {"seq": seq}}, upsert=True)
+            for user_id, room_id, seq in markers
+        ], ordered=False)
+
+    async def read_markers(self, user_id: str) -> Dict[str, int]:
+        docs = await self.db.read_markers.find({"user_id": user_id}, {"_id": 0, "room_id": 1, "seq": 1}).to_list(None)
+        return {doc["room_id"]: doc["seq"] for doc in docs}
+
+    async def save_room_heads(self, heads: Dict[str, int]):
+        await self.db.room_heads.bulk_write([
+            UpdateOne({"room_id": room_id}, {"$max": {"seq": seq}}, upsert=True)
+            for room_id, seq in heads.items()
+        ], ordered=False)
+
+    async def room_heads(self) -> Dict[str, int]:
+        docs = await self.db.room_heads.find({}, {"_id": 0}).to_list(None)
+        return {doc["room_id"]: doc["seq"] for doc in docs}
+
+
+def create_storage(kind: str, mongo_url: str = '', db_name: str = '', path: str = '',
+                   segment_bytes: int = 8 * 1024 * 1024, fsync_interval: float = 0.0,
+                   archive_bucket_messages: int = 1000) -> Storage:
+    if kind == 'mongo':
+        # "mongomock://" swaps in an in-process stand-in for benchmarks
+        if mongo_url.startswith('mongomock://'):
+            from mongomock_motor import AsyncMongoMockClient
+            return MongoStorage(AsyncMongoMockClient(), db_name, archive_bucket_messages)
+        from motor.motor_asyncio import AsyncIOMotorClient
+        return MongoStorage(AsyncIOMotorClient(mongo_url), db_name, archive_bucket_messages)
+    if kind == 'log':
+        from logstore import LogStorage
+        return LogStorage(path, segment_bytes=segment_bytes, fsync_interval=fsync_interval)
+    raise ValueError(f"Unknown storage: {kind}")
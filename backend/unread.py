@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, Optional
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+markers_flushed_total = Counter("chat_read_markers_flushed_total", "Read markers written to storage")
+
+Markers = Dict[str, Dict[str, int]]  # user_id -> room_id -> last read seq
+
+
+# Per-user read markers and per-room heads (the highest seq sent). Unread for a room is
+# head - marker. Heads advance in memory as messages go out and markers as clients report
+# what they have read; both are coalesced and written back every flush_interval. Both
+# only ever move forward, so batches can be merged and retried in any order. Heads from
+# other workers come in with a reload from storage every refresh_interval. Messages below a
+# room's floor (reported by retention) are gone and never count as unread.
+class ReadTracker:
+    def __init__(self, storage, flush_interval: float = 1.0, refresh_interval: float = 30.0):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self.heads: Dict[str, int] = {}
+        self.floors: Dict[str, int] = {}
+        self.pending_markers: Markers = {}
+        self.pending_heads: Dict[str, int] = {}
+        # The batch being written, still counted by unread() until storage has it
+        self._flushing: Markers = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._merge_heads(await self.storage.room_heads())
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def message(self, room_id: str, seq: int, user_id: str):
+        if seq > self.heads.get(room_id, 0):
+            self.heads[room_id] = seq
+            self.pending_heads[room_id] = seq
+        # Sending a message means having read the room up to it
+        self.mark_read(user_id, room_id, seq)
+
+    def expired(self, room_id: str, end_seq: int):
+        # Nothing below end_seq is left in the room
+        if end_seq > self.floors.get(room_id, 0):
+            self.floors[room_id] = end_seq
+
+    def mark_read(self, user_id: str, room_id: str, seq: int):
+        head = self.heads.get(room_id)
+        if head is not None:
+            seq = min(seq, head)
+        rooms = self.pending_markers.setdefault(user_id, {})
+        if seq > rooms.get(room_id, 0):
+            rooms[room_id] = seq
+
+    async def unread(self, user_id: str, room_ids: Iterable[str] = ()) -> Dict[str, dict]:
+        # Every room the user has a marker in, and every one of room_ids: last read seq
+        # (0 without a marker), room head and the number of messages after the marker
+        markers = await self.storage.read_markers(user_id)
+        for pending in (self._flushing, self.pending_markers):
+            for room_id, seq in pending.get(user_id, {}).items():
+                if seq > markers.get(room_id, 0):
+                    markers[room_id] = seq
+        for room_id in room_ids:
+            markers.setdefault(room_id, 0)
+        missing = [room_id for room_id in markers if room_id not in self.heads]
+        # Rooms without a recorded head yet (quiet since before heads were kept)
+        for room_id, seq in zip(missing, await asyncio.gather(*map(self.storage.last_seq, missing))):
+            self.heads.setdefault(room_id, seq)
+        return {
+            room_id: {
+                "last_read": seq,
+                "last_seq": self.heads[room_id],
+                "unread": max(0, self.heads[room_id] - max(seq, self.floors.get(room_id, 1) - 1))
+            }
+            for room_id, seq in markers.items()
+        }
+
+    async def flush(self):
+        markers, self.pending_markers = self.pending_markers, {}
+        heads, self.pending_heads = self.pending_heads, {}
+        self._flushing = markers
+        try:
+            if markers:
+                batch = [(user_id, room_id, seq) for user_id, rooms in markers.items() for room_id, seq in rooms.items()]
+                await self.storage.save_read_markers(batch)
+                markers_flushed_total.inc(len(batch))
+            if heads:
+                await self.storage.save_room_heads(heads)
+        except Exception as e:
+            # Merged back under anything newer that came in meanwhile, for the next flush
+            logger.error("Could not save read markers: %s", e)
+            for user_id, rooms in markers.items():
+                for room_id, seq in rooms.items():
+                    self.mark_read(user_id, room_id, seq)
+            for room_id, seq in heads.items():
+                if seq > self.pending_heads.get(room_id, 0):
+                    self.pending_heads[room_id] = seq
+        finally:
+            self._flushing = {}
+
+    def _merge_heads(self, heads: Dict[str, int]):
+        for room_id, seq in heads.items():
+            if seq > self.heads.get(room_id, 0):
+                self.heads[room_id] = seq
+
+    async def _run(self):
+        refreshed = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() - refreshed >= self.refresh_interval:
+                refreshed = time.monotonic()
+                try:
+                    self._merge_heads(await self.storage.room_heads())
+                except Exception as e:
+                    logger.error("Could not reload room heads: %s", e)
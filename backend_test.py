@@ -208,11 +208,11 @@ class BackendTester:
         try:
             # Connect first user
             async with websockets.connect(ws_url_1) as ws1:
-                # Wait for join notification
+                # Wait for join notification (presence deltas are debounced server-side)
                 join_msg = await asyncio.wait_for(ws1.recv(), timeout=5.0)
                 join_data = json.loads(join_msg)
                 
-                if join_data.get("type") == "user_joined":
+                if join_data.get("type") == "presence" and [user_id_1, username_1] in join_data.get("joined", []):
                     self.log_test("WebSocket User Join", True, f"User join notification received")
                     
                     # Connect second user
@@ -222,7 +222,7 @@ class BackendTester:
                             second_join_msg = await asyncio.wait_for(ws1.recv(), timeout=5.0)
                             second_join_data = json.loads(second_join_msg)
                             
-                            if second_join_data.get("type") == "user_joined" and second_join_data.get("username") == username_2:
+                            if second_join_data.get("type") == "presence" and [user_id_2, username_2] in second_join_data.get("joined", []):
                                 self.log_test("WebSocket Multi-User Join", True, "Multi-user join notifications working")
                                 return True
                             else:
@@ -233,7 +233,7 @@ class BackendTester:
                             self.log_test("WebSocket Multi-User Join", False, "Timeout waiting for second user join notification")
                             return False
                 else:
-                    self.log_test("WebSocket User Join", False, f"Expected user_joined, got: {join_data}")
+                    self.log_test("WebSocket User Join", False, f"Expected presence delta, got: {join_data}")
                     return False
                     
         except Exception as e:
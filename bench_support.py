@@ -0,0 +1,15 @@
+"""
+Shared pieces for the benchmark scripts in this directory
+"""
+
+
+# Stands in for a Starlette WebSocket so ConnectionManager can be driven without a network
+class NullWebSocket:
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data):
+        pass
+
+    async def close(self, code=1000):
+        pass
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Broadcast micro-benchmark
+Compares per-recipient json.dumps against encode-once room broadcasts
+"""
+
+import asyncio
+import json
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+
+from bench_support import NullWebSocket  # noqa: E402
+from server import ConnectionManager  # noqa: E402
+
+RECIPIENTS = [10, 100, 1000]
+MESSAGES = 200
+
+
+def sample_message(i):
+    return {
+        "type": "message",
+        "id": f"msg-{i}",
+        "user_id": "user_bench",
+        "username": "bench",
+        "message": "just vibing to the rain sounds tonight 🌧️",
+        "timestamp": datetime.utcnow().isoformat(),
+        "user_count": 0
+    }
+
+
+async def per_recipient_broadcast(manager, room_id, message):
+    # The previous behaviour: one json.dumps per recipient
+    for connection in list(manager.registry.room(room_id)):
+        await manager.send_personal_message(message, manager.registry.user_id(connection))
+
+
+async def drain(manager):
+    while any(c.pending for c in manager.registry):
+        await asyncio.sleep(0)
+
+
+class EncodeCounter:
+    # Wraps json.dumps to count how many bytes are serialized per broadcast
+    def __init__(self):
+        self.dumps = json.dumps
+        self.bytes = 0
+
+    def __call__(self, *args, **kwargs):
+        encoded = self.dumps(*args, **kwargs)
+        self.bytes += len(encoded)
+        return encoded
+
+
+async def measure(label, recipients, run):
+    start = time.process_time()
+    for i in range(MESSAGES):
+        await run(sample_message(i))
+    cpu = time.process_time() - start
+
+    # Allocation pass, separate so tracemalloc does not skew the CPU numbers
+    counter = EncodeCounter()
+    json.dumps = counter
+    tracemalloc.start()
+    peaks = 0
+    for i in range(MESSAGES):
+        message = sample_message(i)
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        await run(message)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks += peak - before
+    tracemalloc.stop()
+    json.dumps = counter.dumps
+
+    print(f"{label:<14} {recipients:>5} recipients: "
+          f"{cpu / MESSAGES * 1e6:>9.1f} µs/msg  "
+          f"{counter.bytes / MESSAGES:>9.0f} encoded bytes/msg  "
+          f"{peaks / MESSAGES:>9.0f} peak alloc bytes/msg")
+
+
+async def main():
+    print(f"Broadcasting {MESSAGES} messages per run\n")
+    for recipients in RECIPIENTS:
+        manager = ConnectionManager()
+        for i in range(recipients):
+            await manager.connect(NullWebSocket(), f"user_{i}", f"user_{i}", "bench")
+        await drain(manager)
+
+        async def run_per_recipient(message):
+            await per_recipient_broadcast(manager, "bench", message)
+            await drain(manager)
+
+        async def run_encode_once(message):
+            await manager.broadcast_to_room("bench", message)
+            await drain(manager)
+
+        await measure("per-recipient", recipients, run_per_recipient)
+        await measure("encode-once", recipients, run_encode_once)
+
+        for i in range(recipients):
+            manager.disconnect(f"user_{i}")
+        print()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Connection memory benchmark
+Measures the bytes each idle connection costs the server, comparing the registry
+layout against the previous one (four dicts plus a per-room set, and a connection
+holding a deque, an Event, a set and a parked writer task from the moment it joins)
+
+    python connection_memory_benchmark.py --connections 10000 100000
+
+Connections are spread over rooms of --room-size listeners. The websocket objects
+and id strings exist in both layouts, so they are created before measuring.
+"""
+
+import argparse
+import asyncio
+import gc
+import sys
+import tracemalloc
+from collections import deque
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+
+from bench_support import NullWebSocket  # noqa: E402
+from server import ClientConnection, ConnectionManager  # noqa: E402
+
+
+# What each connection used to hold before the registry
+class LegacyConnection:
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.max_queue = 256
+        self.policy = "drop_oldest"
+        self.binary = False
+        self.deflate_level = 0
+        self.known_refs = set()
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+        self.writer = None
+
+    def start(self):
+        self.writer = asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        while not self.closed:
+            await self.ready.wait()
+            while self.queue:
+                self.queue.popleft()
+            self.ready.clear()
+
+
+class LegacyManager:
+    def __init__(self):
+        self.active_connections = {}
+        self.user_rooms = {}
+        self.room_users = {}
+        self.usernames = {}
+
+    def connect(self, websocket, user_id, username, room_id):
+        connection = LegacyConnection(websocket)
+        connection.start()
+        self.active_connections[user_id] = connection
+        self.user_rooms[user_id] = room_id
+        self.room_users.setdefault(room_id, set()).add(user_id)
+        self.usernames[user_id] = username
+
+    def close(self):
+        for connection in self.active_connections.values():
+            connection.writer.cancel()
+
+
+class RegistryManager:
+    # The state ConnectionManager.connect keeps per connection, without the join broadcast
+    def __init__(self):
+        self.manager = ConnectionManager()
+
+    def connect(self, websocket, user_id, username, room_id):
+        manager = self.manager
+        connection = ClientConnection(websocket, username)
+        manager.registry.add(connection, user_id, room_id)
+        connection.start(manager._drop_connection)
+        manager.idle_wheel.schedule(connection, connection.last_seen + manager.idle_timeout)
+
+    def close(self):
+        for connection in self.manager.registry:
+            connection.stop()
+
+
+async def measure(layout, count, room_size):
+    ids = [f"user_{i}" for i in range(count)]
+    names = [f"listener{i}" for i in range(count)]
+    rooms = [f"room_{i // room_size}" for i in range(count)]
+    sockets = [NullWebSocket() for _ in range(count)]
+
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    manager = layout()
+    for i in range(count):
+        manager.connect(sockets[i], ids[i], names[i], rooms[i])
+    # Let every writer task that was started run up to its first await
+    await asyncio.sleep(0)
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    manager.close()
+    await asyncio.sleep(0)
+    return (after - before) / count
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Per-connection memory benchmark")
+    parser.add_argument("--connections", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--room-size", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"Idle connections in rooms of {args.room_size}\n")
+    for count in args.connections:
+        legacy = await measure(LegacyManager, count, args.room_size)
+        registry = await measure(RegistryManager, count, args.room_size)
+        print(f"{count:>7} connections:  legacy {legacy:>7.0f} B/conn   registry {registry:>7.0f} B/conn   "
+              f"saved {1 - registry / legacy:>6.1%}   ({(legacy - registry) * count / 2 ** 20:.1f} MiB)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
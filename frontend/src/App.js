@@ -4,6 +4,8 @@ import './App.css';
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 const WS_URL = BACKEND_URL.replace('https://', 'wss://').replace('http://', 'ws://');
+// Rooms kept subscribed on the multiplexed socket, so switching back to them is instant
+const MAX_SUBSCRIBED_ROOMS = 5;
 
 // Lofi music tracks (royalty-free)
 const LOFI_TRACKS = [
@@ -20,9 +22,17 @@ function App() {
   const [messages, setMessages] = useState([]);
   const [newMessage, setNewMessage] = useState('');
   const [username, setUsername] = useState('');
-  const [userId] = useState(() => 'user_' + Math.random().toString(36).substr(2, 9));
+  // Kept across visits so read markers and unread counts follow the user
+  const [userId] = useState(() => {
+    const saved = localStorage.getItem('userId');
+    if (saved) return saved;
+    const id = 'user_' + Math.random().toString(36).substr(2, 9);
+    localStorage.setItem('userId', id);
+    return id;
+  });
   const [isConnected, setIsConnected] = useState(false);
   const [userCount, setUserCount] = useState(0);
+  const [unread, setUnread] = useState({});
   
   // Music state
   const [isPlaying, setIsPlaying] = useState(false);
@@ -30,16 +40,69 @@ function App() {
   const [volume, setVolume] = useState(0.3);
   
   // Refs
-  const ws = useRef(null);
+  // One multiplexed socket per server URL (more than one only when rooms live on other shards)
+  const sockets = useRef({});
+  // Rooms subscribed to, least recently opened first: room id -> { url, lastSeq, messages, userCount }
+  const subscriptions = useRef({});
+  const currentRoomId = useRef(null);
+  const pendingReads = useRef({ seqs: {}, timer: null });
   const audioRef = useRef(null);
   const messagesEndRef = useRef(null);
 
   // Initialize default rooms
   useEffect(() => {
-    initializeRooms();
-    fetchRooms();
+    initializeRooms().then(fetchRooms);
   }, []);
 
+  // Room user counts and new rooms are pushed by the server instead of polled
+  useEffect(() => {
+    const lobby = new EventSource(`${API}/lobby/events`);
+    lobby.onmessage = (event) => {
+      const data = JSON.parse(event.data);
+      if (data.type === 'lobby') {
+        setRooms(prev => {
+          const known = new Set(prev.map(room => room.id));
+          return [
+            ...prev.map(room => room.id in data.counts ? { ...room, user_count: data.counts[room.id] } : room),
+            ...data.rooms.filter(room => !known.has(room.id))
+          ];
+        });
+      } else if (data.type === 'resync') {
+        fetchRooms();
+      }
+    };
+    return () => lobby.close();
+  }, []);
+
+  // Unread counts for every room, in one request
+  const fetchUnread = async () => {
+    try {
+      const response = await fetch(`${API}/users/${userId}/unread`);
+      setUnread(await response.json());
+    } catch (error) {
+      console.error('Error fetching unread counts:', error);
+    }
+  };
+
+  useEffect(() => {
+    fetchUnread();
+    const timer = setInterval(fetchUnread, 15000);
+    return () => clearInterval(timer);
+  }, [currentRoom]);
+
+  // Tells the server how far rooms have been read, at most once a second
+  const reportRead = (roomId, seq) => {
+    const reads = pendingReads.current;
+    reads.seqs[roomId] = Math.max(reads.seqs[roomId] || 0, seq);
+    if (reads.timer) return;
+    reads.timer = setTimeout(() => {
+      const seqs = reads.seqs;
+      reads.seqs = {};
+      reads.timer = null;
+      Object.entries(seqs).forEach(([id, read]) => send(id, { type: 'read', seq: read }));
+    }, 1000);
+  };
+
   // Auto-scroll to bottom of messages
   useEffect(() => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
@@ -55,51 +118,126 @@ function App() {
 
   const fetchRooms = async () => {
     try {
-      const response = await fetch(`${API}/rooms`);
-      const roomData = await response.json();
+      // Paged; the browser revalidates each page with its ETag
+      const roomData = [];
+      let offset = 0;
+      while (offset != null) {
+        const response = await fetch(`${API}/rooms?offset=${offset}&limit=100`);
+        roomData.push(...await response.json());
+        const next = response.headers.get('X-Next-Offset');
+        offset = next != null ? Number(next) : null;
+      }
       setRooms(roomData);
     } catch (error) {
       console.error('Error fetching rooms:', error);
     }
   };
 
-  const connectToRoom = async (room) => {
-    if (!username.trim()) {
-      alert('Please enter a username first!');
-      return;
-    }
+  const muxUrl = () => `${WS_URL}/ws/${userId}/${encodeURIComponent(username)}`;
 
-    // Disconnect from current room
-    if (ws.current) {
-      ws.current.close();
+  // Sends a frame about one room over the socket that room is subscribed on
+  const send = (roomId, frame) => {
+    const sub = subscriptions.current[roomId];
+    const socket = sub && sockets.current[sub.url];
+    if (socket && socket.readyState === WebSocket.OPEN) {
+      socket.send(JSON.stringify({ ...frame, room_id: roomId }));
+      return true;
     }
+    return false;
+  };
 
-    setCurrentRoom(room);
-    setMessages([]);
+  const subscribe = (roomId, resume) => {
+    const sub = subscriptions.current[roomId];
+    const frame = { type: 'subscribe' };
+    if (sub.lastSeq != null) frame.last_seq = sub.lastSeq;
+    else if (resume) frame.resume = resume;
+    if (!send(roomId, frame)) openSocket(sub.url);
+  };
+
+  // Appends to a room's messages, showing them if it is the open room
+  const addMessages = (roomId, items) => {
+    const sub = subscriptions.current[roomId];
+    if (!sub || items.length === 0) return;
+    sub.messages = [...sub.messages, ...items];
+    if (roomId === currentRoomId.current) setMessages(sub.messages);
+  };
+
+  const systemMessage = (message, timestamp, i = 0) => ({
+    id: `system_${Date.now()}_${i}`,
+    username: 'System',
+    message,
+    timestamp: timestamp || new Date().toISOString(),
+    message_type: 'system'
+  });
 
-    // Fetch recent messages
+  const fetchHistory = async (roomId) => {
     try {
-      const response = await fetch(`${API}/rooms/${room.id}/messages`);
+      const response = await fetch(`${API}/rooms/${roomId}/messages`);
       const messageData = await response.json();
-      setMessages(messageData);
+      const sub = subscriptions.current[roomId];
+      if (!sub) return;
+      sub.messages = messageData;
+      const seqs = messageData.map(m => m.seq).filter(seq => seq != null);
+      sub.lastSeq = seqs.length ? Math.max(...seqs) : 0;
+      if (roomId === currentRoomId.current) {
+        setMessages(sub.messages);
+        if (sub.lastSeq) reportRead(roomId, sub.lastSeq);
+      }
     } catch (error) {
       console.error('Error fetching messages:', error);
     }
+  };
 
-    // Connect WebSocket
-    const wsUrl = `${WS_URL}/ws/${room.id}/${userId}/${encodeURIComponent(username)}`;
-    ws.current = new WebSocket(wsUrl);
+  // resume: room id -> token, from a drain's reconnect hint
+  const openSocket = (url, resume = {}) => {
+    const existing = sockets.current[url];
+    if (existing && existing.readyState <= WebSocket.OPEN) return;
+    const socket = new WebSocket(url);
+    sockets.current[url] = socket;
+    let reconnectHint = null;
 
-    ws.current.onopen = () => {
+    const roomsOnSocket = () => Object.keys(subscriptions.current).filter(id => subscriptions.current[id].url === url);
+
+    socket.onopen = () => {
       setIsConnected(true);
-      console.log('Connected to room:', room.name);
+      // (Re)subscribe every room this socket carries, resuming from the last seq seen
+      roomsOnSocket().forEach(id => subscribe(id, resume[id]));
     };
 
-    ws.current.onmessage = (event) => {
-      const data = JSON.parse(event.data);
-      
-      if (data.type === 'message') {
-        setMessages(prev => [...prev, {
+    const handleEvent = (data) => {
+      const roomId = data.room_id;
+      const sub = roomId != null ? subscriptions.current[roomId] : null;
+      // Left over from a room already unsubscribed
+      if (roomId != null && !sub) return;
+      if (data.type === 'ping') {
+        // Heartbeat from the idle reaper
+        socket.send(JSON.stringify({ type: 'pong' }));
+      } else if (data.type === 'batch') {
+        // Busy rooms deliver several events per frame
+        data.events.forEach(handleEvent);
+      } else if (data.type === 'reconnect') {
+        // The server is restarting or busy; it closes the socket and says when to come back
+        reconnectHint = data;
+      } else if (data.type === 'redirect') {
+        // The room lives on another shard; subscribe to it over that shard's socket
+        if (data.url) {
+          sub.url = data.url;
+          subscribe(roomId);
+        }
+      } else if (data.type === 'subscribed') {
+        sub.userCount = data.user_count;
+        if (roomId === currentRoomId.current) setUserCount(data.user_count);
+      } else if (data.type === 'message') {
+        if (data.seq != null) {
+          // Workers sharing a room can deliver seqs slightly out of order, so only a
+          // message already shown (replayed on resume) is dropped
+          if (sub.lastSeq != null && data.seq <= sub.lastSeq && sub.messages.some(m => m.id === data.id)) {
+            return;
+          }
+          sub.lastSeq = Math.max(sub.lastSeq || 0, data.seq);
+          if (roomId === currentRoomId.current) reportRead(roomId, data.seq);
+        }
+        addMessages(roomId, [{
           id: data.id,
           user_id: data.user_id,
           username: data.username,
@@ -107,45 +245,112 @@ function App() {
           timestamp: data.timestamp,
           message_type: 'chat'
         }]);
-        setUserCount(data.user_count);
-      } else if (data.type === 'user_joined') {
-        setMessages(prev => [...prev, {
-          id: 'system_' + Date.now(),
-          username: 'System',
-          message: `${data.username} joined the room`,
-          timestamp: data.timestamp,
-          message_type: 'system'
-        }]);
-        setUserCount(data.user_count);
-      } else if (data.type === 'user_left') {
-        setMessages(prev => [...prev, {
-          id: 'system_' + Date.now(),
-          username: 'System',
-          message: `${data.username} left the room`,
-          timestamp: data.timestamp,
-          message_type: 'system'
-        }]);
-        setUserCount(data.user_count);
+        sub.userCount = data.user_count;
+        if (roomId === currentRoomId.current) {
+          setUserCount(data.user_count);
+        } else {
+          setUnread(prev => ({ ...prev, [roomId]: { ...prev[roomId], unread: (prev[roomId]?.unread || 0) + 1 } }));
+        }
+      } else if (data.type === 'history_gap') {
+        fetchHistory(roomId);
+      } else if (data.type === 'presence') {
+        // Joins and leaves arrive as one delta per window
+        const describe = (users, verb) => {
+          if (users.length === 0) return null;
+          const names = users.map(([, name]) => name);
+          return names.length <= 3
+            ? `${names.join(', ')} ${verb} the room`
+            : `${names.length} people ${verb} the room`;
+        };
+        const notices = [describe(data.joined, 'joined'), describe(data.left, 'left')].filter(Boolean);
+        addMessages(roomId, notices.map((notice, i) => systemMessage(notice, data.timestamp, i)));
+        sub.userCount = data.user_count;
+        if (roomId === currentRoomId.current) setUserCount(data.user_count);
+      } else if (data.type === 'presence_snapshot') {
+        sub.userCount = data.user_count;
+        if (roomId === currentRoomId.current) setUserCount(data.user_count);
+      } else if (data.type === 'rate_limited' || data.type === 'error') {
+        const notice = data.type === 'rate_limited'
+          ? 'Slow down a little, your messages are being dropped'
+          : data.reason === 'message_too_long'
+            ? `Messages can be at most ${data.max_chars} characters`
+            : 'That message could not be sent';
+        addMessages(roomId ?? currentRoomId.current, [systemMessage(notice)]);
       }
     };
 
-    ws.current.onclose = () => {
+    socket.onmessage = (event) => {
+      handleEvent(JSON.parse(event.data));
+    };
+
+    socket.onclose = (event) => {
+      if (socket !== sockets.current[url]) return;
       setIsConnected(false);
-      console.log('Disconnected from room');
+      console.log('Disconnected from', url);
+      if (event.code === 4409) {
+        // The same user connected from another tab, which now gets the messages
+        addMessages(currentRoomId.current, [systemMessage('Chat moved to another tab; open a room to bring it back here')]);
+        return;
+      }
+      if (reconnectHint) {
+        setTimeout(() => {
+          if (socket === sockets.current[url] && roomsOnSocket().length) {
+            openSocket(url, typeof reconnectHint.resume === 'object' ? reconnectHint.resume : {});
+          }
+        }, reconnectHint.after_ms);
+      }
     };
 
-    ws.current.onerror = (error) => {
+    socket.onerror = (error) => {
+      if (socket !== sockets.current[url]) return;
       console.error('WebSocket error:', error);
       setIsConnected(false);
     };
   };
 
+  const connectToRoom = async (room) => {
+    if (!username.trim()) {
+      alert('Please enter a username first!');
+      return;
+    }
+
+    setCurrentRoom(room);
+    currentRoomId.current = room.id;
+    setUnread(prev => {
+      const { [room.id]: _, ...rest } = prev;
+      return rest;
+    });
+
+    const subs = subscriptions.current;
+    const sub = subs[room.id];
+    if (sub) {
+      // Still subscribed: switching is instant, and it moves to the back of the eviction order
+      delete subs[room.id];
+      subs[room.id] = sub;
+      setMessages(sub.messages);
+      setUserCount(sub.userCount);
+      if (sub.lastSeq) reportRead(room.id, sub.lastSeq);
+      return;
+    }
+
+    // Rooms opened longest ago are unsubscribed to stay under the limit
+    const subscribed = Object.keys(subs);
+    subscribed.slice(0, Math.max(0, subscribed.length - MAX_SUBSCRIBED_ROOMS + 1)).forEach(id => {
+      send(id, { type: 'unsubscribe' });
+      delete subs[id];
+    });
+
+    subs[room.id] = { url: muxUrl(), lastSeq: null, messages: [], userCount: 0 };
+    setMessages([]);
+    setUserCount(0);
+    // History first, then subscribe asking for anything sent since
+    await fetchHistory(room.id);
+    subscribe(room.id);
+  };
+
   const sendMessage = (e) => {
     e.preventDefault();
-    if (newMessage.trim() && ws.current && ws.current.readyState === WebSocket.OPEN) {
-      ws.current.send(JSON.stringify({
-        message: newMessage.trim()
-      }));
+    if (newMessage.trim() && currentRoom && send(currentRoom.id, { type: 'message', message: newMessage.trim() })) {
       setNewMessage('');
     }
   };
@@ -281,7 +486,14 @@ function App() {
                   >
                     <div className="font-medium text-gray-800">{room.name}</div>
                     <div className="text-xs text-gray-500 mt-1">{room.description}</div>
-                    <div className="text-xs text-purple-600 mt-1">{room.user_count || 0} users</div>
+                    <div className="flex items-center justify-between mt-1">
+                      <div className="text-xs text-purple-600">{room.user_count || 0} users</div>
+                      {currentRoom?.id !== room.id && unread[room.id]?.unread > 0 && (
+                        <span className="text-xs font-semibold text-white bg-purple-600 rounded-full px-2">
+                          {unread[room.id].unread > 99 ? '99+' : unread[room.id].unread}
+                        </span>
+                      )}
+                    </div>
                   </button>
                 ))}
               </div>
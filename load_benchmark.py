@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Load generation and latency benchmark for the chat server
+Drives R rooms x U users at a given message rate and reports throughput plus
+delivery, join and history-fetch latency percentiles as JSON
+
+    python load_benchmark.py --rooms 4 --users 25 --rate 5 --duration 10 --output results.json
+
+Without --url the server is started on localhost against an in-process Mongo
+stand-in (MONGO_URL=mongomock://), so no database is needed; both come from
+backend/requirements-dev.txt. Per-room rates above the server's ingress limits, or
+more joins at once than its admission burst, need e.g.
+--server-env WS_ROOM_RATE=0 WS_ADMIT_RATE=0.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+import websockets
+
+BACKEND_DIR = Path(__file__).parent / 'backend'
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 3)
+
+    return {
+        "count": len(ordered),
+        "p50_ms": pick(50),
+        "p95_ms": pick(95),
+        "p99_ms": pick(99),
+        "max_ms": round(ordered[-1], 3)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_local_server(port, extra_env):
+    env = dict(os.environ, MONGO_URL="mongomock://", DB_NAME="load_benchmark", **extra_env)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR,
+        env=env
+    )
+    async with httpx.AsyncClient() as http:
+        for _ in range(100):
+            try:
+                await http.get(f"http://127.0.0.1:{port}/api/")
+                return process
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Server did not start")
+
+
+class Stats:
+    def __init__(self):
+        self.delivery = []
+        self.join = []
+        self.history = []
+        self.sent = 0
+        self.delivered = 0
+        self.errors = 0
+        self.recording = False
+
+
+def handle_event(event, stats):
+    if event.get("type") == "batch":
+        for inner in event["events"]:
+            handle_event(inner, stats)
+    elif event.get("type") == "message":
+        # Senders put their monotonic clock in the text; everything runs in this process
+        parts = event.get("message", "").split(" ")
+        if len(parts) == 2 and parts[0] == "bench" and stats.recording:
+            stats.delivery.append((time.monotonic_ns() - int(parts[1])) / 1e6)
+            stats.delivered += 1
+
+
+async def run_user(http, base_url, ws_url, room_id, index, stats, sockets, ready):
+    user_id = f"bench_{room_id}_{index}"
+    try:
+        start = time.perf_counter()
+        response = await http.get(f"{base_url}/api/rooms/{room_id}/messages")
+        response.raise_for_status()
+        stats.history.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        async with websockets.connect(f"{ws_url}/ws/{room_id}/{user_id}/{user_id}", max_size=None) as ws:
+            stats.join.append((time.perf_counter() - start) * 1000)
+            sockets.setdefault(room_id, []).append(ws)
+            ready.release()
+            async for raw in ws:
+                event = json.loads(raw)
+                if event.get("type") == "ping":
+                    # Idle listeners are reaped unless they answer the heartbeat
+                    await ws.send(json.dumps({"type": "pong"}))
+                else:
+                    handle_event(event, stats)
+    except (OSError, websockets.ConnectionClosed, httpx.HTTPError):
+        stats.errors += 1
+        ready.release()
+
+
+async def run_room_sender(room_id, rate, sockets, stats, stop):
+    interval = 1 / rate
+    while not stop.is_set():
+        members = sockets.get(room_id)
+        if members:
+            ws = random.choice(members)
+            try:
+                await ws.send(json.dumps({"message": f"bench {time.monotonic_ns()}"}))
+                if stats.recording:
+                    stats.sent += 1
+            except websockets.ConnectionClosed:
+                stats.errors += 1
+        await asyncio.sleep(interval)
+
+
+async def run(args):
+    process = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        port = free_port()
+        extra_env = dict(item.split("=", 1) for item in args.server_env)
+        process = await start_local_server(port, extra_env)
+        base_url = f"http://127.0.0.1:{port}"
+    ws_url = base_url.replace("https://", "wss://").replace("http://", "ws://")
+
+    stats = Stats()
+    sockets = {}
+    rooms = [f"bench-room-{i}" for i in range(args.rooms)]
+    ready = asyncio.Semaphore(0)
+    http = httpx.AsyncClient(limits=httpx.Limits(max_connections=args.rooms * args.users))
+    try:
+        users = [
+            asyncio.create_task(run_user(http, base_url, ws_url, room_id, i, stats, sockets, ready))
+            for room_id in rooms for i in range(args.users)
+        ]
+        for _ in users:
+            await ready.acquire()
+
+        stop = asyncio.Event()
+        senders = [asyncio.create_task(run_room_sender(room_id, args.rate, sockets, stats, stop)) for room_id in rooms]
+        await asyncio.sleep(args.warmup)
+        stats.recording = True
+        start = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        stop.set()
+        elapsed = time.perf_counter() - start
+        await asyncio.gather(*senders)
+        # Let in-flight deliveries land before closing
+        await asyncio.sleep(1.0)
+        stats.recording = False
+
+        for members in sockets.values():
+            for ws in members:
+                await ws.close()
+        await asyncio.gather(*users, return_exceptions=True)
+    finally:
+        await http.aclose()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    return {
+        "timestamp": datetime.utcnow().isoformat(),
+        "commit": git_commit(),
+        "config": {
+            "rooms": args.rooms,
+            "users_per_room": args.users,
+            "rate_per_room": args.rate,
+            "duration_s": args.duration,
+            "target": args.url or "local",
+            "server_env": args.server_env
+        },
+        "throughput": {
+            "messages_per_s": round(stats.sent / elapsed, 2),
+            "deliveries_per_s": round(stats.delivered / elapsed, 2),
+            "expected_deliveries": stats.sent * args.users,
+            "delivered": stats.delivered,
+            "errors": stats.errors
+        },
+        "latency": {
+            "delivery": percentiles(stats.delivery),
+            "join": percentiles(stats.join),
+            "history": percentiles(stats.history)
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server load and latency benchmark")
+    parser.add_argument("--url", help="Benchmark a running server instead of starting one, e.g. http://localhost:8001")
+    parser.add_argument("--rooms", type=int, default=4)
+    parser.add_argument("--users", type=int, default=25, help="Users per room")
+    parser.add_argument("--rate", type=float, default=5, help="Messages per second per room")
+    parser.add_argument("--duration", type=float, default=10, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=1, help="Unmeasured seconds before recording")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment for the local server, e.g. ROOM_BATCH_MODE=auto")
+    parser.add_argument("--output", help="Write the JSON result here as well as to stdout")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
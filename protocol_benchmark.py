@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Wire protocol benchmark
+Compares bytes and encode CPU per broadcast for JSON text and the msgpack subprotocol
+"""
+
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+
+from protocol import Frame  # noqa: E402
+
+ITERATIONS = 5000
+USERS = [(f"user_{uuid.uuid4().hex[:9]}", f"listener{i}") for i in range(50)]
+
+
+def chat_event(i):
+    user_id, username = USERS[i % len(USERS)]
+    return {
+        "type": "message",
+        "id": str(uuid.uuid4()),
+        "seq": 1000 + i,
+        "user_id": user_id,
+        "username": username,
+        "message": "anyone else studying to this playlist tonight?",
+        "timestamp": datetime.utcnow().isoformat(),
+        "user_count": 412
+    }
+
+
+def presence_event(i):
+    return {
+        "type": "presence",
+        "joined": [list(user) for user in USERS[:20]],
+        "left": [list(user) for user in USERS[20:25]],
+        "user_count": 412,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+
+def batch_event(i):
+    return {"type": "batch", "events": [chat_event(i + n) for n in range(20)]}
+
+
+ENCODINGS = [
+    ("json", lambda frame: frame.text.encode()),
+    ("msgpack", lambda frame: frame.binary()),
+    ("msgpack+deflate6", lambda frame: frame.binary(deflate_level=6)),
+]
+
+
+def main():
+    print(f"{ITERATIONS} broadcasts per case; bytes are what one recipient receives "
+          f"(excluding the one-off user ref definitions)\n")
+    for name, make_event in [("chat message", chat_event), ("presence delta", presence_event), ("batch of 20", batch_event)]:
+        events = [make_event(i) for i in range(ITERATIONS)]
+        for label, encode in ENCODINGS:
+            size = 0
+            start = time.process_time()
+            for event in events:
+                size += len(encode(Frame(event)))
+            cpu = time.process_time() - start
+            print(f"{name:<15} {label:<17} {size / ITERATIONS:>8.0f} bytes  {cpu / ITERATIONS * 1e6:>8.1f} µs/broadcast")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Search index benchmark
+Indexes a room of synthetic chat messages (Zipf-distributed vocabulary), then times
+single-term, multi-term and prefix queries plus a snapshot save and reload
+
+    python search_benchmark.py --messages 1000000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from itertools import accumulate
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+
+from search import RoomIndex, SearchIndex, tokenize  # noqa: E402
+
+VOCABULARY = 50000
+WORDS_PER_MESSAGE = (3, 15)
+QUERIES = 200
+ROOM_ID = "bench-room"
+
+
+def make_vocabulary(rng):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < VOCABULARY:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return sorted(words, key=lambda w: rng.random())
+
+
+def make_messages(count, words, rng):
+    cumulative = list(accumulate(1 / (rank + 1) for rank in range(len(words))))
+    for seq in range(1, count + 1):
+        yield seq, " ".join(rng.choices(words, cum_weights=cumulative, k=rng.randint(*WORDS_PER_MESSAGE)))
+
+
+def time_queries(index, queries, limit=20):
+    samples = []
+    for query in queries:
+        terms = tokenize(query)
+        start = time.perf_counter()
+        index.search(terms, None, limit)
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Search index benchmark")
+    parser.add_argument("--messages", type=int, default=1000000)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    words = make_vocabulary(rng)
+    index = RoomIndex()
+    start = time.perf_counter()
+    for seq, text in make_messages(args.messages, words, rng):
+        index.add(seq, text)
+    elapsed = time.perf_counter() - start
+    print(f"Indexed {args.messages} messages in {elapsed:.1f}s ({args.messages / elapsed:.0f} msgs/s), "
+          f"{len(index.terms)} terms\n")
+
+    common, mid, rare = words[:50], words[500:5000], words[20000:]
+    cases = {
+        "common term": [rng.choice(common) for _ in range(QUERIES)],
+        "rare term": [rng.choice(rare) for _ in range(QUERIES)],
+        "common + mid": [f"{rng.choice(common)} {rng.choice(mid)}" for _ in range(QUERIES)],
+        "mid + mid": [f"{rng.choice(mid)} {rng.choice(mid)}" for _ in range(QUERIES)],
+        "prefix (3 chars)": [rng.choice(mid)[:3] for _ in range(QUERIES)],
+        "term + prefix": [f"{rng.choice(common)} {rng.choice(mid)[:4]}" for _ in range(QUERIES)],
+    }
+    for label, queries in cases.items():
+        median, p99 = time_queries(index, queries)
+        print(f"{label:<18} median {median:>7.3f} ms   p99 {p99:>7.3f} ms")
+
+    with tempfile.TemporaryDirectory() as path:
+        search = SearchIndex(None, path)
+        index.ready = True
+        search.rooms[ROOM_ID] = index
+        start = time.perf_counter()
+        await search.save()
+        saved = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        start = time.perf_counter()
+        loaded = search._load_snapshots()
+        load = time.perf_counter() - start
+        assert loaded[ROOM_ID].postings.keys() == index.postings.keys()
+    print(f"\nsnapshot {size / 2 ** 20:.1f} MiB ({size / args.messages:.1f} B/msg), "
+          f"saved in {saved:.2f}s, loaded in {load:.2f}s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Room shard scaling benchmark
+Runs the same room workload on K shard processes and reports messages/sec
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+
+from bench_support import NullWebSocket  # noqa: E402
+from sharding import shard_for_room  # noqa: E402
+
+
+async def run_shard(index, shard_count, rooms, users, messages, barrier):
+    from server import ConnectionManager
+    from backplane import InMemoryBackplane
+
+    owned = [room for room in rooms if shard_for_room(room, shard_count) == index]
+    manager = ConnectionManager(InMemoryBackplane())
+    for room in owned:
+        for i in range(users):
+            await manager.connect(NullWebSocket(), f"{room}-user-{i}", f"user-{i}", room)
+    while any(c.pending for c in manager.registry):
+        await asyncio.sleep(0)
+
+    # Time only the message phase, started together on every shard
+    barrier.wait()
+    start = time.perf_counter()
+    sent = 0
+    for n in range(messages):
+        room = owned[n % len(owned)] if owned else None
+        if room is None:
+            break
+        await manager.broadcast_to_room(room, {
+            "type": "message",
+            "id": f"{room}-{n}",
+            "user_id": f"{room}-user-0",
+            "username": "user-0",
+            "message": "late night beats and rain",
+            "timestamp": datetime.utcnow().isoformat(),
+            "user_count": users
+        })
+        sent += 1
+        if n % 32 == 0:
+            await asyncio.sleep(0)
+    while any(c.pending for c in manager.registry):
+        await asyncio.sleep(0)
+    return sent, time.perf_counter() - start
+
+
+def shard_process(index, shard_count, rooms, users, messages, barrier, results):
+    results.put(asyncio.run(run_shard(index, shard_count, rooms, users, messages, barrier)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure messages/sec as room shards are added")
+    parser.add_argument("--shards", default="1,2,4", help="Comma-separated shard counts to try")
+    parser.add_argument("--rooms", type=int, default=32)
+    parser.add_argument("--users", type=int, default=100, help="Members per room")
+    parser.add_argument("--messages", type=int, default=20000, help="Total messages across all rooms")
+    args = parser.parse_args()
+
+    rooms = [f"room-{i}" for i in range(args.rooms)]
+    print(f"{args.rooms} rooms x {args.users} users, {args.messages} messages, {multiprocessing.cpu_count()} CPUs\n")
+    for shard_count in [int(k) for k in args.shards.split(",")]:
+        # Each shard gets the share of messages matching the rooms it owns
+        owned = [sum(1 for r in rooms if shard_for_room(r, shard_count) == i) for i in range(shard_count)]
+        barrier = multiprocessing.Barrier(shard_count)
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=shard_process, args=(
+                i, shard_count, rooms, args.users, args.messages * owned[i] // args.rooms, barrier, results
+            ))
+            for i in range(shard_count)
+        ]
+        for process in processes:
+            process.start()
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        sent = sum(count for count, _ in outcomes)
+        wall = max(elapsed for _, elapsed in outcomes)
+        print(f"K={shard_count:<3} {sent / wall:>10.0f} msgs/sec  "
+              f"{sent * args.users / wall:>12.0f} frames/sec  (rooms per shard: {owned})")
+
+
+if __name__ == "__main__":
+    main()
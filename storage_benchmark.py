@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Storage backend benchmark
+Appends chat messages in write-behind sized batches, then times latest-page,
+cursor-page and seq-range reads for each backend
+
+    python storage_benchmark.py --mongo-url mongodb://localhost:27017
+
+Without --mongo-url the Mongo adapter runs against the in-process stand-in
+(mongomock://), which is only a functional baseline, not a performance one.
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+
+from history import message_key  # noqa: E402
+from storage import create_storage  # noqa: E402
+
+ROOMS = 10
+BATCH = 500
+READS = 200
+
+
+def make_messages(count):
+    start = datetime.utcnow()
+    seqs = {}
+    messages = []
+    for i in range(count):
+        room_id = f"bench-room-{i % ROOMS}"
+        seqs[room_id] = seqs.get(room_id, 0) + 1
+        messages.append({
+            "id": str(uuid.uuid4()),
+            "seq": seqs[room_id],
+            "user_id": f"user_{i % 97}",
+            "username": f"listener{i % 97}",
+            "room_id": room_id,
+            "message": "anyone else studying to this playlist tonight?",
+            "timestamp": start + timedelta(microseconds=i),
+            "message_type": "chat"
+        })
+    return messages
+
+
+async def time_reads(read):
+    samples = []
+    for i in range(READS):
+        start = time.perf_counter()
+        await read(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+async def run(name, storage, messages):
+    await storage.start()
+    try:
+        start = time.perf_counter()
+        for i in range(0, len(messages), BATCH):
+            await storage.append_messages([dict(m) for m in messages[i:i + BATCH]])
+        append_rate = len(messages) / (time.perf_counter() - start)
+
+        room_id = "bench-room-0"
+        in_room = [m for m in messages if m["room_id"] == room_id]
+        latest = await time_reads(lambda i: storage.read_messages(room_id, 50))
+        paged = await time_reads(
+            lambda i: storage.read_messages(room_id, 50, before=message_key(in_room[(i * 37) % len(in_room)]))
+        )
+        by_seq = await time_reads(
+            lambda i: storage.messages_by_seq(room_id, (i * 37) % len(in_room) + 1, (i * 37) % len(in_room) + 101, 100)
+        )
+    finally:
+        await storage.close()
+
+    print(f"{name:<8} {append_rate:>10.0f} msgs/s appended   "
+          f"latest {latest:>6.3f} ms   before-cursor {paged:>6.3f} ms   seq range {by_seq:>6.3f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Storage backend benchmark")
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--mongo-url", default="mongomock://")
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages)
+    print(f"{args.messages} messages over {ROOMS} rooms, appended {BATCH} at a time; reads are medians of {READS}\n")
+    with tempfile.TemporaryDirectory() as path:
+        await run("log", create_storage("log", path=path), messages)
+    await run("mongo", create_storage("mongo", mongo_url=args.mongo_url, db_name=f"storage_benchmark_{uuid.uuid4().hex[:8]}"), messages)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
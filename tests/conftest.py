@@ -0,0 +1,32 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# The backend modules import each other as top-level modules, as server.py runs them
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+# server.py reads its settings on import: an in-process Mongo stand-in, scratch files, and no
+# per-connection message rate unless a test sets one
+os.environ.update(
+    STORAGE="mongo",
+    MONGO_URL="mongomock://tests",
+    DB_NAME="chat",
+    STORAGE_PATH=tempfile.mkdtemp(prefix="chat-tests-"),
+    BACKPLANE="memory",
+    SHARD_COUNT="1",
+    ADMIN_TOKEN="test-token",
+    WS_CONN_RATE="0"
+)
+
+
+@pytest.fixture(scope="session")
+def client():
+    # One running app for every test that talks to it over HTTP or WebSocket
+    from fastapi.testclient import TestClient
+
+    import server
+    with TestClient(server.app) as client:
+        yield client
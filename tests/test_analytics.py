@@ -0,0 +1,43 @@
+import asyncio
+
+from analytics import RoomActivity
+
+
+class Clock:
+    def __init__(self, now: float):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_restart_restores_history_but_not_listeners(tmp_path):
+    path = str(tmp_path / "stats.npz")
+    clock = Clock(600 * 60.0)
+    before = RoomActivity(path, minutes=60, hours=48, clock=clock)
+    before.listeners("lobby", 12)
+    before.message("lobby", "alice")
+    before.message("lobby", "bob")
+    asyncio.run(before.save())
+
+    # Down for ten minutes
+    clock.now += 10 * 60
+    after = RoomActivity(path, minutes=60, hours=48, clock=clock)
+    after._restore(after._load_snapshot())
+    stats = after.stats("minute", 11, room_id="lobby")
+    assert stats["messages"] == [2] + [0] * 10
+    assert stats["active_senders"] == [2] + [0] * 10
+    assert stats["listeners"] == [12] + [0] * 10
+    assert after.current_listeners[after.rooms["lobby"]] == 0
+
+
+def test_rooms_outside_the_catalog_are_not_counted(tmp_path):
+    activity = RoomActivity(str(tmp_path / "stats.npz"), minutes=10, hours=48, clock=Clock(0.0),
+                            known={"lobby"}.__contains__)
+    for i in range(1000):
+        activity.message(f"made-up-{i}", "mallory")
+        activity.listeners(f"made-up-{i}", 1)
+    activity.message("lobby", "alice")
+    assert activity.room_ids == ["lobby"]
+    assert activity.stats("minute", 1)["messages"] == [1]
+    assert activity.stats("minute", 1, room_id="made-up-1")["messages"] == [0]
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from backplane import InMemoryBackplane, InMemoryHub, UnixSocketBackplane
+from sharding import ShardMap, claim_directory, shard_for_room
+
+
+class Worker:
+    def __init__(self, backplane):
+        self.backplane = backplane
+        self.received = []
+        self.presence = []
+        backplane.on_presence = self.presence.append
+
+    async def start(self):
+        await self.backplane.start(lambda room_id, frame, key: self.received.append((room_id, frame, key)))
+        return self
+
+
+async def settle(condition, timeout: float = 5.0):
+    async def wait():
+        while not condition():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(wait(), timeout)
+
+
+def test_memory_hub_delivers_to_other_subscribed_workers():
+    async def run():
+        hub = InMemoryHub()
+        a, b, c = [await Worker(InMemoryBackplane(hub)).start() for _ in range(3)]
+        b.backplane.subscribe("room")
+        a.backplane.subscribe("room")
+        a.backplane.publish("room", "hello", "key")
+        a.backplane.publish("other", "ignored")
+
+        a.backplane.set_presence("room", 2)
+        b.backplane.set_presence("room", 3)
+        totals = [w.backplane.room_user_count("room") for w in (a, b, c)]
+        await b.backplane.close()
+        after_close = a.backplane.room_user_count("room")
+        a.backplane.set_presence("room", 0)
+        return a, b, c, totals, after_close
+
+    a, b, c, totals, after_close = asyncio.run(run())
+    assert a.received == [] and c.received == []
+    assert b.received == [("room", "hello", "key")]
+    assert totals == [5, 5, 5]
+    assert after_close == 2
+    assert a.backplane.room_user_count("room") == 0 and "room" not in c.backplane.totals
+    assert c.presence == ["room"] * 4
+
+
+def test_unix_workers_share_frames_and_presence_across_a_broker_handover(tmp_path):
+    path = str(tmp_path / "bp.sock")
+
+    async def run():
+        first = await Worker(UnixSocketBackplane(path, reconnect_delay=0.05)).start()
+        second = await Worker(UnixSocketBackplane(path, reconnect_delay=0.05)).start()
+        assert first.backplane.broker is not None and second.backplane.broker is None
+
+        second.backplane.subscribe("room")
+        second.backplane.set_presence("room", 1)
+        first.backplane.set_presence("room", 2)
+        await settle(lambda: second.backplane.room_user_count("room") == 3
+                     and first.backplane.room_user_count("room") == 3)
+        first.backplane.publish("room", "hello")
+        await settle(lambda: second.received)
+
+        # The broker's worker goes away: the other takes the lock and replays its state
+        await first.backplane.close()
+        await settle(lambda: second.backplane.broker is not None)
+        await settle(lambda: second.backplane.room_user_count("room") == 1)
+        third = await Worker(UnixSocketBackplane(path, reconnect_delay=0.05)).start()
+        await settle(lambda: third.backplane.room_user_count("room") == 1)
+        third.backplane.publish("room", "again")
+        await settle(lambda: len(second.received) == 2)
+        await third.backplane.close()
+        await second.backplane.close()
+        return second.received
+
+    assert asyncio.run(run()) == [("room", "hello", None), ("room", "again", None)]
+
+
+def test_shard_map_routes_every_room_to_one_shard():
+    urls = [f"ws://shard{i}" for i in range(4)]
+    shards = [ShardMap(i, 4, urls) for i in range(4)]
+    for room_id in (f"room_{i}" for i in range(100)):
+        owners = [shard.index for shard in shards if shard.owns(room_id)]
+        assert owners == [shard_for_room(room_id, 4)]
+        assert shards[0].url_for(room_id) == urls[owners[0]]
+    single = ShardMap()
+    assert not single.enabled and single.owns("anything") and single.url_for("anything") is None
+    with pytest.raises(ValueError):
+        ShardMap(4, 4)
+
+
+def test_each_claim_gets_a_directory_of_its_own(tmp_path):
+    first, second = claim_directory(str(tmp_path), "worker"), claim_directory(str(tmp_path), "worker")
+    assert (first, second) == (str(tmp_path / "worker-0"), str(tmp_path / "worker-1"))
@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+import server
+from backplane import InMemoryBackplane
+from server import ConnectionManager
+from tests.test_send_queue import FakeWebSocket
+
+
+class FakeClock:
+    # Stands in for the time module inside server, so rate windows move only when told to
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def delivered(socket: FakeWebSocket) -> list:
+    # Chat traffic as it reached the client: a seq per single message, a tuple per batch
+    out = []
+    for frame in socket.sent:
+        if frame["type"] == "message":
+            out.append(frame["seq"])
+        elif frame["type"] == "batch":
+            out.append(tuple(event["seq"] for event in frame["events"]))
+    return out
+
+
+def test_always_mode_sends_one_batch_per_tick():
+    async def run():
+        manager = ConnectionManager(InMemoryBackplane())
+        manager.batch_mode, manager.batch_tick = "always", 0.02
+        socket = FakeWebSocket()
+        await manager.connect(socket, "u1", "U1", "room")
+        for n in range(3):
+            await manager.broadcast_to_room("room", {"type": "message", "seq": n})
+        await asyncio.sleep(0)
+        before_tick = delivered(socket)
+        await asyncio.sleep(0.05)
+        first_tick = delivered(socket)
+        for n in range(3, 5):
+            await manager.broadcast_to_room("room", {"type": "message", "seq": n})
+        await asyncio.sleep(0.05)
+        return before_tick, first_tick, delivered(socket), socket.sent
+
+    before_tick, first_tick, after, sent = asyncio.run(run())
+    assert before_tick == []
+    assert first_tick == [(0, 1, 2)]
+    assert after == [(0, 1, 2), (3, 4)]
+    assert [f["room_id"] for f in sent if f["type"] == "batch"] == ["room", "room"]
+
+
+def test_auto_mode_batches_only_while_the_room_is_busy(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server, "time", clock)
+
+    async def run():
+        manager = ConnectionManager(InMemoryBackplane())
+        manager.batch_mode, manager.batch_tick, manager.batch_rate = "auto", 0.02, 20
+        socket = FakeWebSocket()
+        await manager.connect(socket, "u1", "U1", "room")
+        # 25 messages in the first second: measured when the next one arrives
+        for n in range(25):
+            await manager.broadcast_to_room("room", {"type": "message", "seq": n})
+        clock.now = 1.0
+        for n in range(25, 28):
+            await manager.broadcast_to_room("room", {"type": "message", "seq": n})
+        await asyncio.sleep(0.05)
+        busy = delivered(socket)[25:]
+        # Two more inside the next tick, then the rate falls and batching stops
+        for n in range(28, 30):
+            await manager.broadcast_to_room("room", {"type": "message", "seq": n})
+        clock.now = 3.0
+        await manager.broadcast_to_room("room", {"type": "message", "seq": 30})
+        await asyncio.sleep(0.05)
+        return busy, delivered(socket)
+
+    busy, sent = asyncio.run(run())
+    assert sent[:25] == list(range(25))
+    assert busy == [(25, 26, 27)]
+    # Pending events are flushed ahead of the first unbatched message
+    assert sent[25:] == [(25, 26, 27), (28, 29), 30]
@@ -0,0 +1,34 @@
+from datetime import datetime
+
+import catalog
+from catalog import RoomCatalog
+
+
+def room(i: int) -> dict:
+    return {"id": f"room_{i}", "name": f"Room {i}", "created_at": datetime(2024, 1, 1, 0, i)}
+
+
+def test_workers_with_different_histories_agree_on_etags():
+    counts = {"room_1": 3}
+    first, second = RoomCatalog(counts.get), RoomCatalog(counts.get)
+    first.load([room(i) for i in range(5)])
+    for i in range(5):
+        second.add(room(i))
+        second.count_changed(f"room_{i}")
+    assert first.version != second.version
+    assert first.page(0, 3) == second.page(0, 3)
+
+    counts["room_1"] = 4
+    first.count_changed("room_1")
+    assert first.page(0, 3)[1] != second.page(0, 3)[1]
+    assert first.page(3, 3) == second.page(3, 3)
+
+
+def test_page_cache_is_bounded():
+    rooms = RoomCatalog(lambda room_id: 0)
+    rooms.load([room(i) for i in range(3)])
+    for offset in range(catalog.MAX_CACHED_PAGES + 10):
+        rooms.page(offset, 1)
+    rooms.page(0, 1)
+    assert len(rooms._pages) == catalog.MAX_CACHED_PAGES
+    assert next(reversed(rooms._pages)) == (0, 1)
@@ -0,0 +1,71 @@
+from connections import ConnectionRegistry, IdleWheel, Interner
+
+
+class Record:
+    def __init__(self, multiplexed: bool = False):
+        self.user = self.room = self.slot = -1
+        self.rooms = {} if multiplexed else None
+
+
+def test_interner_reuses_released_ids():
+    names = Interner()
+    assert [names.intern(n) for n in ("a", "b", "c")] == [0, 1, 2]
+    names.release(1)
+    assert names.lookup("b") is None
+    assert names.intern("d") == 1
+    assert names.name(1) == "d"
+    assert names.intern("a") == 0
+
+
+def test_removal_swaps_the_last_member_into_place():
+    registry: ConnectionRegistry[Record] = ConnectionRegistry()
+    records = [Record() for _ in range(4)]
+    assert registry.add(records[0], "user_0", "room")
+    for i, record in enumerate(records[1:], 1):
+        assert not registry.add(record, f"user_{i}", "room")
+
+    assert not registry.leave(records[1], "room")
+    registry.remove(records[1])
+    assert registry.room("room") == [records[0], records[3], records[2]]
+    assert [record.slot for record in registry.room("room")] == [0, 1, 2]
+    assert records[1].room == -1 and registry.get("user_1") is None
+    assert len(registry) == 3
+
+    for record in (records[0], records[3]):
+        registry.leave(record, "room")
+    assert registry.leave(records[2], "room")
+    assert registry.room("room") == []
+    assert list(registry.room_sizes()) == []
+
+
+def test_multiplexed_connections_keep_a_slot_per_room():
+    registry: ConnectionRegistry[Record] = ConnectionRegistry()
+    single, multi = Record(), Record(multiplexed=True)
+    registry.add(single, "single", "a")
+    registry.add(multi, "multi")
+    assert not registry.join(multi, "a")
+    assert registry.join(multi, "b")
+    assert sorted(registry.room_ids(multi)) == ["a", "b"]
+    assert registry.joined(multi, "b") and not registry.joined(single, "b")
+
+    registry.leave(single, "a")
+    assert multi.rooms[registry.rooms.lookup("a")] == 0
+    assert dict(registry.room_sizes()) == {"a": 1, "b": 1}
+    assert registry.leave(multi, "b")
+    assert registry.room_ids(multi) == ["a"]
+    assert registry.get("multi") is multi and list(registry) == [single, multi]
+
+
+def test_idle_wheel_returns_items_once_their_slot_passes():
+    wheel: IdleWheel[str] = IdleWheel(tick=1.0)
+    wheel.schedule("early", 10.5)
+    wheel.schedule("late", 30.0)
+    assert wheel.due(10.9) == []
+    assert wheel.due(11.0) == ["early"]
+    assert wheel.due(11.0) == []
+    # Deadlines already behind the wheel go in the next slot rather than being lost
+    wheel.schedule("overdue", 5.0)
+    assert wheel.due(12.0) == ["overdue"]
+    # Skipped ticks are caught up on
+    assert wheel.due(100.0) == ["late"]
+    assert wheel.slots == {}
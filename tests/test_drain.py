@@ -0,0 +1,78 @@
+import json
+import uuid
+
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+import server
+from tests.test_multiplexed import receive_messages, receive_until
+
+
+def room() -> str:
+    return f"room-{uuid.uuid4().hex[:8]}"
+
+
+def test_resume_token_round_trip():
+    token = server.encode_resume_token("general", 42)
+    assert server.decode_resume_token(token) == ("general", 42)
+    assert server.decode_resume_token(server.encode_resume_token("general", -3)) == ("general", 0)
+    assert server.decode_resume_token("not a token") is None
+    assert server.decode_resume_token("") is None
+
+
+def test_drain_hands_out_resume_tokens_and_refuses_new_sockets(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(server.manager, "draining", False)
+    monkeypatch.setattr(server, "DRAIN_JITTER_MS", 0)
+    monkeypatch.setattr(server, "DRAIN_STATE_PATH", str(tmp_path / "drain-state.json"))
+    first, second = room(), room()
+    with client.websocket_connect(f"/ws/{first}/dana/Dana") as single, \
+            client.websocket_connect("/ws/erin/Erin") as multiplexed:
+        for n in range(3):
+            single.send_json({"message": f"m{n}"})
+        receive_messages(single, 3)
+        for room_id in (first, second):
+            multiplexed.send_json({"type": "subscribe", "room_id": room_id})
+            receive_until(multiplexed, "subscribed")
+
+        assert client.post("/api/admin/drain").status_code == 403
+        response = client.post("/api/admin/drain", headers={"X-Admin-Token": "test-token"})
+        assert response.status_code == 200 and response.json()["closed"] == 2
+
+        hint = receive_until(single, "reconnect")[-1]
+        assert (hint["reason"], hint["after_ms"]) == ("draining", server.DRAIN_RECONNECT_MS)
+        assert server.decode_resume_token(hint["resume"]) == (first, 3)
+        hint = receive_until(multiplexed, "reconnect")[-1]
+        tokens = {room_id: server.decode_resume_token(token) for room_id, token in hint["resume"].items()}
+        assert tokens == {first: (first, 3), second: (second, 0)}
+        with pytest.raises(WebSocketDisconnect) as closed:
+            single.receive_json()
+        assert closed.value.code == 1012
+
+    with client.websocket_connect(f"/ws/{first}/frank/Frank") as refused:
+        assert refused.receive_json()["type"] == "reconnect"
+        with pytest.raises(WebSocketDisconnect) as closed:
+            refused.receive_json()
+        assert closed.value.code == 1013
+    assert client.post("/api/admin/drain", headers={"X-Admin-Token": "test-token"}).status_code == 409
+
+    with open(tmp_path / "drain-state.json") as f:
+        state = json.load(f)
+    assert state["rooms"][first]["seq"] == 3
+    assert sorted(state["rooms"][first]["users"]) == [["dana", "Dana"], ["erin", "Erin"]]
+    assert state["rooms"][second] == {"seq": 0, "users": [["erin", "Erin"]]}
+
+
+def test_resume_token_replays_what_the_client_missed(client):
+    room_id = room()
+    with client.websocket_connect(f"/ws/{room_id}/gina/Gina") as ws:
+        for n in range(4):
+            ws.send_json({"message": f"m{n}"})
+        receive_messages(ws, 4)
+    token = server.encode_resume_token(room_id, 2)
+
+    with client.websocket_connect(f"/ws/{room_id}/gina/Gina?resume={token}") as ws:
+        assert receive_messages(ws, 2) == [(3, "m2"), (4, "m3")]
+    with client.websocket_connect("/ws/gina/Gina") as ws:
+        ws.send_json({"type": "subscribe", "room_id": room_id, "resume": token})
+        assert receive_until(ws, "subscribed")[-1]["last_seq"] == 4
+        assert receive_messages(ws, 2) == [(3, "m2"), (4, "m3")]
@@ -0,0 +1,104 @@
+import asyncio
+
+from history import RecentHistory, RoomSequencer
+from storage import create_storage
+from tests.test_logstore import message, seqs
+
+
+def test_workers_sharing_a_counter_never_reuse_a_seq():
+    async def run():
+        storage = create_storage('mongo', 'mongomock://test', 'chat')
+        await storage.start()
+        await storage.append_messages([message(7)])
+        workers = [RoomSequencer(storage.last_seq, storage.next_seq) for _ in range(3)]
+        seqs = await asyncio.gather(*[worker.allocate("room") for worker in workers * 4])
+        return seqs, [worker.last("room") for worker in workers]
+
+    seqs, last = asyncio.run(run())
+    assert sorted(seqs) == list(range(8, 20))
+    assert max(last) == 19
+
+
+def test_local_sequencer_continues_from_storage():
+    async def run():
+        sequencer = RoomSequencer(lambda room_id: asyncio.sleep(0, result=41))
+        await sequencer.ensure("room")
+        return [await sequencer.allocate("room") for _ in range(3)]
+
+    assert asyncio.run(run()) == [42, 43, 44]
+
+
+def test_recent_history_pages_by_seq_whatever_the_timestamps():
+    history = RecentHistory(size=5)
+    same_time = message(1)["timestamp"]
+    stored = [dict(message(seq), timestamp=same_time) for seq in range(1, 11)]
+
+    async def load(limit):
+        return stored[-limit:]
+
+    async def run():
+        return await history.warm("room", load)
+
+    room = asyncio.run(run())
+    assert seqs(history.query(room, 3)) == [8, 9, 10]
+    assert history.query(room, 3, before=8) is None
+    assert seqs(history.query(room, 2, before=8)) == [6, 7]
+    assert seqs(history.query(room, 10, after=6)) == [7, 8, 9, 10]
+    # Older than the buffer: storage has to answer
+    assert history.query(room, 2, after=2) is None
+
+
+def test_recent_history_keeps_seq_order_for_late_arrivals():
+    history = RecentHistory(size=4)
+    for seq in (1, 2, 4, 3, 6, 5):
+        history.append("room", message(seq))
+    assert seqs(history.recent("room")) == [3, 4, 5, 6]
+
+
+def test_messages_stored_before_seqs_are_numbered_on_start():
+    async def run():
+        storage = create_storage('mongo', 'mongomock://test', 'chat')
+        # 80 messages from before seqs, then 3 numbered ones; a room with only old messages
+        legacy = [message(i) for i in range(80)] + [message(i, "quiet") for i in range(3)]
+        for doc in legacy:
+            del doc["seq"]
+        await storage.db.chat_messages.insert_many(legacy + [message(seq) for seq in range(1, 4)])
+        await storage.start()
+        # A second worker starting at the same time changes nothing
+        await storage.start()
+
+        pages = []
+        before = None
+        while True:
+            page = await storage.read_messages("room", 10, before=before)
+            if not page:
+                break
+            pages.append(page)
+            before = page[0]["seq"]
+        quiet = await storage.read_messages("quiet", 10)
+        return pages, quiet, await storage.next_seq("room"), await storage.next_seq("quiet")
+
+    pages, quiet, next_room, next_quiet = asyncio.run(run())
+    assert seqs(pages[0]) == list(range(-6, 4))
+    assert [doc["id"] for doc in pages[0][:7]] == [f"room-{i}" for i in range(73, 80)]
+    assert sum(map(len, pages)) == 83
+    assert seqs(pages[-1])[0] == -79
+    assert seqs(quiet) == [1, 2, 3]
+    assert (next_room, next_quiet) == (4, 4)
+
+
+def test_head_follows_seqs_other_workers_took():
+    async def run():
+        storage = create_storage('mongo', 'mongomock://test', 'chat')
+        await storage.start()
+        here, there = [RoomSequencer(storage.last_seq, storage.next_seq, storage.current_seq) for _ in range(2)]
+        await here.ensure("room")
+        await here.allocate("room")
+        for _ in range(3):
+            await there.allocate("room")
+        stale = here.last("room")
+        head = await here.head("room")
+        here.observe("room", 2)
+        return stale, head, here.last("room")
+
+    assert asyncio.run(run()) == (1, 4, 4)
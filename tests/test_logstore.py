@@ -0,0 +1,163 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import logstore
+from logstore import INDEX_ENTRY, LogStorage, RoomLog, room_directory
+
+START = datetime(2024, 1, 1)
+
+
+def message(seq: int, room_id: str = "room", timestamp: datetime = None) -> dict:
+    return {
+        "id": f"{room_id}-{seq}",
+        "seq": seq,
+        "user_id": "user",
+        "username": "someone",
+        "room_id": room_id,
+        "message": f"message {seq} " + "x" * 40,
+        "timestamp": timestamp or START + timedelta(seconds=seq),
+        "message_type": "chat"
+    }
+
+
+def open_log(path, segment_bytes: int = 4096, index_interval: int = 256) -> RoomLog:
+    log = RoomLog(str(path), segment_bytes, index_interval)
+    log.open()
+    return log
+
+
+def seqs(docs):
+    return [doc["seq"] for doc in docs]
+
+
+def test_reads_by_seq_and_cursor_across_segments(tmp_path):
+    log = open_log(tmp_path)
+    log.append([message(seq) for seq in range(1, 301)])
+    assert len(log.segments) > 1
+    assert len(log.blocks) > len(log.segments)
+
+    assert seqs(log.by_seq(37, 45, 100)) == list(range(37, 45))
+    assert seqs(log.by_seq(1, 301, 5)) == [1, 2, 3, 4, 5]
+    assert seqs(log.before(None, 3)) == [298, 299, 300]
+    assert seqs(log.before(150, 4)) == [146, 147, 148, 149]
+    assert seqs(log.after(150, 4)) == [151, 152, 153, 154]
+    assert seqs(log.before(1, 4)) == []
+    assert seqs(log.after(300, 4)) == []
+    log.close()
+
+
+def test_recovers_from_a_torn_record_and_a_stale_index(tmp_path):
+    log = open_log(tmp_path)
+    log.append([message(seq) for seq in range(1, 101)])
+    active = log.segments[-1]
+    path, index_path, size = active.path, active.index_path, active.size
+    log.close()
+
+    # A crash mid-append: half a record past the end, and an index entry pointing at it
+    record = logstore.encode_message(message(101))
+    with open(path, "r+b") as f:
+        f.seek(size)
+        f.write(record[:len(record) // 2])
+    with open(index_path, "ab") as f:
+        f.write(INDEX_ENTRY.pack(101, 0, size))
+        f.write(b"\x01\x02")
+
+    log = open_log(tmp_path)
+    assert log.last_seq == 100
+    assert log.segments[-1].size == size
+    assert all(offset < size for _, _, offset in log.segments[-1].index)
+    assert seqs(log.by_seq(1, 200, 200)) == list(range(1, 101))
+    log.append([message(101)])
+    assert seqs(log.before(None, 2)) == [100, 101]
+    log.close()
+
+    log = open_log(tmp_path)
+    assert seqs(log.by_seq(95, 200, 200)) == list(range(95, 102))
+    log.close()
+
+
+def test_retried_batch_is_stored_once(tmp_path, monkeypatch):
+    log = open_log(tmp_path)
+    log.append([message(seq) for seq in range(1, 11)], batch_id=1)
+
+    # The second chunk of the next batch fails to write after the first one went in
+    batch = [message(seq) for seq in range(11, 201)]
+    writes = []
+    original = logstore.Segment.write
+
+    def failing_write(segment, data, entries):
+        writes.append(len(data))
+        if len(writes) == 2:
+            raise OSError("disk full")
+        original(segment, data, entries)
+
+    monkeypatch.setattr(logstore.Segment, "write", failing_write)
+    with pytest.raises(OSError):
+        log.append(batch, batch_id=2)
+    monkeypatch.setattr(logstore.Segment, "write", original)
+
+    log.append(batch, batch_id=2)
+    log.append(batch, batch_id=2)
+    assert seqs(log.by_seq(1, 1000, 1000)) == list(range(1, 201))
+
+    # The next batch starts from scratch
+    log.append([message(201), message(202)], batch_id=3)
+    assert seqs(log.before(None, 3)) == [200, 201, 202]
+    log.close()
+
+
+def test_storage_retry_skips_rooms_already_stored(tmp_path):
+    async def run():
+        storage = LogStorage(str(tmp_path))
+        await storage.start()
+        batch = [message(1, "a"), message(1, "b"), message(2, "a")]
+        await storage.append_messages(batch, batch_id=7)
+        await storage.append_messages(batch, batch_id=7)
+        found = {room_id: seqs(await storage.messages_by_seq(room_id, 1, 10, 10)) for room_id in ("a", "b")}
+        await storage.close()
+        return found
+
+    assert asyncio.run(run()) == {"a": [1, 2], "b": [1]}
+
+
+def test_expire_drops_old_sealed_segments_only(tmp_path):
+    log = open_log(tmp_path)
+    log.append([message(seq) for seq in range(1, 301)])
+    segments = len(log.segments)
+
+    assert log.expire(START) == []
+    expired = log.expire(START + timedelta(seconds=200))
+    assert expired and len(log.segments) == segments - len(expired)
+    first = log.segments[0].base_seq
+    assert seqs(log.by_seq(1, 1000, 1000)) == list(range(first, 301))
+
+    expired = log.expire(START + timedelta(days=1))
+    assert len(log.segments) == 1
+    assert log.last_seq == 300
+    log.close()
+
+
+def test_expire_with_an_empty_newest_segment_after_a_crash(tmp_path):
+    log = open_log(tmp_path)
+    log.append([message(seq) for seq in range(1, 301)])
+    log.close()
+    # Crashed right after rolling: the new segment was preallocated but never written
+    with open(os.path.join(str(tmp_path), f"{301:020d}.log"), "wb") as f:
+        f.write(b"\0" * 4096)
+
+    log = open_log(tmp_path)
+    assert log.segments[-1].size == 0
+    assert log.last_seq == 300
+    log.expire(START + timedelta(days=1))
+    assert log.segments[-1].base_seq == 301
+    log.close()
+
+
+def test_room_directory_is_safe_for_any_room_id(tmp_path):
+    root = str(tmp_path)
+    for room_id in ("../escape", "a/b", "ü"):
+        directory = room_directory(root, room_id)
+        assert os.path.dirname(directory) == root
@@ -0,0 +1,109 @@
+import uuid
+
+import server
+
+
+def room() -> str:
+    return f"room-{uuid.uuid4().hex[:8]}"
+
+
+def receive_until(ws, kind: str) -> list:
+    # Frames up to and including the first of type `kind`
+    frames = []
+    while not frames or frames[-1]["type"] != kind:
+        frames.append(ws.receive_json())
+    return frames
+
+
+def receive_messages(ws, count: int) -> list:
+    # The next `count` chat messages as (seq, text), skipping presence and other events
+    messages = []
+    while len(messages) < count:
+        frame = ws.receive_json()
+        if frame["type"] == "message":
+            messages.append((frame["seq"], frame["message"]))
+    return messages
+
+
+def test_subscribe_then_message_then_presence(client):
+    room_id = room()
+    with client.websocket_connect("/ws/alice/Alice") as ws:
+        ws.send_json({"type": "subscribe", "room_id": room_id})
+        assert ws.receive_json() == {"type": "subscribed", "room_id": room_id, "last_seq": 0, "user_count": 1}
+        ws.send_json({"type": "message", "room_id": room_id, "message": "hi"})
+        message = ws.receive_json()
+        assert (message["type"], message["room_id"], message["seq"], message["message"]) == ("message", room_id, 1, "hi")
+        presence = ws.receive_json()
+        assert presence["type"] == "presence" and presence["room_id"] == room_id
+        assert presence["joined"] == [["alice", "Alice"]] and presence["user_count"] == 1
+
+
+def test_replay_comes_between_the_ack_and_live_messages(client):
+    room_id = room()
+    with client.websocket_connect(f"/ws/{room_id}/bob/Bob") as sender:
+        for n in range(3):
+            sender.send_json({"message": f"m{n}"})
+            receive_messages(sender, 1)
+        with client.websocket_connect("/ws/carol/Carol") as ws:
+            ws.send_json({"type": "subscribe", "room_id": room_id, "last_seq": 1})
+            ack = ws.receive_json()
+            assert (ack["type"], ack["last_seq"]) == ("subscribed", 3)
+            sender.send_json({"message": "live"})
+            assert receive_messages(ws, 3) == [(2, "m1"), (3, "m2"), (4, "live")]
+
+
+def test_rooms_on_one_socket_are_kept_apart(client):
+    first, second = room(), room()
+    with client.websocket_connect("/ws/dave/Dave") as ws, client.websocket_connect("/ws/erin/Erin") as other:
+        for room_id in (first, second):
+            ws.send_json({"type": "subscribe", "room_id": room_id})
+            assert ws.receive_json()["type"] == "subscribed"
+        other.send_json({"type": "subscribe", "room_id": second})
+        assert other.receive_json()["user_count"] == 2
+
+        presence = {}
+        while len(presence) < 2:
+            frame = ws.receive_json()
+            if frame["type"] == "presence":
+                presence[frame["room_id"]] = (sorted(map(tuple, frame["joined"])), frame["user_count"])
+        assert presence == {first: ([("dave", "Dave")], 1), second: ([("dave", "Dave"), ("erin", "Erin")], 2)}
+
+        ws.send_json({"type": "unsubscribe", "room_id": first})
+        assert receive_until(ws, "unsubscribed")[-1] == {"type": "unsubscribed", "room_id": first}
+        ws.send_json({"type": "message", "room_id": first, "message": "gone"})
+        assert receive_until(ws, "error")[-1] == {"type": "error", "reason": "not_subscribed", "room_id": first}
+        other.send_json({"type": "message", "room_id": second, "message": "still here"})
+        message = receive_until(ws, "message")[-1]
+        assert (message["room_id"], message["message"]) == (second, "still here")
+
+
+def test_frames_without_a_room_are_rejected(client):
+    with client.websocket_connect("/ws/frank/Frank") as ws:
+        ws.send_json({"type": "subscribe"})
+        assert ws.receive_json() == {"type": "error", "reason": "malformed"}
+        ws.send_json({"type": "dance", "room_id": "x"})
+        assert ws.receive_json() == {"type": "error", "reason": "not_subscribed", "room_id": "x"}
+
+
+def test_control_frames_skip_the_connection_rate(client, monkeypatch):
+    monkeypatch.setattr(server.ingress_limiter.defaults, "conn_rate", 0.001)
+    monkeypatch.setattr(server.ingress_limiter.defaults, "conn_burst", 2)
+    first, second = room(), room()
+    with client.websocket_connect("/ws/hana/Hana") as ws:
+        ws.send_json({"type": "subscribe", "room_id": first})
+        receive_until(ws, "subscribed")
+        ws.send_json({"type": "message", "room_id": first, "message": "hi"})
+        receive_messages(ws, 1)
+        # The bucket is empty now; reads, pongs and snapshots still go through
+        for n in range(5):
+            ws.send_json({"type": "pong"})
+            ws.send_json({"type": "read", "room_id": first, "seq": 1})
+            ws.send_json({"type": "presence_snapshot", "room_id": first})
+            assert receive_until(ws, "presence_snapshot")[-1]["room_id"] == first
+        # A subscribe over the limit is answered, every time
+        for n in range(2):
+            ws.send_json({"type": "subscribe", "room_id": second})
+            refused = receive_until(ws, "rate_limited")[-1]
+            assert refused["room_id"] == second and refused["retry_after_ms"] > 0
+        ws.send_json({"type": "message", "room_id": first, "message": "again"})
+        assert "room_id" not in receive_until(ws, "rate_limited")[-1]
@@ -0,0 +1,62 @@
+import asyncio
+
+from logstore import LogStorage
+from persistence import MessageWriter
+from tests.test_logstore import message, seqs
+
+
+class FlakyStorage:
+    # Stores into `inner`, failing every call listed in fail_calls after the append went through
+    def __init__(self, inner, fail_calls):
+        self.inner = inner
+        self.fail_calls = set(fail_calls)
+        self.calls = 0
+
+    async def append_messages(self, docs, batch_id=None):
+        self.calls += 1
+        await self.inner.append_messages(docs, batch_id)
+        if self.calls in self.fail_calls:
+            raise OSError("lost the reply")
+
+
+def test_full_buffer_keeps_add_order_through_retries(tmp_path):
+    async def run():
+        log = LogStorage(str(tmp_path))
+        await log.start()
+        writer = MessageWriter(FlakyStorage(log, {1, 3}), batch_size=2, flush_interval=0.01,
+                               max_buffer=2, retry_backoff=0.001)
+        writer.start()
+
+        async def produce(seq):
+            await writer.add(message(seq))
+
+        tasks = []
+        for seq in range(1, 41):
+            tasks.append(asyncio.create_task(produce(seq)))
+            if seq % 3 == 0:
+                await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        await writer.close()
+        stored = seqs(await log.messages_by_seq("room", 1, 100, 100))
+        await log.close()
+        return stored
+
+    assert asyncio.run(run()) == list(range(1, 41))
+
+
+def test_wait_reports_a_dropped_batch(tmp_path):
+    class DownStorage:
+        async def append_messages(self, docs, batch_id=None):
+            raise OSError("down")
+
+    async def run():
+        writer = MessageWriter(DownStorage(), batch_size=1, flush_interval=0.01, max_retries=1, retry_backoff=0.001)
+        writer.start()
+        try:
+            await writer.add(message(1), wait=True)
+        except OSError as e:
+            return str(e)
+        finally:
+            await writer.close()
+
+    assert asyncio.run(run()) == "down"
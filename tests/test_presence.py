@@ -0,0 +1,48 @@
+import asyncio
+
+from backplane import InMemoryBackplane
+from server import ConnectionManager, PresenceDelta
+from tests.test_send_queue import FakeWebSocket
+
+
+def presence(socket: FakeWebSocket) -> list:
+    return [(f["joined"], f["left"], f["user_count"]) for f in socket.sent if f["type"] == "presence"]
+
+
+def test_join_and_leave_in_one_window_cancel_out():
+    delta = PresenceDelta()
+    delta.join("a", "A")
+    delta.leave("a", "A")
+    assert (delta.joined, delta.left) == ({}, {})
+    delta.leave("b", "B")
+    delta.join("b", "B")
+    assert (delta.joined, delta.left) == ({}, {})
+    delta.join("c", "C")
+    delta.leave("d", "D")
+    assert (delta.joined, delta.left) == ({"c": "C"}, {"d": "D"})
+
+
+def test_one_presence_frame_per_window():
+    async def run():
+        manager = ConnectionManager(InMemoryBackplane())
+        manager.presence_window = 0.02
+        watcher = FakeWebSocket()
+        await manager.connect(watcher, "watcher", "Watcher", "room")
+        await asyncio.sleep(0.05)
+        first = presence(watcher)
+        # Within one window: two join, one of them leaves again
+        await manager.connect(FakeWebSocket(), "u1", "U1", "room")
+        await manager.connect(FakeWebSocket(), "u2", "U2", "room")
+        manager.disconnect("u1")
+        await asyncio.sleep(0.05)
+        second = presence(watcher)[1:]
+        # A window where someone leaves and comes straight back sends nothing
+        manager.disconnect("u2")
+        await manager.connect(FakeWebSocket(), "u2", "U2", "room")
+        await asyncio.sleep(0.05)
+        return first, second, presence(watcher)[2:]
+
+    first, second, third = asyncio.run(run())
+    assert first == [([["watcher", "Watcher"]], [], 1)]
+    assert second == [([["u2", "U2"]], [], 2)]
+    assert third == []
@@ -0,0 +1,68 @@
+import zlib
+
+import msgpack
+import pytest
+
+from protocol import DEFLATED, RAW, Frame, FrameTooLarge, UserRefs, decode_client_frame, ref_definitions
+
+
+def deflate(payload: bytes) -> bytes:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return DEFLATED + compressor.compress(payload) + compressor.flush()
+
+
+def test_decodes_raw_and_deflated_frames_with_short_keys():
+    packed = msgpack.packb({"t": "message", "m": "hi", "r": "lobby"})
+    expected = {"type": "message", "message": "hi", "room_id": "lobby"}
+    assert decode_client_frame(packed) == expected
+    assert decode_client_frame(RAW + packed) == expected
+    assert decode_client_frame(deflate(packed), max_size=1024) == expected
+
+
+def test_deflated_frame_is_limited_by_its_inflated_size():
+    bomb = deflate(msgpack.packb({"m": "a" * 10_000_000}))
+    assert len(bomb) < 16384
+    with pytest.raises(FrameTooLarge):
+        decode_client_frame(bomb, max_size=16384)
+
+
+def test_undecodable_frames_raise_value_error():
+    packed = deflate(msgpack.packb({"m": "hi"}))
+    for frame in (DEFLATED + b"not deflate", packed[:-3], msgpack.packb([1, 2]), b"\xc1"):
+        with pytest.raises(ValueError):
+            decode_client_frame(frame, max_size=1024)
+
+
+def test_user_refs_are_released_with_the_last_connection():
+    refs = UserRefs(max_idle=2)
+    first = refs.intern("alice", "Alice")
+    refs.acquire("alice", "Alice")
+    refs.acquire("alice", "Alice")
+    assert refs.intern("alice", "Alice") == first
+    for i in range(10):
+        refs.intern(f"author-{i}", "someone")
+    assert len(refs) == 3
+
+    refs.release("alice")
+    assert "alice" in refs.held
+    refs.release("alice")
+    for i in range(10):
+        refs.intern(f"reader-{i}", "someone")
+    assert len(refs) == 2 and not refs.holders
+
+
+def test_renamed_user_gets_a_new_ref_and_never_an_old_one():
+    refs = UserRefs()
+    refs.acquire("alice", "Alice")
+    old = refs.intern("alice", "Alice")
+    new = refs.intern("alice", "Alicia")
+    assert new != old
+    assert refs.held == {"alice": (new, "Alicia")}
+
+
+def test_frames_carry_the_definitions_they_use():
+    frame = Frame({"type": "message", "user_id": "bob", "username": "Bob", "message": "hi"})
+    packed = msgpack.unpackb(frame.packed)
+    assert frame.refs == {packed["u"]: ("bob", "Bob")}
+    definitions = msgpack.unpackb(ref_definitions(frame.refs)[1:])
+    assert definitions == {"t": "users", "d": [[packed["u"], "bob", "Bob"]]}
@@ -0,0 +1,46 @@
+import uuid
+
+import server
+
+
+def post(client, room_id: str, count: int):
+    with client.websocket_connect(f"/ws/{room_id}/poster/Poster") as ws:
+        for n in range(count):
+            ws.send_json({"message": f"m{n}"})
+            while ws.receive_json()["type"] != "message":
+                pass
+    client.portal.call(server.message_writer.flush)
+
+
+def replay(client, room_id: str, last_seq: int, upto: int) -> list:
+    events = client.portal.call(server.load_missed_messages, room_id, last_seq, upto)
+    return [event["seq"] for event in events]
+
+
+def test_replays_everything_after_the_clients_seq(client):
+    room_id = f"room-{uuid.uuid4().hex[:8]}"
+    post(client, room_id, 8)
+    # Only the newest two are still in the ring buffer; the rest come from storage
+    server.recent_history.forget(room_id)
+    post(client, room_id, 2)
+    assert [m["seq"] for m in server.recent_history.recent(room_id)] == [9, 10]
+    assert replay(client, room_id, 2, 10) == [3, 4, 5, 6, 7, 8, 9, 10]
+    assert replay(client, room_id, 8, 9) == [9]
+    assert replay(client, room_id, 10, 10) == []
+
+    with client.websocket_connect(f"/ws/{room_id}/late/Late?last_seq=7") as ws:
+        assert [ws.receive_json()["seq"] for _ in range(3)] == [8, 9, 10]
+
+
+def test_too_far_behind_gets_a_gap_and_the_newest_messages(client, monkeypatch):
+    room_id = f"room-{uuid.uuid4().hex[:8]}"
+    post(client, room_id, 10)
+    monkeypatch.setattr(server, "RESUME_MAX_MESSAGES", 3)
+    events = client.portal.call(server.load_missed_messages, room_id, 1, 10)
+    assert events[0] == {"type": "history_gap", "room_id": room_id, "from_seq": 2, "to_seq": 7}
+    assert [event["seq"] for event in events[1:]] == [8, 9, 10]
+
+    with client.websocket_connect(f"/ws/{room_id}/late/Late?last_seq=0") as ws:
+        gap = ws.receive_json()
+        assert (gap["type"], gap["from_seq"], gap["to_seq"]) == ("history_gap", 1, 7)
+        assert [ws.receive_json()["seq"] for _ in range(3)] == [8, 9, 10]
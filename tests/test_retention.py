@@ -0,0 +1,98 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from retention import RetentionJob, RetentionPolicy
+from storage import create_storage
+from tests.test_logstore import START, message, seqs
+
+BUCKET_MESSAGES = 7
+
+
+async def mongo_storage(count: int):
+    storage = create_storage('mongo', 'mongomock://test', 'chat', archive_bucket_messages=BUCKET_MESSAGES)
+    await storage.start()
+    await storage.append_messages([message(seq) for seq in range(1, count + 1)])
+    return storage
+
+
+async def page_backwards(storage, limit: int):
+    pages, cursor = [], None
+    while True:
+        page = await storage.read_messages("room", limit, before=cursor)
+        if not page:
+            return [seq for page in reversed(pages) for seq in page]
+        pages.append(seqs(page))
+        cursor = page[0]["seq"]
+
+
+async def page_forwards(storage, limit: int):
+    found, cursor = [], 0
+    while True:
+        page = await storage.read_messages("room", limit, after=cursor)
+        if not page:
+            return found
+        found.extend(seqs(page))
+        cursor = page[-1]["seq"]
+
+
+def test_archive_keeps_hot_count_and_reads_page_through_buckets():
+    async def run():
+        storage = await mongo_storage(100)
+        # Buckets of 30 s: several parts each
+        job = RetentionJob(storage, lambda: ["room"], RetentionPolicy(hot_count=10), bucket_seconds=30, batch=16)
+        await job.run_once()
+        hot = await storage.db.chat_messages.count_documents({"room_id": "room"})
+        parts = await storage.db.chat_archive.find({"room_id": "room"}).to_list(None)
+        return (hot, parts, await page_backwards(storage, 6), await page_forwards(storage, 6),
+                seqs(await storage.messages_by_seq("room", 20, 40, 100)), await storage.last_seq("room"))
+
+    hot, parts, backwards, forwards, by_seq, last = asyncio.run(run())
+    assert hot == 10
+    assert sum(part["count"] for part in parts) == 90
+    assert all(len(part["messages"]) <= BUCKET_MESSAGES for part in parts)
+    assert len({(part["start"], part["part"]) for part in parts}) == len(parts)
+    assert backwards == forwards == list(range(1, 101))
+    assert by_seq == list(range(20, 40))
+    assert last == 100
+
+
+def test_interrupted_archive_run_is_repeated_without_duplicates():
+    async def run():
+        storage = await mongo_storage(40)
+        await storage.archive_messages("room", 31, None, 3600, 1000)
+        # As if the run had stopped after filling the buckets but before deleting hot copies
+        await storage.append_messages([message(seq) for seq in range(1, 31)])
+        moved = await storage.archive_messages("room", 31, None, 3600, 1000)
+        parts = await storage.db.chat_archive.find({"room_id": "room"}).to_list(None)
+        return moved, parts, await page_forwards(storage, 100)
+
+    moved, parts, forwards = asyncio.run(run())
+    assert moved == 30
+    assert sum(part["count"] for part in parts) == 30
+    assert forwards == list(range(1, 41))
+
+
+def test_ttl_expires_hot_and_archived_messages():
+    async def run():
+        storage = await mongo_storage(50)
+        expired = []
+        job = RetentionJob(storage, lambda: ["room"], RetentionPolicy(), bucket_seconds=10,
+                           on_expired=lambda room_id, end_seq: expired.append((room_id, end_seq)))
+        await job.apply("room", RetentionPolicy(hot_count=20), START)
+        await job.apply("room", RetentionPolicy(ttl_s=60), START + timedelta(seconds=100))
+        return expired, await page_forwards(storage, 8)
+
+    expired, remaining = asyncio.run(run())
+    # Whole archive buckets go once their newest message is past the cutoff
+    assert remaining == list(range(40, 51))
+    assert expired == [("room", 40)]
+
+
+def test_policy_overrides():
+    job = RetentionJob(None, lambda: [], RetentionPolicy(ttl_s=60), overrides={"quiet": {"ttl_s": 0}})
+    assert job.policy_for("quiet").enabled is False
+    assert job.policy_for("other").ttl_s == 60
+    with pytest.raises(ValueError):
+        RetentionPolicy().override(ttl=1)
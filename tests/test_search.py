@@ -0,0 +1,104 @@
+import asyncio
+from array import array
+
+from logstore import LogStorage
+from search import RoomIndex, SearchIndex, pack_postings, tokenize, unpack_postings
+from tests.test_logstore import message
+
+TEXTS = ["Hello world", "hello there", "the world is big", "WORLDS apart", "hello worldwide web"]
+
+
+def chat(seq: int, text: str, room_id: str = "room") -> dict:
+    return {**message(seq, room_id), "message": text}
+
+
+def room_index() -> RoomIndex:
+    index = RoomIndex()
+    for seq, text in enumerate(TEXTS, 1):
+        index.add(seq, text)
+    return index
+
+
+def test_postings_round_trip_as_gaps():
+    postings = array("I", [3, 4, 10, 1000, 2 ** 31])
+    assert unpack_postings(pack_postings(postings)) == postings
+    assert tokenize("Héllo, WORLD_1!") == ["héllo", "world_1"]
+
+
+def test_every_term_must_match_and_the_last_is_a_prefix():
+    index = room_index()
+    assert index.search(["hello"], None, 10) == [5, 2, 1]
+    assert index.search(["world"], None, 10) == [5, 4, 3, 1]
+    assert index.search(["hello", "world"], None, 10) == [5, 1]
+    assert index.search(["world", "hello"], None, 10) == [1]
+    assert index.search(["hello", "world"], 5, 10) == [1]
+    assert index.search(["world"], None, 2) == [5, 4]
+    assert index.search(["missing", "world"], None, 10) == []
+
+
+def test_late_and_repeated_messages_keep_postings_sorted():
+    index = room_index()
+    index.add(2, "hello there")
+    index.add(0, "hello again")
+    assert index.postings["hello"] == array("I", [0, 1, 2, 5])
+    assert index.last_seq == 5
+
+
+def test_expire_drops_old_postings_and_empty_terms():
+    index = room_index()
+    index.expire(3)
+    assert "there" not in index.postings and "there" not in index.terms
+    assert index.search(["hello"], None, 10) == [5]
+    assert index.search(["world"], None, 10) == [5, 4, 3]
+
+
+def test_catches_up_from_storage_and_reloads_snapshots(tmp_path):
+    async def run():
+        storage = LogStorage(str(tmp_path / "log"))
+        await storage.start()
+        await storage.append_messages([chat(seq, text) for seq, text in enumerate(TEXTS, 1)])
+        search = SearchIndex(storage, str(tmp_path / "search"), catch_up_batch=2)
+        await search.start()
+        # Persisted before the room is searched: left for catch-up to read
+        search.add_messages([chat(6, "hello again")])
+        await storage.append_messages([chat(6, "hello again")])
+        first = await search.search("room", "hello")
+        search.add_messages([chat(7, "hello later")])
+        second = await search.search("room", "hello l")
+        await search.close()
+
+        reloaded = SearchIndex(storage, str(tmp_path / "search"))
+        await reloaded.start()
+        restored = reloaded.rooms["room"].last_seq
+        third = await reloaded.search("room", "hello", before=6)
+        await reloaded.close()
+        await storage.close()
+        return first, second, restored, third
+
+    first, second, restored, third = asyncio.run(run())
+    assert first == [6, 5, 2, 1]
+    assert second == [7]
+    assert restored == 7
+    assert third == [5, 2, 1]
+
+
+def test_rooms_other_processes_write_to_catch_up_before_each_search(tmp_path):
+    async def run():
+        storage = LogStorage(str(tmp_path / "log"))
+        await storage.start()
+        search = SearchIndex(storage, str(tmp_path / "search"), complete=lambda room_id: room_id != "shared")
+        await search.start()
+        results = []
+        for room_id in ("own", "shared"):
+            await storage.append_messages([chat(1, "hello", room_id)])
+            await search.search(room_id, "hello")
+            # Seq 3 persisted here, then seq 2 by another worker after it
+            search.add_messages([chat(3, "hello again", room_id)])
+            await storage.append_messages([chat(3, "hello again", room_id)])
+            await storage.append_messages([chat(2, "hello there", room_id)])
+            results.append(await search.search(room_id, "hello"))
+        await search.close()
+        await storage.close()
+        return results
+
+    assert asyncio.run(run()) == [[3, 1], [3, 2, 1]]
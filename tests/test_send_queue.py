@@ -0,0 +1,124 @@
+import asyncio
+import json
+
+import pytest
+
+from backplane import InMemoryBackplane
+from protocol import Frame
+from server import ClientConnection, ConnectionManager, SlowConsumer, encode_frame
+
+
+class FakeWebSocket:
+    def __init__(self, blocked: bool = False):
+        self.sent = []
+        self.closed_with = None
+        # While cleared, sends wait, like a client that stopped reading
+        self.gate = asyncio.Event()
+        if not blocked:
+            self.gate.set()
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data):
+        await self.gate.wait()
+        self.sent.append(json.loads(data))
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+def frame(n: int) -> Frame:
+    return encode_frame({"type": "message", "seq": n})
+
+
+def queued(connection: ClientConnection):
+    return [(key, f.message["seq"]) for key, f in connection.queue]
+
+
+def test_drop_oldest_keeps_the_newest_frames():
+    async def run():
+        socket = FakeWebSocket()
+        connection = ClientConnection(socket, max_queue=3, policy="drop_oldest", held=True)
+        for n in range(5):
+            connection.enqueue(frame(n))
+        pending = queued(connection)
+        connection.start(lambda c: None)
+        await asyncio.sleep(0.01)
+        return pending, connection.dropped, [m["seq"] for m in socket.sent]
+
+    pending, dropped, sent = asyncio.run(run())
+    assert pending == [(None, 2), (None, 3), (None, 4)]
+    assert dropped == 2
+    assert sent == [2, 3, 4]
+
+
+def test_coalesce_replaces_a_pending_frame_with_the_same_key_in_place():
+    connection = ClientConnection(FakeWebSocket(), max_queue=3, policy="coalesce", held=True)
+    connection.enqueue(frame(0))
+    connection.enqueue(frame(1), "presence")
+    connection.enqueue(frame(2))
+    connection.enqueue(frame(3), "presence")
+    assert queued(connection) == [(None, 0), ("presence", 3), (None, 2)]
+    assert connection.dropped == 0
+    # Nothing to replace: the oldest frame goes
+    connection.enqueue(frame(4), "typing")
+    assert queued(connection) == [("presence", 3), (None, 2), ("typing", 4)]
+    assert connection.dropped == 1
+
+
+def test_disconnect_policy_raises_once_full():
+    connection = ClientConnection(FakeWebSocket(), max_queue=2, policy="disconnect", held=True)
+    connection.enqueue(frame(0))
+    connection.enqueue(frame(1))
+    with pytest.raises(SlowConsumer):
+        connection.enqueue(frame(2))
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        ClientConnection(FakeWebSocket(), policy="block")
+
+
+def test_slow_consumer_is_dropped_without_holding_up_the_room():
+    async def run():
+        manager = ConnectionManager(InMemoryBackplane())
+        fast, slow = FakeWebSocket(), FakeWebSocket(blocked=True)
+        await manager.connect(fast, "fast", "fast", "room")
+        stuck = await manager.connect(slow, "slow", "slow", "room")
+        stuck.policy, stuck.max_queue = "disconnect", 2
+        for n in range(5):
+            await manager.broadcast_to_room("room", {"type": "message", "seq": n})
+        await asyncio.sleep(0.01)
+        members = [manager.registry.user_id(c) for c in manager.registry.room("room")]
+        return fast.sent, slow.closed_with, members, manager.registry.get("slow")
+
+    sent, closed_with, members, slow = asyncio.run(run())
+    assert [m["seq"] for m in sent if m["type"] == "message"] == list(range(5))
+    assert closed_with == 1008
+    assert members == ["fast"] and slow is None
+
+
+def test_writer_task_and_queue_only_exist_while_there_is_something_to_send():
+    async def run():
+        socket = FakeWebSocket(blocked=True)
+        connection = ClientConnection(socket)
+        connection.start(lambda c: None)
+        idle = (connection.queue, connection.writer)
+        connection.enqueue(frame(0))
+        connection.enqueue(frame(1))
+        busy = (connection.pending, connection.writer is not None)
+        socket.gate.set()
+        await asyncio.sleep(0.01)
+        connection.retire()
+        await asyncio.sleep(0.01)
+        retired = (connection.queue, connection.writer)
+        connection.enqueue(frame(2))
+        await asyncio.sleep(0.01)
+        return idle, busy, retired, [m["seq"] for m in socket.sent]
+
+    idle, busy, retired, sent = asyncio.run(run())
+    assert idle == (None, None)
+    assert busy == (2, True)
+    assert retired == (None, None)
+    assert sent == [0, 1, 2]
@@ -0,0 +1,58 @@
+import asyncio
+
+from storage import create_storage
+from unread import ReadTracker
+from tests.test_logstore import message
+
+
+def test_unread_counts_with_and_without_markers():
+    async def run():
+        storage = create_storage('mongo', 'mongomock://test', 'chat')
+        await storage.start()
+        # A quiet room with no head recorded yet
+        await storage.append_messages([message(seq, "quiet") for seq in range(1, 4)])
+        tracker = ReadTracker(storage)
+        await tracker.start()
+        for seq in range(1, 11):
+            tracker.message("busy", seq, "someone")
+        tracker.mark_read("reader", "busy", 4)
+        # Reported past the head: held at the head
+        tracker.mark_read("reader", "late", 9)
+        before = await tracker.unread("reader", ["busy", "quiet", "expired"])
+        await tracker.flush()
+        tracker.message("expired", 20, "someone")
+        tracker.expired("expired", 15)
+        after = await tracker.unread("reader", ["quiet", "expired"])
+        await tracker.close()
+        return before, after
+
+    before, after = asyncio.run(run())
+    assert before["busy"] == {"last_read": 4, "last_seq": 10, "unread": 6}
+    assert before["quiet"] == {"last_read": 0, "last_seq": 3, "unread": 3}
+    assert before["expired"] == {"last_read": 0, "last_seq": 0, "unread": 0}
+    assert before["late"]["last_read"] == 9
+    # Markers come back from storage once flushed; expired messages are not counted
+    assert after["busy"] == before["busy"]
+    assert after["expired"] == {"last_read": 0, "last_seq": 20, "unread": 6}
+
+
+def test_unread_endpoint_covers_every_catalog_room(client):
+    rooms = [client.post("/api/rooms", json={"name": f"unread {n}", "description": "", "niche": "test"}).json()["id"]
+             for n in range(2)]
+    with client.websocket_connect(f"/ws/{rooms[0]}/writer/Writer") as ws:
+        for n in range(3):
+            ws.send_json({"message": f"m{n}"})
+            while ws.receive_json()["type"] != "message":
+                pass
+    counts = client.get("/api/users/reader/unread").json()
+    assert counts[rooms[0]] == {"last_read": 0, "last_seq": 3, "unread": 3}
+    assert counts[rooms[1]] == {"last_read": 0, "last_seq": 0, "unread": 0}
+
+    with client.websocket_connect(f"/ws/{rooms[0]}/reader/Reader") as ws:
+        ws.send_json({"type": "read", "seq": 2})
+        # Answered after the read frame has been handled
+        ws.send_json({"type": "presence_snapshot"})
+        while ws.receive_json()["type"] != "presence_snapshot":
+            pass
+    counts = client.get("/api/users/reader/unread").json()
+    assert counts[rooms[0]]["unread"] == 1